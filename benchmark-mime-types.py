@@ -0,0 +1,57 @@
+"""
+Compare the in-process MIME sniffing of get_mime_type() with one `file
+--mime-type` subprocess per file, on all the files of a folder
+"""
+import argparse
+import os
+import sys
+import time
+
+from lib import get_mime_type, get_mime_type_with_file, get_mime_types
+from utils.mime import sniff_mime_type
+
+
+def time_it(func, file_paths):
+    start = time.time()
+    results = func(file_paths)
+    return results, time.time() - start
+
+
+def with_file(file_paths):
+    return {file_path: get_mime_type_with_file(file_path) for file_path in file_paths}
+
+
+def with_sniffing(file_paths):
+    return {file_path: get_mime_type(file_path) for file_path in file_paths}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the MIME type detection')
+    parser.add_argument('folder', help='Folder whose files are used for the benchmark (recursively)')
+    parser.add_argument('-n', '--max-files', default=1000, type=int, help='Maximum number of files')
+    args = parser.parse_args()
+
+    file_paths = []
+    for path, dirs, files in os.walk(args.folder):
+        file_paths.extend(os.path.join(path, f) for f in files if os.path.isfile(os.path.join(path, f)))
+    file_paths = sorted(file_paths)[:args.max_files]
+    if not file_paths:
+        print('No files found in {}'.format(args.folder))
+        sys.exit(1)
+
+    file_results, file_time = time_it(with_file, file_paths)
+    sniff_results, sniff_time = time_it(with_sniffing, file_paths)
+    batch_results, batch_time = time_it(get_mime_types, file_paths)
+    n_sniffed = sum(1 for file_path in file_paths if sniff_mime_type(file_path) is not None)
+
+    print('Files\t\t\t: {}'.format(len(file_paths)))
+    print('Known signatures\t: {} ({:.1%})'.format(n_sniffed, n_sniffed / len(file_paths)))
+    print('file (1 call per file)\t: {:.3f} s'.format(file_time))
+    print('get_mime_type()\t\t: {:.3f} s ({:.1f}x faster)'.format(sniff_time, file_time / max(sniff_time, 1e-9)))
+    print('get_mime_types()\t: {:.3f} s ({:.1f}x faster)'.format(batch_time, file_time / max(batch_time, 1e-9)))
+    mismatches = [(file_path, file_results[file_path], sniff_results[file_path]) for file_path in file_paths
+                  if file_results[file_path] != sniff_results[file_path]]
+    print('Mismatches with file\t: {}'.format(len(mismatches)))
+    for file_path, file_mime_type, sniffed_mime_type in mismatches:
+        print('  {}: file={} sniffed={}'.format(file_path, file_mime_type, sniffed_mime_type))
+    sys.exit(0)
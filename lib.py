@@ -6,9 +6,18 @@ A Python port of ebooks-managing shell scripts from https://github.com/na--/eboo
 # import PyPDF2
 import argparse
 import ast
+import bz2
+import collections
+from concurrent.futures import as_completed, FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
+import gzip
+import io
 import ipdb
+import itertools
+import json
 import logging
+import lzma
+import mimetypes
 import os
 from pathlib import Path
 import re
@@ -17,10 +26,22 @@ import shutil
 import string
 import subprocess
 import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+import zipfile
+import zlib
 
 
 import config
-from utils.path import file_exists
+from utils.cache import IsbnCache, MetadataCache, OcrCache
+from utils.ebookmeta import get_native_ebook_metadata
+from utils.metadata_index import MetadataIndex
+from utils.mime import sniff_mime_type
+from utils.path import file_exists, get_file_hash
+from utils.pdf import inspect_pdf
+from utils.scheduler import FetchScheduler, CANCELLED, EMPTY, FAILURE, SUCCESS
+from utils.text import iter_epub_text, iter_markup_text, iter_office_text, OFFICE_DOCUMENTS
 
 
 logger = logging.getLogger('{}.{}'.format(os.path.basename(os.path.dirname(__file__)), __name__))
@@ -32,16 +53,46 @@ RED = '\033[0;31m'
 BOLD = '\033[1m'
 NC = '\033[0m'
 
+# Resolution (in dpi) of the page images rendered for OCR
+OCR_DPI = 300
+# Page segmentation mode used by tesseract_wrapper()
+OCR_PSM = 12
+# Resolution (in dpi) of the grayscale page images rendered for the quick pass
+# of tesseract_isbn_wrapper()
+OCR_FAST_DPI = 150
+# Number of pages rendered to images by one call to ghostscript/ddjvu: the
+# pages are rendered batch by batch, as they are OCR-ed
+OCR_RENDER_BATCH_SIZE = 4
+# Minimum free space (in MiB) of /dev/shm for creating the scratch directories
+# there, e.g. a Docker container only has 64 MiB by default
+SHM_MIN_FREE_MIB = 256
+
+# Fast OCR profiles, selected through `ocr_command`: ocr_command -> ocr_command
+# of the full pass. The quick pass runs on low-resolution grayscale images and
+# the page is OCR-ed again with the full pass (at OCR_DPI) only if the quick
+# pass found ISBN-like tokens but no valid ISBN (e.g. a misread digit) or an
+# ISBN-10 that must be confirmed, see needs_full_ocr()
+FAST_OCR_PROFILES = {'tesseract_isbn_wrapper': 'tesseract_wrapper'}
+
 
 # OCR: converts image to text
 def tesseract_wrapper(input_file, output_file):
     # cmd = 'tesseract INPUT_FILE stdout --psm 12 > OUTPUT_FILE || exit 1
-    cmd = 'tesseract "{}" stdout --psm 12'.format(input_file)
+    cmd = 'tesseract "{}" stdout --psm {}'.format(input_file, OCR_PSM)
     args = shlex.split(cmd)
     result = subprocess.run(args, stdout=open(output_file, 'w'), stderr=subprocess.PIPE, encoding='utf-8', bufsize=4096)
     return convert_result_from_shell_cmd(result)
 
 
+# OCR: converts image to text but only recognizes the characters that can be
+# found in ISBNs (digits, 'X' and '-'), which is much faster than the full OCR
+def tesseract_isbn_wrapper(input_file, output_file):
+    args = ['tesseract', input_file, 'stdout', '--psm', str(OCR_PSM),
+            '-c', 'tessedit_char_whitelist=0123456789X-']
+    result = subprocess.run(args, stdout=open(output_file, 'w'), stderr=subprocess.PIPE, encoding='utf-8', bufsize=4096)
+    return convert_result_from_shell_cmd(result)
+
+
 # TODO: following variables should be checked first if they are set, if not
 # then set with the specified value, like it is done in bash: ${FOO:=val}
 # which means 'Set $FOO to val if not set'
@@ -187,7 +238,17 @@ def get_file_size(file_path, unit):
         return None
 
 
-def get_ebook_metadata(file_path):
+# Returns the calibre-style metadata of an ebook. The epub, fb2 and pdf files
+# are read natively, calibre's `ebook-meta` (and its slow start) is only used
+# for the other formats or if the native reader fails.
+def get_ebook_metadata(file_path, mime_type=None):
+    if mime_type is None:
+        mime_type = get_mime_type(file_path)
+    ebookmeta = get_native_ebook_metadata(file_path, mime_type)
+    if ebookmeta is not None:
+        logger.debug('Read the metadata of {} natively'.format(file_path))
+        result = subprocess.CompletedProcess(['get_native_ebook_metadata', file_path], 0, ebookmeta, '')
+        return convert_result_from_shell_cmd(result)
     # TODO: add `ebook-meta` in PATH, right now it is only working for mac
     cmd = '/Applications/calibre.app/Contents/MacOS/ebook-meta "{}"'.format(file_path)
     args = shlex.split(cmd)
@@ -226,6 +287,37 @@ def pdfinfo(file_path):
     return convert_result_from_shell_cmd(result)
 
 
+# Returns the structure of a pdf document (page count, page sizes, encryption
+# and damage flags) read natively, or None if the file can't be read
+def get_pdf_info(file_path):
+    try:
+        return inspect_pdf(file_path)
+    except OSError as e:
+        logger.debug('Could not inspect the pdf {}: {}'.format(file_path, e))
+        return None
+
+
+# Returns the number of pages of a pdf or djvu document, or None if it can't
+# be found
+def get_page_count(file_path, mime_type, pdf_info=None):
+    pages = None
+    if mime_type == 'application/pdf':
+        # The native pdf inspector avoids spawning `mdls` or `pdfinfo`
+        if pdf_info is None:
+            pdf_info = get_pdf_info(file_path)
+        if pdf_info is not None and pdf_info.page_count is not None:
+            pages = pdf_info.page_count
+        elif command_exists('mdls'):
+            pages = get_pages_in_pdf(file_path).stdout
+        elif command_exists('pdfinfo'):
+            match = re.search(r'^Pages:\s+([0-9]+)', str(pdfinfo(file_path).stdout), re.MULTILINE)
+            pages = int(match.group(1)) if match else None
+    # TODO: not need to specify the full path to djvused if you set correctly the right env. variables
+    elif mime_type.startswith('image/vnd.djvu') and command_exists('/Applications/DjView.app/Contents/bin/djvused'):
+        pages = get_pages_in_djvu(file_path).stdout
+    return pages if isinstance(pages, int) else None
+
+
 def convert_result_from_shell_cmd(old_result):
     class Result:
         def __init__(self):
@@ -279,9 +371,9 @@ def search_meta_val(ebookmeta, key):
     val = None
     lines = ebookmeta.splitlines()
     for line in lines:
-        match = re.match('^({})( +):'.format(key), ebookmeta)
+        match = re.match(r'^({})( +): ?'.format(re.escape(key)), line)
         if match:
-            val = line.split(match.end - 1)[-1]
+            val = line[match.end():].strip()
             return val
     return val
 
@@ -290,11 +382,27 @@ def search_meta_val(ebookmeta, key):
 # `lenr` (or $TOKEN_MIN_LENGTH), converts them to lowercase, optionally
 # deduplicates them (if `dedup` is true or not specified) and finally concatenates
 # them with `separator` (or ' ' if not specified)
+# The tokens matching `tokens_to_ignore` (where ${RE_YEAR} is replaced by
+# the regex of the years, see get_re_year()) are removed
 # ref.: https://bit.ly/2ImdPHW
 def tokenize(text, separator=' ', dedup=True, lenr=None):
     if lenr is None:
-        token_min_length = config.config_dict['general-options']['token_min_length']
+        lenr = config.config_dict['general-options']['token_min_length']
     tokens_to_ignore = config.config_dict['general-options']['tokens_to_ignore']
+    tokens_to_ignore = str(tokens_to_ignore or '').replace('${RE_YEAR}', get_re_year())
+    ignore_regex = re.compile('^({})$'.format(tokens_to_ignore), re.I) if tokens_to_ignore else None
+    tokens = []
+    seen = set()
+    # Equivalent to `grep -oE '[[:alpha:]]+|[[:digit:]]+'`
+    for token in re.findall(r'[^\W\d_]+|\d+', text.lower()):
+        if len(token) < lenr or (ignore_regex and ignore_regex.match(token)):
+            continue
+        if dedup:
+            if token in seen:
+                continue
+            seen.add(token)
+        tokens.append(token)
+    return separator.join(tokens)
 
 
 # TODO: place it (and other path-related functions) in the path module
@@ -332,13 +440,93 @@ def is_file_empty(file_path):
         return False
 
 
+class FileProbe:
+    """
+    Facts about a file that several steps of its organization need: MIME type,
+    size, calibre metadata (`ebook-meta`), pdf structure, `pdfinfo` output,
+    number of pages and content hash. Each of them is computed lazily the first time it is
+    needed and memoized, so that the same probe passed to
+    check_file_for_corruption(), search_file_for_isbns(), is_pamphlet(), ...
+    runs every tool at most once per file.
+
+    `saved_calls` counts, by probe, the calls that were avoided thanks to the
+    memoization and `total_saved_calls` sums them over all the files.
+    """
+    total_saved_calls = collections.Counter()
+    _total_lock = threading.Lock()
+
+    def __init__(self, file_path, mime_type=None):
+        self.file_path = file_path
+        self.values = {}
+        if mime_type is not None:
+            self.values['mime_type'] = mime_type
+        self.saved_calls = collections.Counter()
+
+    def __repr__(self):
+        return 'FileProbe({!r})'.format(self.file_path)
+
+    def _get(self, name, func):
+        if name in self.values:
+            self.saved_calls[name] += 1
+            with FileProbe._total_lock:
+                FileProbe.total_saved_calls[name] += 1
+        else:
+            self.values[name] = func()
+        return self.values[name]
+
+    def get_mime_type(self):
+        return self._get('mime_type', lambda: get_mime_type(self.file_path))
+
+    def stat(self):
+        return self._get('stat', lambda: os.stat(self.file_path))
+
+    def get_file_size(self, unit):
+        size = self.stat().st_size
+        if unit[1] == 'i':
+            return convert_bytes_binary(size, unit=unit)
+        return convert_bytes_decimal(size, unit=unit)
+
+    def get_ebook_metadata(self):
+        return self._get('ebook_metadata', lambda: get_ebook_metadata(self.file_path, self.get_mime_type()))
+
+    def pdfinfo(self):
+        return self._get('pdfinfo', lambda: pdfinfo(self.file_path))
+
+    def get_pdf_info(self):
+        return self._get('pdf_info', lambda: get_pdf_info(self.file_path))
+
+    def get_page_count(self):
+        def page_count():
+            if self.get_mime_type() != 'application/pdf':
+                return get_page_count(self.file_path, self.get_mime_type())
+            # Reuse the output of `pdfinfo` if it was already run, e.g. by
+            # check_file_for_corruption() on a damaged pdf
+            if 'pdfinfo' in self.values:
+                match = re.search(r'^Pages:\s+([0-9]+)', str(self.pdfinfo().stdout), re.MULTILINE)
+                if match:
+                    return int(match.group(1))
+            return get_page_count(self.file_path, self.get_mime_type(), self.get_pdf_info())
+        return self._get('page_count', page_count)
+
+    def get_file_hash(self):
+        return self._get('file_hash', lambda: get_file_hash(self.file_path))
+
+
+def log_probe_stats():
+    if FileProbe.total_saved_calls:
+        logger.info('Calls saved by the file probes: {}'.format(', '.join(
+            '{} {}'.format(count, name) for name, count in sorted(FileProbe.total_saved_calls.items()))))
+
+
 # Checks the supplied file for different kinds of corruption:
 #  - If it's zero-sized or contains only \0
 #  - If it has a pdf extension but different mime type
 #  - If it's a pdf and `pdfinfo` returns an error
 #  - If it has an archive extension but `7z t` returns an error
 # ref.: https://bit.ly/2JLpqgf
-def check_file_for_corruption(file_path):
+def check_file_for_corruption(file_path, probe=None):
+    if probe is None:
+        probe = FileProbe(file_path)
     file_err = ''
     logger.info('Testing {} for corruption...'.format(file_path))
 
@@ -351,7 +539,7 @@ def check_file_for_corruption(file_path):
         return file_err
 
     ext = Path(file_path).suffix[1:]  # Remove the dot from extension
-    mime_type = get_mime_type(file_path)
+    mime_type = probe.get_mime_type()
 
     if mime_type == 'application/octet-stream' and re.match('^(pdf|djv|djvu)$', mime_type):
         file_err = 'The file has a {} extension but {} MIME type!'.format(ext, mime_type)
@@ -359,12 +547,24 @@ def check_file_for_corruption(file_path):
         return file_err
     elif mime_type == 'application/pdf':
         logger.info('Checking pdf file for integrity...')
-        if not command_exists('pdfinfo'):
+        # A pdf with sound cross-reference data and page tree is checked
+        # natively. `pdfinfo` is only run on the damaged ones since it might
+        # still be able to repair them.
+        pdf_info = probe.get_pdf_info()
+        if pdf_info is not None and not pdf_info.damaged and pdf_info.page_count is not None:
+            logger.info('pdf structure is OK')
+            logger.debug(pdf_info)
+            if pdf_info.page_sizes and pdf_info.page_sizes[0] == (0, 0):
+                logger.info('pdf is corrupt anyway, page size property is empty!')
+                file_err = 'pdf can be parsed, but page size is 0 x 0 pts!'
+                logger.debug(file_err)
+                return file_err
+        elif not command_exists('pdfinfo'):
             file_err = 'pdfinfo does not exist, could not check if pdf is OK'
             logger.debug(file_err)
             return file_err
         else:
-            pdfinfo_output = pdfinfo(file_path)
+            pdfinfo_output = probe.pdfinfo()
             if pdfinfo_output.stderr:
                 logger.info('pdfinfo returned an error!')
                 logger.debug(pdfinfo_output.stderr)
@@ -398,42 +598,107 @@ def check_file_for_corruption(file_path):
     return file_err
 
 
+# Returns a new temporary directory for scratch files such as the page images
+# rendered for OCR. If possible, it is created on a tmpfs (/dev/shm on Linux)
+# so that the images are never written to disk, unless the tmpfs is almost full
+def make_scratch_dir():
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        stat = os.statvfs('/dev/shm')
+        if stat.f_bavail * stat.f_frsize >= SHM_MIN_FREE_MIB * 1024 * 1024:
+            return tempfile.mkdtemp(dir='/dev/shm')
+        logger.debug('Less than {} MiB free in /dev/shm, using the temporary directory'.format(SHM_MIN_FREE_MIB))
+    return tempfile.mkdtemp()
+
+
+# Formats a sorted list of pages as a page list for `gs -sPageList` or
+# `ddjvu -page`, e.g. [1, 2, 3, 7, 9, 10] --> '1-3,7,9-10'
+def format_page_list(pages):
+    ranges = []
+    for page in pages:
+        if ranges and ranges[-1][1] == page - 1:
+            ranges[-1][1] = page
+        else:
+            ranges.append([page, page])
+    return ','.join(str(a) if a == b else '{}-{}'.format(a, b) for a, b in ranges)
+
+
+# Maps the page images rendered in `output_dir` as 'page-%d.ext' to their
+# pages. Depending on the tool, %d is either the page number or the index of
+# the page among the rendered pages
+def get_rendered_pages(pages, output_dir):
+    rendered = {}
+    for filename in os.listdir(output_dir):
+        match = re.match(r'^page-([0-9]+)\.', filename)
+        if match:
+            rendered[int(match.group(1))] = os.path.join(output_dir, filename)
+    if set(rendered) == set(pages):
+        return rendered
+    if set(rendered) == set(range(1, len(pages) + 1)):
+        return {page: rendered[i] for i, page in enumerate(pages, start=1)}
+    logger.info('Unexpected rendered pages in {}: {}'.format(output_dir, sorted(rendered)))
+    return {page: rendered[page] for page in pages if page in rendered}
+
+
 # OCR on a pdf, djvu document and image to extract ISBN
 # NOTE: If pdf or djvu document: first needs to be converted to image and then OCR
-def ocr_file(input_file, output_file, mime_type):
-    def convert_pdf_page(page, input_file, output_file):
+def ocr_file(input_file, output_file, mime_type, probe=None):
+    if probe is None:
+        probe = FileProbe(input_file, mime_type)
+
+    def convert_pdf_page(page, input_file, output_file, dpi=OCR_DPI, gray=False):
         # Converts pdf to png image
-        cmd = 'gs -dSAFER -q -r300 -dFirstPage={} -dLastPage={} -dNOPAUSE ' \
-              '-dINTERPOLATE -sDEVICE=png16m -sOutputFile="{}" "{}" -c quit'.format(page, page, output_file, input_file)
+        cmd = 'gs -dSAFER -q -r{} -dFirstPage={} -dLastPage={} -dNOPAUSE ' \
+              '-dINTERPOLATE -sDEVICE={} -sOutputFile="{}" "{}" -c quit'.format(
+                dpi, page, page, 'pnggray' if gray else 'png16m', output_file, input_file)
         args = shlex.split(cmd)
         result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         return convert_result_from_shell_cmd(result)
 
-    # Converts djvu to tif image
-    def convert_djvu_page(page, input_file, output_file):
+    # Converts all the pages to png images in one `gs` call; thus ghostscript's
+    # startup cost is paid once per document instead of once per page
+    def render_pdf_pages(pages, input_file, output_dir, dpi=OCR_DPI, gray=False):
+        args = ['gs', '-dSAFER', '-q', '-r{}'.format(dpi), '-sPageList={}'.format(format_page_list(pages)),
+                '-dNOPAUSE', '-dINTERPOLATE', '-sDEVICE={}'.format('pnggray' if gray else 'png16m'),
+                '-sOutputFile={}'.format(os.path.join(output_dir, 'page-%d.png')), input_file, '-c', 'quit']
+        result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return convert_result_from_shell_cmd(result)
+
+    # Converts djvu to tif image (pgm if grayscale)
+    def convert_djvu_page(page, input_file, output_file, dpi=OCR_DPI, gray=False):
         # TODO: not need to specify the full path to djvused if you set correctly the right env. variables
-        cmd = '/Applications/DjView.app/Contents/bin/ddjvu -page={} ' \
-              '-format=tif {} {}'.format(page, input_file, output_file)
+        cmd = '/Applications/DjView.app/Contents/bin/ddjvu -page={} -scale={} ' \
+              '-format={} {} {}'.format(page, dpi, 'pgm' if gray else 'tif', input_file, output_file)
         args = shlex.split(cmd)
         result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         return convert_result_from_shell_cmd(result)
 
+    # Converts all the pages to tif images in one `ddjvu` call
+    def render_djvu_pages(pages, input_file, output_dir, dpi=OCR_DPI, gray=False):
+        # TODO: not need to specify the full path to djvused if you set correctly the right env. variables
+        image_format = 'pgm' if gray else 'tif'
+        args = ['/Applications/DjView.app/Contents/bin/ddjvu', '-format={}'.format(image_format), '-eachpage',
+                '-scale={}'.format(dpi), '-page={}'.format(format_page_list(pages)), input_file,
+                os.path.join(output_dir, 'page-%d.{}'.format(image_format))]
+        result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return convert_result_from_shell_cmd(result)
+
     num_pages = 1
     page_convert_cmd = ''
+    pages_render_cmd = ''
     if mime_type.startswith('application/pdf'):
         # TODO: they are using the `pdfinfo` command but it might not be present;
         # in check_file_for_corruption(), they are testing if this command exists
         # but not in ocr_file()
-        result = get_pages_in_pdf(input_file)
-        num_pages = result.stdout
-        logger.debug('Result of {} on {}:\n{}'.format(get_pages_in_pdf.__repr__(), input_file, result))
-        logger.debug('{}'.format(result))
+        num_pages = probe.get_page_count()
+        logger.debug('Number of pages of {}: {}'.format(input_file, num_pages))
         page_convert_cmd = convert_pdf_page
+        pages_render_cmd = render_pdf_pages
     elif mime_type.startswith('image/vnd.djvu'):
         result = get_pages_in_djvu(input_file)
         num_pages = result.stdout
         logger.debug('Result of {} on {}:\n{}'.format(get_pages_in_djvu.__repr__(), input_file, result))
         page_convert_cmd = convert_djvu_page
+        pages_render_cmd = render_djvu_pages
     elif mime_type.startswith('image/'):
         # TODO: in their code, they don't initialize num_pages
         logger.info('Running OCR on file %s and with mime type %s...'
@@ -443,6 +708,16 @@ def ocr_file(input_file, output_file, mime_type):
         if ocr_command in globals():
             result = eval('{}("{}", "{}")'.format(ocr_command, input_file, output_file))
             logger.debug('Result of {}:\n{}'.format(ocr_command.__repr__(), result))
+            if ocr_command in FAST_OCR_PROFILES:
+                with open(output_file, 'r') as f:
+                    data = f.read()
+                if needs_full_ocr(data):
+                    result = globals()[FAST_OCR_PROFILES[ocr_command]](input_file, output_file)
+                    logger.debug('Result of {}:\n{}'.format(FAST_OCR_PROFILES[ocr_command].__repr__(), result))
+                    with open(output_file, 'r') as f:
+                        full_data = f.read()
+                    with open(output_file, 'w') as f:
+                        f.write(merge_fast_ocr_text(data, full_data if result.returncode == 0 else ''))
         else:
             logger.debug("Function {} doesn't exit. Ending ocr.".format(ocr_command))
             return 1
@@ -460,40 +735,165 @@ def ocr_file(input_file, output_file, mime_type):
     logger.info('Running OCR on file %s %s pages and with mime type %s...'
                 % (input_file, num_pages, mime_type))
 
+    if num_pages is None:
+        logger.info('Could not get the number of pages of {}'.format(input_file))
+        return 1
+
     ocr_only_first_last_pages = config.config_dict['general-options']['ocr_only_first_last_pages']
-    ocr_first_pages, ocr_last_pages = [int(i) for i in ocr_only_first_last_pages.split(',')]
     # Pre-compute the list of pages to process based on ocr_first_pages and ocr_last_pages
     if ocr_only_first_last_pages:
-        pages_to_process = [i for i in range(1, ocr_first_pages+1)]
-        pages_to_process.extend([i for i in range(num_pages+1-ocr_last_pages, num_pages+1)])
+        ocr_first_pages, ocr_last_pages = [int(i) for i in ocr_only_first_last_pages.split(',')]
+        pages_to_process = [i for i in range(1, min(ocr_first_pages, num_pages)+1)]
+        # NOTE: short documents would have pages both in the first and last pages
+        pages_to_process.extend([i for i in range(max(num_pages+1-ocr_last_pages, ocr_first_pages+1), num_pages+1)])
     else:
         # `ocr_only_first_last_pages` is False
         logger.debug('ocr_only_first_last_pages is False')
-        pages_to_process = [i for i in range(0, num_pages)]
+        pages_to_process = [i for i in range(1, num_pages+1)]
     logger.debug('Pages to process: {}'.format(pages_to_process))
 
-    text = ''
-    for page in pages_to_process:
+    # With a fast OCR profile, the pages are first rendered at a low resolution
+    # in grayscale
+    full_ocr_command = FAST_OCR_PROFILES.get(ocr_command)
+    if full_ocr_command is not None:
+        render_options = {'dpi': OCR_FAST_DPI, 'gray': True}
+    else:
+        render_options = {'dpi': OCR_DPI, 'gray': False}
+
+    # The OCR-ed pages are cached by document content, page and OCR settings
+    ocr_cache = get_ocr_cache()
+    file_hash = None
+    cached_texts = {}
+    ocr_settings = '{}:dpi={}:psm={}'.format(ocr_command, render_options['dpi'], OCR_PSM)
+    if ocr_cache is not None:
+        file_hash = probe.get_file_hash()
+        for page in pages_to_process:
+            text = ocr_cache.get(file_hash, page, ocr_settings)
+            if text is not None:
+                cached_texts[page] = text
+        logger.info('{} of {} pages found in the OCR cache'.format(len(cached_texts), len(pages_to_process)))
+    pages_to_render = sorted(page for page in pages_to_process if page not in cached_texts)
+
+    # The pages are rendered to images in a scratch directory (on tmpfs if
+    # possible) by batches of OCR_RENDER_BATCH_SIZE pages, a batch being only
+    # rendered when one of its pages is about to be OCR-ed: the pages after the
+    # one with an ISBN are never rendered and the scratch directory only holds
+    # the images of a few batches at a time. Pages that could not be rendered
+    # this way are converted one by one in run_ocr_command()
+    scratch_dir = make_scratch_dir()
+    render_batches = [pages_to_render[i:i + OCR_RENDER_BATCH_SIZE]
+                      for i in range(0, len(pages_to_render), OCR_RENDER_BATCH_SIZE)]
+    batch_by_page = {page: i for i, batch in enumerate(render_batches) for page in batch}
+    rendered_batches = {}
+    render_locks = [threading.Lock() for _ in render_batches]
+
+    def get_page_image(page):
+        i = batch_by_page[page]
+        with render_locks[i]:
+            if i not in rendered_batches:
+                batch_dir = tempfile.mkdtemp(dir=scratch_dir)
+                start = time.time()
+                result = pages_render_cmd(render_batches[i], input_file, batch_dir, **render_options)
+                logger.debug('Result of {}:\n{}'.format(pages_render_cmd.__repr__(), result))
+                rendered_batches[i] = get_rendered_pages(render_batches[i], batch_dir)
+                logger.info('Rendered {} of the pages {} in {:.2f} seconds'.format(
+                    len(rendered_batches[i]), format_page_list(render_batches[i]), time.time() - start))
+            # The image is removed once OCR-ed
+            return rendered_batches[i].pop(page, None)
+
+    def ocr_page(page):
+        if page in cached_texts:
+            return cached_texts[page]
+        if ocr_cache is None:
+            return ocr_page_uncached(page)
+        if not ocr_cache.claim(file_hash, page, ocr_settings):
+            logger.info('Page {} is being OCR-ed by another worker, waiting for its result...'.format(page))
+            text = ocr_cache.wait(file_hash, page, ocr_settings)
+            if text is not None:
+                return text
+            ocr_cache.claim(file_hash, page, ocr_settings)
+        try:
+            text = ocr_page_uncached(page)
+            # A failed OCR is not cached so that it is retried next time
+            if text is not None:
+                ocr_cache.put(file_hash, page, ocr_settings, text)
+            return text
+        finally:
+            ocr_cache.release(file_hash, page, ocr_settings)
+
+    def ocr_page_uncached(page):
+        start = time.time()
+        data = run_ocr_command(page, ocr_command, get_page_image(page), render_options)
+        # Quick pass of a fast OCR profile: only OCR the page again (at full
+        # resolution) if it seems to contain a misread ISBN or an ISBN-10 to
+        # confirm
+        if full_ocr_command is not None and data and needs_full_ocr(data):
+            logger.info('Page {} contains ISBN-like tokens or ISBN-10s, '
+                        'running the full OCR with {}'.format(page, full_ocr_command))
+            full_data = run_ocr_command(page, full_ocr_command, None, {'dpi': OCR_DPI, 'gray': False})
+            data = merge_fast_ocr_text(data, full_data or '')
+        logger.info('OCR of page {} of {} took {:.2f} seconds'.format(page, input_file, time.time() - start))
+        return data
+
+    # Returns the OCR-ed text of the page or None if the page could not be
+    # converted to an image or OCR-ed
+    def run_ocr_command(page, command, tmp_file, page_convert_options):
         # Make temporary files
-        tmp_file = tempfile.mkstemp()[1]
-        tmp_file_txt = tempfile.mkstemp(suffix='.txt')[1]
-        logger.info('Running OCR of page %s, using tmp files %s and %s ...'
-                    % (page, tmp_file, tmp_file_txt))
-        # doc(pdf, djvu) --> image(png, tiff)
-        result = page_convert_cmd(page, input_file, tmp_file)
-        logger.debug('Result of {}:\n{}'.format(page_convert_cmd.__repr__(), result))
-        # image --> text
-        result = eval('{}("{}", "{}")'.format(ocr_command, tmp_file, tmp_file_txt))
-        logger.debug('Result of {}:\n{}'.format(ocr_command.__repr__(), result))
-        with open(tmp_file_txt, 'r') as f:
-            data = f.read()
-            # TODO: remove this debug eventually; too much data printed
-            logger.debug(data)
-        text += data
+        tmp_file_txt = tempfile.mkstemp(suffix='.txt', dir=scratch_dir)[1]
+        data = None
+        if tmp_file is None:
+            tmp_file = tempfile.mkstemp(dir=scratch_dir)[1]
+            # doc(pdf, djvu) --> image(png, tiff)
+            result = page_convert_cmd(page, input_file, tmp_file, **page_convert_options)
+            logger.debug('Result of {}:\n{}'.format(page_convert_cmd.__repr__(), result))
+            if result.returncode != 0:
+                logger.info('Could not convert page {} of {}: {}'.format(page, input_file, result.stderr))
+                command = None
+        if command is not None:
+            logger.info('Running OCR of page %s, using tmp files %s and %s ...'
+                        % (page, tmp_file, tmp_file_txt))
+            # image --> text
+            result = globals()[command](tmp_file, tmp_file_txt)
+            logger.debug('Result of {}:\n{}'.format(command.__repr__(), result))
+            if result.returncode == 0:
+                with open(tmp_file_txt, 'r') as f:
+                    data = f.read()
+                    # TODO: remove this debug eventually; too much data printed
+                    logger.debug(data)
+            else:
+                logger.info('OCR of page {} of {} failed: {}'.format(page, input_file, result.stderr))
         # Remove temporary files
         logger.info('Cleaning up tmp files %s and %s' % (tmp_file, tmp_file_txt))
         remove_file(tmp_file)
         remove_file(tmp_file_txt)
+        return data
+
+    # The pages are OCR-ed by a pool of `ocr_jobs` threads (ghostscript and
+    # tesseract run as external processes) and the OCR stops as soon as a page
+    # contains a valid ISBN
+    ocr_jobs = max(1, config.config_dict['general-options']['ocr_jobs'])
+    texts = {}
+    try:
+        with ThreadPoolExecutor(max_workers=ocr_jobs) as executor:
+            futures = {executor.submit(ocr_page, page): page for page in pages_to_process}
+            for future in as_completed(futures):
+                page = futures[future]
+                texts[page] = future.result()
+                if texts[page] and find_isbns(texts[page]):
+                    logger.info('Page {} contains ISBNs, cancelling the OCR of the remaining pages'.format(page))
+                    for f in futures:
+                        f.cancel()
+                    break
+        # Get the pages that were being OCR-ed when the OCR was stopped
+        for future, page in futures.items():
+            if page not in texts and future.done() and not future.cancelled() and future.exception() is None:
+                texts[page] = future.result()
+    finally:
+        # Remove the images of the cancelled pages, also on errors since the
+        # scratch directory might be in RAM
+        remove_tree(scratch_dir)
+    # Reassemble the pages in their original order
+    text = ''.join(texts[page] for page in pages_to_process if texts.get(page))
 
     # Everything on the stdout must be copied to the output file
     logger.info('Writing the reordered text')
@@ -516,15 +916,18 @@ def is_isbn_valid(isbn):
     # Case 1: ISBN-10
     if len(isbn) == 10:
         for i in range(len(isbn)):
-            number = int(isbn[i])
             if i == 9 and isbn[i] == 'X':
                 number = 10
+            elif isbn[i].isdigit():
+                number = int(isbn[i])
+            else:
+                return False
             sum += (number * (10 - i))
         if sum % 11 == 0:
             return True
     # Case 2: ISBN-13
     elif len(isbn) == 13:
-        if isbn[0:3] in ['978', '979']:
+        if isbn[0:3] in ['978', '979'] and isbn.isdigit():
             for i in range(0, len(isbn), 2):
                 sum += int(isbn[i])
             for i in range(1, len(isbn), 2):
@@ -534,6 +937,23 @@ def is_isbn_valid(isbn):
     return False
 
 
+# Returns the ISBN-13 form of a valid ISBN-10 or ISBN-13, without dashes, so that
+# the two forms of the same ISBN are the same key (e.g. in the metadata cache)
+def get_canonical_isbn(isbn):
+    isbn = ''.join(isbn.split()).replace('-', '').upper()
+    if len(isbn) != 10:
+        return isbn
+    isbn = '978' + isbn[:9]
+    check_digit = (10 - sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(isbn)) % 10) % 10
+    return isbn + str(check_digit)
+
+
+# Remove everything except numbers [0-9], 'x', and 'X'
+# NOTE: equivalent to UNIX command `tr -c -d '0-9xX'`
+# TODO: they don't remove \n in their code
+_ISBN_DEL_TAB = str.maketrans('', '', string.printable[10:].replace('x', '').replace('X', ''))
+
+
 # Searches the input string for ISBN-like sequences and removes duplicates and
 # finally validates them using is_isbn_valid() and returns them separated by
 # `isbn_ret_separator`
@@ -544,14 +964,7 @@ def find_isbns(input_str):
     # ref.: https://bit.ly/2HUbnIs
     matches = re.finditer(config.config_dict['general-options']['isbn_regex'], input_str)
     for i, match in enumerate(matches):
-        match = match.group()
-        # Remove everything except numbers [0-9], 'x', and 'X'
-        # NOTE: equivalent to UNIX command `tr -c -d '0-9xX'`
-        # TODO 1: they don't remove \n in their code
-        # TODO 2: put the following in a function
-        del_tab = string.printable[10:].replace('x', '').replace('X', '')
-        tran_tab = str.maketrans('', '', del_tab)
-        match = match.translate(tran_tab)
+        match = match.group().translate(_ISBN_DEL_TAB)
         # Only keep unique ISBNs
         if match not in isbns:
             # Validate ISBN
@@ -560,8 +973,119 @@ def find_isbns(input_str):
     return config.config_dict['find-isbns']['isbn_ret_separator'].join(isbns)
 
 
+# Returns the ISBN-like sequences of the input string that are not valid ISBNs,
+# e.g. an ISBN with a digit misread by the OCR
+def find_isbn_like_tokens(input_str):
+    tokens = []
+    for match in re.finditer(config.config_dict['general-options']['isbn_regex'], input_str):
+        match = match.group().translate(_ISBN_DEL_TAB)
+        if match not in tokens and not is_isbn_valid(match):
+            tokens.append(match)
+    return tokens
+
+
+# The quick pass of a fast OCR profile only recognizes the characters of
+# ISBNs, thus letters are read as digits and a word can form a valid ISBN-10 by
+# chance (its check digit being right once in eleven). The page is OCR-ed again
+# by the full pass if the quick pass found such ISBN-10s, or ISBN-like tokens
+# but no valid ISBN
+def needs_full_ocr(fast_text):
+    isbns = [isbn for isbn in find_isbns(fast_text).split(
+        config.config_dict['find-isbns']['isbn_ret_separator']) if isbn]
+    if isbns:
+        return any(len(isbn) == 10 for isbn in isbns)
+    return bool(find_isbn_like_tokens(fast_text))
+
+
+# Returns the text of the full pass followed by the ISBNs of the quick pass
+# that it doesn't contain but that are kept: the ISBN-13s, and the ISBN-10s if
+# the full pass found an ISBN label on the page (e.g. it misread a digit of
+# the ISBN)
+def merge_fast_ocr_text(fast_text, full_text):
+    separator = config.config_dict['find-isbns']['isbn_ret_separator']
+    full_isbns = find_isbns(full_text).split(separator)
+    has_label = re.search('ISBN', full_text, re.IGNORECASE) is not None
+    kept = [isbn for isbn in find_isbns(fast_text).split(separator)
+            if isbn and isbn not in full_isbns and (len(isbn) == 13 or has_label)]
+    if kept and full_text and not full_text.endswith('\n'):
+        full_text += '\n'
+    return full_text + ''.join('{}\n'.format(isbn) for isbn in kept)
+
+
+class IsbnScanner:
+    """
+    Incremental version of find_isbns(): the text is fed chunk by chunk (e.g.
+    as it is output by `pdftotext`) and only the last few characters are kept
+    between chunks, in case an ISBN is split over two chunks. Thus, the memory
+    used doesn't depend on the size of the text.
+
+    If `stop_at_first` is True, feed() returns True as soon as a chunk contains
+    valid ISBNs, so that the caller can stop producing text.
+    """
+    # Number of characters kept between chunks; it must be larger than the
+    # longest ISBN-like match (13 digits with dashes, e.g. -9-7-8-...)
+    overlap = 64
+
+    def __init__(self, stop_at_first=False):
+        self.stop_at_first = stop_at_first
+        self.isbns = []
+        # Whether alphanumeric characters were found in the text
+        self.has_text = False
+        self.chars_scanned = 0
+        self._regex = re.compile(config.config_dict['general-options']['isbn_regex'])
+        # Unscanned end of the previous chunks, preceded by one character of
+        # context for the lookbehind of the ISBN regex
+        self._tail = ''
+        self._pos = 0
+
+    # Scans `data` from `pos` and returns the position where the next scan
+    # should start: matches must end before `limit` since they might continue
+    # in the next chunk otherwise
+    def _scan(self, data, pos, limit):
+        for match in self._regex.finditer(data, pos):
+            if match.end() > limit:
+                # It will be scanned again with the next chunk
+                return match.start()
+            isbn = match.group().translate(_ISBN_DEL_TAB)
+            if isbn not in self.isbns and is_isbn_valid(isbn):
+                self.isbns.append(isbn)
+        return max(pos, limit)
+
+    def feed(self, text):
+        """
+        :return: True if the scanning can stop, i.e. `stop_at_first` is True
+                 and ISBNs were found
+        """
+        self.chars_scanned += len(text)
+        if not self.has_text and re.search('[A-Za-z0-9]', text):
+            self.has_text = True
+        data = self._tail + text
+        cut = self._scan(data, self._pos, len(data) - self.overlap)
+        context = min(cut, 1)
+        self._tail = data[cut - context:]
+        self._pos = context
+        return self.stop_at_first and len(self.isbns) > 0
+
+    def close(self):
+        # Scan what is left of the text
+        self._scan(self._tail, self._pos, len(self._tail))
+        self._tail = ''
+        self._pos = 0
+
+    def get_isbns(self):
+        return config.config_dict['find-isbns']['isbn_ret_separator'].join(self.isbns)
+
+
+# The MIME type is sniffed in-process from the magic bytes of the file and
+# `file` is only called for the unknown signatures
 def get_mime_type(file_path):
-    # TODO: get MIME type with a python package, see the magic package
+    mime_type = sniff_mime_type(file_path)
+    if mime_type is not None:
+        return mime_type
+    return get_mime_type_with_file(file_path)
+
+
+def get_mime_type_with_file(file_path):
     # ref.: https://stackoverflow.com/a/2753385
     cmd = 'file --brief --mime-type "{}"'.format(file_path)
     args = shlex.split(cmd)
@@ -569,6 +1093,33 @@ def get_mime_type(file_path):
     return result.stdout.decode('UTF-8').split()[0]
 
 
+# Returns a dict mapping the given files to their MIME types. The files with
+# unknown signatures go through a single `file -f -` call instead of one `file`
+# call per file
+def get_mime_types(file_paths):
+    mime_types = {}
+    unknown_file_paths = []
+    for file_path in file_paths:
+        mime_type = sniff_mime_type(file_path)
+        if mime_type is not None:
+            mime_types[file_path] = mime_type
+        elif '\n' in file_path:
+            # `file -f` reads one file name per line
+            mime_types[file_path] = get_mime_type_with_file(file_path)
+        else:
+            unknown_file_paths.append(file_path)
+    if unknown_file_paths:
+        args = ['file', '--brief', '--mime-type', '-f', '-']
+        result = subprocess.run(args, input='\n'.join(unknown_file_paths) + '\n',
+                                stdout=subprocess.PIPE, encoding='utf-8')
+        for file_path, mime_type in zip(unknown_file_paths, result.stdout.splitlines()):
+            mime_types[file_path] = mime_type.strip()
+        for file_path in unknown_file_paths:
+            if file_path not in mime_types:
+                mime_types[file_path] = get_mime_type_with_file(file_path)
+    return mime_types
+
+
 def extract_archive(input_file, output_file):
     cmd = '7z x -o"{}" {}'.format(output_file, input_file)
     args = shlex.split(cmd)
@@ -576,6 +1127,22 @@ def extract_archive(input_file, output_file):
     return convert_result_from_shell_cmd(result)
 
 
+# Lists the members of an archive with their technical information (path,
+# size, attributes, ...), one block of `Key = value` lines per member
+def list_archive(file_path):
+    args = ['7z', 'l', '-slt', file_path]
+    result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return convert_result_from_shell_cmd(result)
+
+
+# Extracts a single archive member and returns the `7z` process whose stdout
+# is the content of the member. `-spd` disables the wildcard matching so that a
+# member name containing '*' or '?' only matches itself
+def open_archive_member(file_path, member_path):
+    args = ['7z', 'x', '-so', '-spd', file_path, '--', member_path]
+    return subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+
 def test_archive(file_path):
     cmd = '7z t "{}"'.format(file_path)
     args = shlex.split(cmd)
@@ -583,47 +1150,57 @@ def test_archive(file_path):
     return convert_result_from_shell_cmd(result)
 
 
-# If `isbn_grep_reorder_files` is enabled, reorders the specified file according
-# to the values of `isbn_grep_rf_scan_first` and `isbn_grep_rf_reverse_last`
+# If `isbn_grep_reorder_files` is enabled, yields the lines of the specified
+# file reordered according to the values of `isbn_grep_rf_scan_first` and
+# `isbn_grep_rf_reverse_last`: the first `isbn_grep_rf_scan_first` lines, then
+# the last `isbn_grep_rf_reverse_last` lines in reverse order and finally the
+# remaining lines in the middle.
+# NOTE: the file is read twice (once for the first and last parts, and once for
+# the middle part) so that it is never loaded whole in memory
+# `open_text` is the function that opens the file in text mode, e.g. to read a
+# compressed file (default: open())
 # ref.: https://bit.ly/2JuaEKw
-def reorder_file_content(file_path):
+def iter_reordered_lines(file_path, open_text=None):
+    if open_text is None:
+        def open_text():
+            return open(file_path, 'r')
     isbn_grep_rf_scan_first = config.config_dict['general-options']['isbn_grep_rf_scan_first']
     isbn_grep_rf_reverse_last = config.config_dict['general-options']['isbn_grep_rf_reverse_last']
-    if config.config_dict['general-options']['isbn_grep_reorder_files']:
-        logger.info('Reordering input file (if possible), read first '
-                    'isbn_grep_rf_scan_first lines normally, then read last '
-                    'isbn_grep_rf_reverse_last lines in reverse and then read '
-                    'the rest')
-        # TODO: try out with big file, more than 800 pages (approx. 73k lines)
-        # TODO: see alternatives for reading big file @ https://stackoverflow.com/a/4999741 (mmap),
-        # https://stackoverflow.com/a/24809292 (linecache), https://stackoverflow.com/a/42733235 (buffer)
-        with open(file_path, 'r') as f:
-            # Read whole file as a list of lines
-            # TODO: do we remove newlines? e.g. with f.read().rstrip("\n")
-            data = f.readlines()
-            # Read the first ISBN_GREP_RF_SCAN_FIRST lines of the file text
-            first_part = data[:isbn_grep_rf_scan_first]
-            del data[:isbn_grep_rf_scan_first]
-            # Read the last part and reverse it
-            last_part = data[-isbn_grep_rf_reverse_last:]
-            if last_part:
-                last_part.reverse()
-                del data[-isbn_grep_rf_reverse_last:]
-            # Read the middle part of the file text
-            middle_part = data
-            # TODO: try out with large lists, if efficiency is a concern then
-            # check itertools.chain
-            # ref.: https://stackoverflow.com/a/4344735
-            # Concatenate the three parts: first, last part (reversed), and middle part
-            data = first_part + last_part + middle_part
-            data = "".join(data)
-    else:
+    if not config.config_dict['general-options']['isbn_grep_reorder_files']:
         logger.info('Since isbn_grep_reorder_files is False, input file will not be reordered')
-        with open(file_path, 'r') as f:
-            # TODO: do we remove newlines? e.g. with f.read().rstrip("\n")
-            # Read whole content of file as a string
-            data = f.read()
-    return data
+        with open_text() as f:
+            yield from f
+        return
+    logger.info('Reordering input file (if possible), read first '
+                'isbn_grep_rf_scan_first lines normally, then read last '
+                'isbn_grep_rf_reverse_last lines in reverse and then read '
+                'the rest')
+    with open_text() as f:
+        # Read the first ISBN_GREP_RF_SCAN_FIRST lines of the file text
+        for line in itertools.islice(f, isbn_grep_rf_scan_first):
+            yield line
+        # Read the last part and reverse it
+        last_part = collections.deque(maxlen=isbn_grep_rf_reverse_last)
+        n_remaining_lines = 0
+        for line in f:
+            last_part.append(line)
+            n_remaining_lines += 1
+    yield from reversed(last_part)
+    # Read the middle part of the file text
+    n_middle_lines = n_remaining_lines - len(last_part)
+    if n_middle_lines > 0:
+        with open_text() as f:
+            yield from itertools.islice(f, isbn_grep_rf_scan_first, isbn_grep_rf_scan_first + n_middle_lines)
+
+
+# Searches the (reordered) content of a text file for ISBNs without loading the
+# file in memory. Returns the IsbnScanner used
+def scan_text_file_for_isbns(file_path, open_text=None):
+    scanner = IsbnScanner()
+    for line in iter_reordered_lines(file_path, open_text):
+        scanner.feed(line)
+    scanner.close()
+    return scanner
 
 
 # Checks if directory is empty
@@ -632,7 +1209,371 @@ def is_dir_empty(path):
     return next(os.scandir(path), None) is None
 
 
-def get_all_isbns_from_archive(file_path):
+# Extensions of the archive members that are scanned as text, e.g. the OPF
+# package document and the XHTML content of an epub or the XML of a docx/odt
+ARCHIVE_TEXT_MEMBER_EXTENSIONS = ('.opf', '.ncx', '.xhtml', '.html', '.htm', '.xml', '.txt', '.fb2')
+# Size above which a nested zip archive is spooled to a temporary file instead
+# of being kept in memory
+ARCHIVE_SPOOL_MAX_MEMORY = 16 * 1024 * 1024
+
+
+class ArchiveScanBudget:
+    """
+    Limits on the work done to scan an archive for ISBNs, shared by the
+    archive and all the archives nested in it (a zip of zips, a 7z of epubs,
+    ...): the nesting depth (`isbn_archive_max_depth`), the number of scanned
+    members (`isbn_archive_max_members`) and the number of extracted bytes
+    (`isbn_archive_max_extracted_mib`).
+
+    A budget is created for the top-level archive and each nested archive gets
+    a child budget with nested(). The limits that were hit are recorded by
+    archive and logged by report(), and a budget is marked as `truncated` if a
+    limit was hit while scanning it or one of its nested archives: finding no
+    ISBNs in it is then not a definitive result.
+
+    The root budget also holds the threads that the archive and all its nested
+    archives can use to scan their members concurrently (`isbn_archive_jobs`),
+    see map_archive_members().
+    """
+    def __init__(self, archive_path, parent=None):
+        self.archive_path = archive_path
+        self.parent = parent
+        self.truncated = False
+        if parent is not None:
+            self.root = parent.root
+            self.depth = parent.depth + 1
+            return
+        self.root = self
+        self.depth = 1
+        self.max_depth = config.config_dict['general-options']['isbn_archive_max_depth']
+        self.max_members = config.config_dict['general-options']['isbn_archive_max_members']
+        self.max_bytes = config.config_dict['general-options']['isbn_archive_max_extracted_mib'] * 1024 * 1024
+        self.lock = threading.Lock()
+        self.members = 0
+        self.bytes = 0
+        # Threads that can still be started, besides the calling thread
+        self.free_workers = max(1, config.config_dict['general-options']['isbn_archive_jobs']) - 1
+        # archive path -> names of the limits that were hit
+        self.limits_hit = collections.OrderedDict()
+
+    def nested(self, archive_path):
+        return ArchiveScanBudget(archive_path, parent=self)
+
+    def _hit(self, limit):
+        limits = self.root.limits_hit.setdefault(self.archive_path, [])
+        if limit not in limits:
+            limits.append(limit)
+        budget = self
+        while budget is not None:
+            budget.truncated = True
+            budget = budget.parent
+
+    def allows_depth(self):
+        if self.depth <= self.root.max_depth:
+            return True
+        with self.root.lock:
+            self._hit('depth')
+        return False
+
+    def take_member(self, size):
+        """
+        Accounts for a member of `size` bytes about to be scanned.
+
+        :return: False if scanning the member would exceed a limit
+        """
+        root = self.root
+        with root.lock:
+            if root.members >= root.max_members:
+                self._hit('members')
+                return False
+            if root.bytes + size > root.max_bytes:
+                self._hit('bytes')
+                return False
+            root.members += 1
+            root.bytes += size
+            return True
+
+    def take_bytes(self, size):
+        """
+        Accounts for `size` bytes decompressed outside of an archive member,
+        e.g. the contents of a gzipped file, see BudgetedStream.
+
+        :return: False if it would exceed the limit of extracted bytes
+        """
+        root = self.root
+        with root.lock:
+            if root.bytes + size > root.max_bytes:
+                self._hit('bytes')
+                return False
+            root.bytes += size
+            return True
+
+    def take_workers(self, count):
+        """
+        Takes up to `count` of the threads left to the archive scan, without
+        waiting for them to be released.
+
+        :return: number of threads taken, to be given back with
+                 release_workers()
+        """
+        root = self.root
+        with root.lock:
+            count = min(count, root.free_workers)
+            root.free_workers -= count
+            return count
+
+    def release_workers(self, count):
+        root = self.root
+        with root.lock:
+            root.free_workers += count
+
+    def report(self):
+        root = self.root
+        logger.info('Scanned {} members ({} bytes) of {}'.format(root.members, root.bytes, root.archive_path))
+        for archive_path, limits in root.limits_hit.items():
+            logger.info('Limits hit while scanning {}: {}'.format(archive_path, ', '.join(limits)))
+
+
+# Returns the MIME type of an archive member guessed from its name, or an
+# empty string if it is unknown (no `file` call since the member is not on disk)
+def guess_member_mime_type(member_name):
+    mime_type = mimetypes.guess_type(member_name)[0]
+    return mime_type if mime_type else ''
+
+
+# Adds the ISBNs (separated by `isbn_ret_separator`) to `all_isbns` if they are
+# not already there
+def add_isbns(all_isbns, isbns):
+    if isbns:
+        for isbn in isbns.split(config.config_dict['find-isbns']['isbn_ret_separator']):
+            if isbn not in all_isbns:
+                all_isbns.append(isbn)
+
+
+# Calls `func` on every archive member and returns the results (ISBNs) in the
+# order of the members. If `stop_at_first` is True, the results stop at the
+# first member with ISBNs and the members not started yet are cancelled.
+# The members are scanned concurrently by the threads left in the budget of
+# the top-level archive (`isbn_archive_jobs` in total, whatever the nesting):
+# when they are all busy, e.g. scanning the other members of the parent
+# archive, the members are scanned one by one in the calling thread
+def map_archive_members(func, members, budget, stop_at_first=False):
+    results = []
+    if not members:
+        return results
+    workers = budget.take_workers(len(members))
+    if not workers:
+        for member in members:
+            isbns = func(member)
+            results.append(isbns)
+            if isbns and stop_at_first:
+                break
+        return results
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(func, member) for member in members]
+            for future in futures:
+                isbns = future.result()
+                results.append(isbns)
+                if isbns and stop_at_first:
+                    for f in futures:
+                        f.cancel()
+                    break
+    finally:
+        budget.release_workers(workers)
+    return results
+
+
+# Copies at most `size` bytes of the file object `src` to `dst`
+def copy_file_limited(src, dst, size):
+    while size > 0:
+        data = src.read(min(size, 64*1024))
+        if not data:
+            break
+        dst.write(data)
+        size -= len(data)
+
+
+# Scans the members of a zip archive (epub, cbz, docx, odt, ...) for ISBNs
+# in-process: the text members are decompressed as streams straight into an
+# IsbnScanner, the OPF package documents first, and nested zip archives are
+# read in memory (spooled to disk when larger than ARCHIVE_SPOOL_MAX_MEMORY).
+# Only the members that need external tools (e.g. a pdf in a zip) are
+# extracted to temporary files, and they are scanned concurrently. The bytes
+# read from a member never exceed its size accounted for by the budget
+def get_all_isbns_from_zip(zip_file, budget):
+    all_isbns = []
+    members = [info for info in zip_file.infolist() if not info.is_dir()]
+    opf_members = [info for info in members if info.filename.lower().endswith('.opf')]
+    text_members = [info for info in members if info not in opf_members and
+                    info.filename.lower().endswith(ARCHIVE_TEXT_MEMBER_EXTENSIONS)]
+    other_members = [info for info in members if info not in opf_members and info not in text_members]
+
+    for info in opf_members + text_members:
+        if not budget.take_member(info.file_size):
+            continue
+        scanner = IsbnScanner()
+        with io.TextIOWrapper(zip_file.open(info), encoding='utf-8', errors='replace') as f:
+            for chunk in iter(lambda: f.read(64*1024), ''):
+                scanner.feed(chunk)
+        scanner.close()
+        isbns = scanner.get_isbns()
+        if isbns:
+            logger.info('Found ISBNs {} in {} of {}'.format(isbns, info.filename, budget.archive_path))
+            add_isbns(all_isbns, isbns)
+        if info in opf_members and all_isbns:
+            # The package metadata is authoritative, no need to scan the content
+            return config.config_dict['find-isbns']['isbn_ret_separator'].join(all_isbns)
+
+    ocr_enabled = config.config_dict['general-options']['ocr_enabled']
+    members_to_scan = []
+    for info in other_members:
+        mime_type = guess_member_mime_type(info.filename)
+        if re.match(config.config_dict['general-options']['isbn_ignored_files'], mime_type) or \
+                (mime_type.startswith('image/') and not ocr_enabled):
+            logger.debug('Skipping {} ({}) of {}'.format(info.filename, mime_type, budget.archive_path))
+            continue
+        members_to_scan.append(info)
+
+    def scan_member(info):
+        if not budget.take_member(info.file_size):
+            return ''
+        with zip_file.open(info) as f:
+            data = f.read(4)
+            if data == b'PK\x03\x04':
+                nested_budget = budget.nested('{}/{}'.format(budget.archive_path, info.filename))
+                if not nested_budget.allows_depth():
+                    return ''
+                logger.info('Scanning nested zip archive {}'.format(nested_budget.archive_path))
+                with tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_MAX_MEMORY) as spool:
+                    spool.write(data)
+                    copy_file_limited(f, spool, info.file_size - len(data))
+                    spool.seek(0)
+                    with zipfile.ZipFile(spool) as nested_zip_file:
+                        return get_all_isbns_from_zip(nested_zip_file, nested_budget)
+            # The file must be on disk for the external tools (e.g. pdftotext)
+            tmp_file = tempfile.mkstemp(suffix=os.path.splitext(info.filename)[1])[1]
+            try:
+                with open(tmp_file, 'wb') as tmp_f:
+                    tmp_f.write(data)
+                    copy_file_limited(f, tmp_f, info.file_size - len(data))
+                return search_file_for_isbns(tmp_file, archive_budget=budget)
+            finally:
+                remove_file(tmp_file)
+
+    for isbns in map_archive_members(scan_member, members_to_scan, budget):
+        add_isbns(all_isbns, isbns)
+    return config.config_dict['find-isbns']['isbn_ret_separator'].join(all_isbns)
+
+
+# Parses the output of `7z l -slt` and returns the list of files in the archive
+# as `(path, size)` tuples (the directories are skipped)
+def parse_archive_listing(listing):
+    members = []
+    # The members are listed after the '----------' line, the blocks before
+    # it describe the archive itself
+    _, _, listing = listing.partition('\n----------\n')
+    for block in listing.split('\n\n'):
+        info = {}
+        for line in block.splitlines():
+            key, sep, value = line.partition(' = ')
+            if sep:
+                info[key.strip()] = value
+        if 'Path' not in info or info.get('Folder') == '+' or 'D' in info.get('Attributes', '').split(' ')[0]:
+            continue
+        try:
+            size = int(info.get('Size', 0))
+        except ValueError:
+            size = 0
+        members.append((info['Path'], size))
+    return members
+
+
+# Ranks the archive members by their likelihood of containing an ISBN: the
+# OPF/NCX/XHTML/text members first, then the others, and the smaller members
+# before the larger ones. The members that would be discarded anyway
+# (`isbn_ignored_files`, and images if OCR is disabled) are filtered out
+def rank_archive_members(members):
+    ocr_enabled = config.config_dict['general-options']['ocr_enabled']
+    ranked = []
+    for path, size in members:
+        mime_type = guess_member_mime_type(path)
+        if re.match(config.config_dict['general-options']['isbn_ignored_files'], mime_type) or \
+                (mime_type.startswith('image/') and not ocr_enabled):
+            logger.debug('Skipping {} ({})'.format(path, mime_type))
+            continue
+        if path.lower().endswith('.opf'):
+            rank = 0
+        elif path.lower().endswith(ARCHIVE_TEXT_MEMBER_EXTENSIONS):
+            rank = 1
+        else:
+            rank = 2
+        ranked.append((rank, size, path))
+    return [(path, size) for rank, size, path in sorted(ranked)]
+
+
+# List-first scan of an archive that Python can't read (7z, rar, iso, ...):
+# the archive is listed once, the members are filtered and ranked with
+# rank_archive_members() and they are extracted and scanned (concurrently)
+# in that order until one of them contains valid ISBNs. A member is only
+# accounted for in the budget when its scan starts
+def get_isbns_from_archive_members(file_path, budget):
+    result = list_archive(file_path)
+    if result.returncode != 0:
+        logger.info('Error listing the file (probably not an archive)!')
+        logger.debug(result.stderr)
+        return ''
+    if not budget.allows_depth():
+        return ''
+    members = parse_archive_listing(str(result.stdout))
+    ranked_members = rank_archive_members(members)
+    logger.info('{} of the {} members of {} can be scanned'.format(len(ranked_members), len(members), file_path))
+
+    def scan_member(member):
+        member_path, size = member
+        if not budget.take_member(size):
+            return ''
+        logger.info('Scanning member {} ({} bytes) of {}'.format(member_path, size, file_path))
+        process = open_archive_member(file_path, member_path)
+        tmp_file = None
+        try:
+            if member_path.lower().endswith(ARCHIVE_TEXT_MEMBER_EXTENSIONS):
+                # Text members are never written to disk. The stream is decoded
+                # incrementally so that the multibyte characters split between
+                # two chunks are not replaced
+                scanner = IsbnScanner(stop_at_first=True)
+                text_stream = io.TextIOWrapper(process.stdout, encoding='utf-8', errors='replace')
+                for chunk in iter(lambda: text_stream.read(64*1024), ''):
+                    if scanner.feed(chunk):
+                        break
+                scanner.close()
+                isbns = scanner.get_isbns()
+            else:
+                # The file must be on disk for the external tools (e.g. pdftotext)
+                fd, tmp_file = tempfile.mkstemp(suffix=os.path.splitext(member_path)[1])
+                with os.fdopen(fd, 'wb') as f:
+                    shutil.copyfileobj(process.stdout, f)
+                isbns = search_file_for_isbns(tmp_file, archive_budget=budget)
+        finally:
+            # Also done when the scan fails so that neither the temporary file
+            # nor the extraction process are left behind
+            if tmp_file is not None:
+                remove_file(tmp_file)
+            if process.poll() is None:
+                process.kill()
+            process.stdout.close()
+            process.wait()
+        if isbns:
+            logger.info('Found ISBNs {} in {} of {}'.format(isbns, member_path, file_path))
+        return isbns
+
+    results = map_archive_members(scan_member, ranked_members, budget, stop_at_first=True)
+    return results[-1] if results else ''
+
+
+# Extracts the whole archive with 7z in a temporary folder and scans all the
+# extracted files (concurrently)
+def get_isbns_from_extracted_archive(file_path, budget):
     all_isbns = []
     tmpdir = tempfile.mkdtemp()
 
@@ -643,37 +1584,74 @@ def get_all_isbns_from_archive(file_path):
         logger.debug(result.stderr)
         remove_tree(tmpdir)
         return ''
+    if not budget.allows_depth():
+        remove_tree(tmpdir)
+        return ''
 
     logger.info('Archive extracted successfully in {}, scanning contents recursively...'.format(tmpdir))
     # TODO: ref.: https://stackoverflow.com/a/2759553
     # TODO: ignore .DS_Store
+    files_to_check = []
     for path, dirs, files in os.walk(tmpdir, topdown=False):
         # TODO: they use flag options for sorting the directory contents
         # see https://github.com/na--/ebook-tools#miscellaneous-options [FILE_SORT_FLAGS]
         for file_to_check in files:
-            # TODO: add debug_prefixer
             file_to_check = os.path.join(path, file_to_check)
-            isbns = search_file_for_isbns(file_to_check)
-            if isbns:
-                logger.info('Found ISBNs {}!'.format(isbns))
-                # TODO: two prints, one for stderror and the other for stdout
-                logger.info(isbns.replace(config.config_dict['find-isbns']['isbn_ret_separator'], '\n'))
-                for isbn in isbns.split(','):
-                    if isbn not in all_isbns:
-                        all_isbns.append(isbn)
-            logger.info('Removing {}...'.format(file_to_check))
-            remove_file(file_to_check)
-        if len(os.listdir(path)) == 0 and path != tmpdir:
-            os.rmdir(path)
-        elif path == tmpdir:
-            if len(os.listdir(tmpdir)) == 1 and '.DS_Store' in tmpdir:
-                remove_file(os.path.join(tmpdir, '.DS_Store'))
-    logger.info('Removing temporary folder {} (should be empty)...'.format(tmpdir))
-    if is_dir_empty(tmpdir):
-        remove_tree(tmpdir)
+            if budget.take_member(os.path.getsize(file_to_check)):
+                files_to_check.append(file_to_check)
+
+    # One pass of `file` over all the files with unknown signatures
+    mime_types = get_mime_types(files_to_check)
+
+    def scan_file(file_to_check):
+        # TODO: add debug_prefixer
+        isbns = search_file_for_isbns(file_to_check, archive_budget=budget,
+                                      probe=FileProbe(file_to_check, mime_types[file_to_check]))
+        if isbns:
+            logger.info('Found ISBNs {}!'.format(isbns))
+            # TODO: two prints, one for stderror and the other for stdout
+            logger.info(isbns.replace(config.config_dict['find-isbns']['isbn_ret_separator'], '\n'))
+        logger.info('Removing {}...'.format(file_to_check))
+        remove_file(file_to_check)
+        return isbns
+
+    for isbns in map_archive_members(scan_file, files_to_check, budget):
+        add_isbns(all_isbns, isbns)
+    logger.info('Removing temporary folder {}...'.format(tmpdir))
+    remove_tree(tmpdir)
     return config.config_dict['find-isbns']['isbn_ret_separator'].join(all_isbns)
 
 
+# Scans the contents of an archive for ISBNs within the limits of `budget`, the
+# budget of the archive (a child of the budget of the archive containing it if
+# it is a nested archive, see search_file_for_isbns())
+def get_all_isbns_from_archive(file_path, budget=None):
+    if budget is None:
+        budget = ArchiveScanBudget(file_path)
+
+    # Zip archives are read in-process; 7z is only used for the other formats
+    isbns = None
+    if zipfile.is_zipfile(file_path):
+        logger.info('Scanning the contents of zip archive {}'.format(file_path))
+        try:
+            with zipfile.ZipFile(file_path) as zip_file:
+                isbns = get_all_isbns_from_zip(zip_file, budget) if budget.allows_depth() else ''
+        except (zipfile.BadZipFile, zlib.error, NotImplementedError, RuntimeError, EOFError) as e:
+            # e.g. encrypted members or unsupported compression methods
+            logger.info('Could not read the zip archive ({}), trying 7z'.format(e))
+
+    if isbns is None:
+        if config.config_dict['general-options']['isbn_archive_extract_all']:
+            isbns = get_isbns_from_extracted_archive(file_path, budget)
+        else:
+            logger.info('Listing the contents of {} and scanning the most promising members'.format(file_path))
+            isbns = get_isbns_from_archive_members(file_path, budget)
+
+    if budget.root is budget and (budget.members or budget.limits_hit):
+        budget.report()
+    return isbns
+
+
 # ref.: https://stackoverflow.com/a/28909933
 def command_exists(cmd):
     return shutil.which(cmd) is not None
@@ -686,8 +1664,11 @@ def pdftotext(input_file, output_file):
     return convert_result_from_shell_cmd(result)
 
 
+# Converts a Word document to text; `catdoc` outputs the text on stdout
 def catdoc(input_file, output_file):
-    raise NotImplementedError('catdoc is not implemented')
+    args = ['catdoc', input_file]
+    result = subprocess.run(args, stdout=open(output_file, 'w'), stderr=subprocess.PIPE, encoding='utf-8', bufsize=4096)
+    return convert_result_from_shell_cmd(result)
 
 
 def djvutxt(input_file, output_file):
@@ -706,28 +1687,327 @@ def ebook_convert(input_file, output_file):
     return convert_result_from_shell_cmd(result)
 
 
-# Tries to convert the supplied ebook file into .txt. It uses calibre's
-# ebook-convert tool. For optimization, if present, it will use pdftotext
-# for pdfs, catdoc for word files and djvutxt for djvu files.
-# ref.: https://bit.ly/2HXdf2I
-def convert_to_txt(input_file, output_file, mime_type):
-    result = None
+# Returns the command that converts the supplied pdf or djvu document (or only
+# the pages from `first_page` to `last_page`) to text, or None if there is no
+# such command for this MIME type (e.g. calibre's `ebook-convert` can't convert
+# only some pages). If `output_file` is None, the text is output on stdout.
+def get_convert_to_txt_args(input_file, mime_type, output_file=None, first_page=None, last_page=None):
     if mime_type == 'application/pdf' and command_exists('pdftotext'):
-        logger.info('The file looks like a pdf, using pdftotext to extract the text')
-        result = pdftotext(input_file, output_file)
-    elif mime_type == 'application/msword' and command_exists('catdoc'):
-        logger.info('The file looks like a doc, using catdoc to extract the text')
-        result = catdoc(input_file, output_file)
+        args = ['pdftotext']
+        if first_page is not None:
+            args += ['-f', str(first_page), '-l', str(last_page)]
+        return args + [input_file, output_file or '-']
     # TODO: not need to specify the full path to djvutxt if you set correctly the right env. variables
     elif mime_type.startswith('image/vnd.djvu') and command_exists('/Applications/DjView.app/Contents/bin/djvutxt'):
-        logger.info('The file looks like a djvu, using djvutxt to extract the text')
-        result = djvutxt(input_file, output_file)
-    elif (not mime_type.startswith('image/vnd.djvu')) and mime_type.startswith('image/'):
-        logger.info('The file looks like a normal image ({}), skipping ebook-convert usage!'.format(mime_type))
-    else:
-        logger.info("Trying to use calibre's ebook-convert to convert the {} file to .txt".format(mime_type))
-        result = ebook_convert(input_file, output_file)
-    return result
+        args = ['/Applications/DjView.app/Contents/bin/djvutxt']
+        if first_page is not None:
+            args.append('--page={}-{}'.format(first_page, last_page))
+        args.append(input_file)
+        return args + [output_file] if output_file else args
+    return None
+
+
+# Returns the page ranges of a document with `num_pages` pages in the order
+# they should be searched for ISBNs: the first pages, the last pages and
+# finally the pages in the middle (see `isbn_grep_rf_first_last_pages`).
+# Returns None if the document is too short to be split.
+def get_isbn_search_page_ranges(num_pages):
+    first_last_pages = config.config_dict['general-options']['isbn_grep_rf_first_last_pages']
+    if not config.config_dict['general-options']['isbn_grep_reorder_files'] or not first_last_pages:
+        return None
+    first_pages, last_pages = [int(i) for i in str(first_last_pages).split(',')]
+    if num_pages <= first_pages + last_pages:
+        return None
+    ranges = [(1, first_pages), (num_pages - last_pages + 1, num_pages)]
+    if last_pages == 0:
+        ranges.pop()
+    ranges.append((first_pages + 1, num_pages - last_pages))
+    return ranges
+
+
+class TextExtractionError(Exception):
+    pass
+
+
+class TextExtractor:
+    """
+    A way of extracting the text of some MIME types for the ISBN search (step
+    6 of search_file_for_isbns()), registered in TEXT_EXTRACTORS.
+
+    `mime_types` is a regex matched against the MIME type of the files and
+    `cost` a rough estimate of the time spent on a book (the cheapest
+    extractors are tried first). `streams` tells if the text can be scanned as
+    it is produced (and the extraction stopped at the first ISBNs) and
+    `page_ranges` if only some pages can be extracted (see
+    get_isbn_search_page_ranges()).
+
+    Subclasses implement iter_text() that yields the text by chunks (and None
+    at the end of a document, e.g. a chapter of an epub, after which the
+    extraction stops if ISBNs were found) and raises TextExtractionError on
+    failure. The calls, failures, calls that found
+    ISBNs and the time spent are recorded by extractor, see
+    log_extractor_stats().
+    """
+    def __init__(self, name, mime_types, cost, streams=False, page_ranges=False):
+        self.name = name
+        self.mime_types = mime_types
+        self.cost = cost
+        self.streams = streams
+        self.page_ranges = page_ranges
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.hits = 0
+        self.total_time = 0.0
+
+    def __repr__(self):
+        return 'TextExtractor({!r}, cost={})'.format(self.name, self.cost)
+
+    def handles(self, mime_type):
+        return re.match(self.mime_types, mime_type) is not None
+
+    def is_available(self):
+        return True
+
+    def is_streaming(self):
+        return self.streams
+
+    def iter_text(self, file_path, mime_type, first_page=None, last_page=None):
+        raise NotImplementedError
+
+    def scan(self, file_path, mime_type, page_ranges=None):
+        """
+        Scans the text of the file for ISBNs, range by range if `page_ranges`
+        is given: the middle of an 800-page book is only extracted if no ISBNs
+        are found in its first and last pages.
+
+        :return: the IsbnScanner used or None if the text could not be
+                 extracted
+        """
+        scanner = IsbnScanner(stop_at_first=self.is_streaming())
+        start = time.time()
+        try:
+            for first_page, last_page in page_ranges or [(None, None)]:
+                if first_page is not None:
+                    logger.info('Converting pages {}-{} of {} to text...'.format(first_page, last_page, file_path))
+                chunks = self.iter_text(file_path, mime_type, first_page, last_page)
+                try:
+                    for chunk in chunks:
+                        if chunk is None:
+                            # End of a document: no ISBN can continue in the
+                            # next one
+                            scanner.close()
+                            chunk = ''
+                        if scanner.feed(chunk):
+                            logger.info('Found ISBNs after {} characters, stopping {}'.format(
+                                scanner.chars_scanned, self.name))
+                            break
+                finally:
+                    chunks.close()
+                if scanner.isbns and first_page is not None:
+                    logger.info('Found ISBNs in pages {}-{}, skipping the other pages'.format(first_page, last_page))
+                    break
+        except (TextExtractionError, OSError) as e:
+            logger.info('{} could not extract the text of {}: {}'.format(self.name, file_path, e))
+            self._record(start, failed=True)
+            return None
+        scanner.close()
+        self._record(start, found=bool(scanner.isbns))
+        return scanner
+
+    def _record(self, start, failed=False, found=False):
+        with self.lock:
+            self.calls += 1
+            self.failures += failed
+            self.hits += found
+            self.total_time += time.time() - start
+
+    def stats(self):
+        with self.lock:
+            return {'calls': self.calls, 'failures': self.failures, 'hits': self.hits,
+                    'hit_rate': self.hits / self.calls if self.calls else 0.0,
+                    'avg_time': self.total_time / self.calls if self.calls else 0.0}
+
+
+class CommandTextExtractor(TextExtractor):
+    """
+    Extracts the text with an external tool (`pdftotext`, `ebook-convert`,
+    ...): `convert(input_file, output_file)` writes the text of the whole file
+    to a .txt file whose lines are then read in the `isbn_grep_reorder_files`
+    order. If `get_args` is given, it returns the command line outputting the
+    text (or the text of some pages) on stdout, which is streamed when
+    `isbn_stream_extraction` is enabled.
+    """
+    def __init__(self, name, mime_types, cost, command, convert, get_args=None):
+        super().__init__(name, mime_types, cost, streams=get_args is not None,
+                         page_ranges=get_args is not None)
+        self.command = command
+        self.convert = convert
+        self.get_args = get_args
+
+    def is_available(self):
+        return command_exists(self.command)
+
+    # The text is only streamed if `isbn_stream_extraction` is enabled
+    def is_streaming(self):
+        return self.streams and config.config_dict['general-options']['isbn_stream_extraction']
+
+    def iter_text(self, file_path, mime_type, first_page=None, last_page=None):
+        if self.is_streaming():
+            yield from self._iter_command_output(self.get_args(file_path, mime_type, None, first_page, last_page))
+            return
+        tmp_file_txt = tempfile.mkstemp(suffix='.txt')[1]
+        try:
+            if first_page is not None:
+                args = self.get_args(file_path, mime_type, tmp_file_txt, first_page, last_page)
+                returncode = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE).returncode
+            else:
+                logger.info('Converting ebook to text format in file {}...'.format(tmp_file_txt))
+                returncode = self.convert(file_path, tmp_file_txt).returncode
+            if returncode != 0:
+                raise TextExtractionError('{} returned {}'.format(self.command, returncode))
+            if first_page is not None:
+                with open(tmp_file_txt, 'r') as f:
+                    yield from f
+            else:
+                yield from iter_reordered_lines(tmp_file_txt)
+        finally:
+            remove_file(tmp_file_txt)
+
+    # The process is killed if the caller stops reading (e.g. `pdftotext`
+    # stops at the copyright page instead of converting the whole book)
+    @staticmethod
+    def _iter_command_output(args, chunk_size=64*1024):
+        logger.info('Calling `{}` and scanning its output for ISBNs'.format(' '.join(args)))
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        stdout = io.TextIOWrapper(proc.stdout, encoding='utf-8', errors='replace')
+        finished = False
+        try:
+            for chunk in iter(lambda: stdout.read(chunk_size), ''):
+                yield chunk
+            finished = True
+        finally:
+            if not finished:
+                proc.kill()
+            stdout.close()
+            returncode = proc.wait()
+        if returncode != 0:
+            raise TextExtractionError('{} returned {}'.format(args[0], returncode))
+
+
+class MarkupTextExtractor(TextExtractor):
+    """
+    Extracts the text of HTML/XHTML/XML (e.g. FB2) files in-process, see
+    iter_markup_text().
+    """
+    def __init__(self, name, mime_types, cost):
+        super().__init__(name, mime_types, cost, streams=True)
+
+    def iter_text(self, file_path, mime_type, first_page=None, last_page=None):
+        with open(file_path, 'rb') as f:
+            yield from iter_markup_text(f)
+
+
+class ContainerTextExtractor(TextExtractor):
+    """
+    Extracts the text of the zip-based ebooks (epub, docx, odt) in-process: the
+    XHTML/XML documents are streamed from the archive in reading order and
+    their markup is stripped, without any conversion to .txt. The front matter
+    of an epub is read first if `isbn_grep_reorder_files` is enabled.
+
+    Since these files are documents rather than archives, step 5 of
+    search_file_for_isbns() leaves them to this extractor.
+    """
+    def __init__(self, name, mime_types, cost):
+        super().__init__(name, mime_types, cost, streams=True)
+
+    def iter_text(self, file_path, mime_type, first_page=None, last_page=None):
+        try:
+            if mime_type == 'application/epub+zip':
+                # The documents are separated by None, see TextExtractor.scan()
+                yield from iter_epub_text(file_path, config.config_dict['general-options']['isbn_grep_reorder_files'],
+                                          separator=None)
+            else:
+                yield from iter_office_text(file_path, mime_type)
+        except (zipfile.BadZipFile, zlib.error, KeyError, ValueError, ET.ParseError, RuntimeError, EOFError) as e:
+            raise TextExtractionError(e)
+
+
+class TextExtractorRegistry:
+    """
+    The text extractors by increasing cost. Several extractors can handle the
+    same MIME type, e.g. the native ones are tried before calibre's
+    `ebook-convert` which handles (almost) everything.
+    """
+    def __init__(self):
+        self.extractors = []
+
+    def register(self, extractor):
+        self.extractors.append(extractor)
+        self.extractors.sort(key=lambda e: e.cost)
+        return extractor
+
+    def get_extractors(self, mime_type):
+        """
+        :return: the available extractors handling `mime_type`, cheapest first
+        """
+        return [e for e in self.extractors if e.handles(mime_type) and e.is_available()]
+
+    def has_container_extractor(self, mime_type):
+        return any(isinstance(e, ContainerTextExtractor) for e in self.get_extractors(mime_type))
+
+
+TEXT_EXTRACTORS = TextExtractorRegistry()
+TEXT_EXTRACTORS.register(MarkupTextExtractor(
+    'markup', r'^(text/(html|xml)|application/(xhtml\+xml|xml|x-fictionbook\+xml))$', cost=1))
+TEXT_EXTRACTORS.register(ContainerTextExtractor(
+    'container', r'^({})$'.format('|'.join(re.escape(m) for m in ['application/epub+zip'] + list(OFFICE_DOCUMENTS))),
+    cost=2))
+TEXT_EXTRACTORS.register(CommandTextExtractor(
+    'pdftotext', r'^application/pdf$', cost=10, command='pdftotext', convert=pdftotext,
+    get_args=get_convert_to_txt_args))
+# TODO: not need to specify the full path to djvutxt if you set correctly the right env. variables
+TEXT_EXTRACTORS.register(CommandTextExtractor(
+    'djvutxt', r'^image/vnd\.djvu', cost=10, command='/Applications/DjView.app/Contents/bin/djvutxt',
+    convert=djvutxt, get_args=get_convert_to_txt_args))
+TEXT_EXTRACTORS.register(CommandTextExtractor(
+    'catdoc', r'^application/msword$', cost=20, command='catdoc', convert=catdoc))
+# calibre's `ebook-convert` handles everything but the normal images; its
+# startup alone takes about a second
+TEXT_EXTRACTORS.register(CommandTextExtractor(
+    'ebook-convert', r'^(?!image/(?!vnd\.djvu))', cost=100,
+    command='/Applications/calibre.app/Contents/MacOS/ebook-convert', convert=ebook_convert))
+
+
+# Scans the text of the file for ISBNs with the cheapest extractor of
+# TEXT_EXTRACTORS that succeeds. Returns the IsbnScanner used or None if no
+# extractor could extract the text.
+def scan_file_text_for_isbns(file_path, mime_type, probe=None):
+    if probe is None:
+        probe = FileProbe(file_path, mime_type)
+    extractors = TEXT_EXTRACTORS.get_extractors(mime_type)
+    if not extractors:
+        logger.info('No text extractor for the {} file {}'.format(mime_type, file_path))
+    for extractor in extractors:
+        logger.info('Extracting the text of the {} file with {}'.format(mime_type, extractor.name))
+        page_ranges = None
+        if extractor.page_ranges:
+            num_pages = probe.get_page_count()
+            if num_pages:
+                page_ranges = get_isbn_search_page_ranges(num_pages)
+        scanner = extractor.scan(file_path, mime_type, page_ranges)
+        if scanner is not None:
+            return scanner
+    return None
+
+
+def log_extractor_stats():
+    for extractor in TEXT_EXTRACTORS.extractors:
+        stats = extractor.stats()
+        if stats['calls']:
+            logger.info('Text extractor {}: {} calls, {} failures, {:.1%} found ISBNs, '
+                        '{:.2f} s per call'.format(extractor.name, stats['calls'], stats['failures'],
+                                                   stats['hit_rate'], stats['avg_time']))
 
 
 # Tries to find ISBN numbers in the given ebook file by using progressively
@@ -739,15 +2019,31 @@ def convert_to_txt(input_file, output_file, mime_type):
 # 3. If the MIME type matches `isbn_ignored_files`, the function returns early
 #    with no results
 # 4. Check the file metadata from calibre's `ebook-meta` for ISBNs
-# 5. Try to extract the file as an archive with `7z`; if successful,
-#    recursively call search_file_for_isbns for all the extracted files
-# 6. If the file is not an archive, try to convert it to a .txt file
-#    via convert_to_txt()
-# 7. If OCR is enabled and convert_to_txt() fails or its result is empty,
+# 5. Try to scan the file as an archive (in-process for zip archives, with
+#    `7z` otherwise, but not the epub/docx/odt documents); if successful,
+#    recursively call search_file_for_isbns for the archive members, within
+#    the limits of `archive_budget` (see ArchiveScanBudget). Single files
+#    compressed with gzip, bzip2, xz or lzma are detected by their magic bytes
+#    and decompressed as streams before step 2
+# 6. If the file is not an archive, try to extract its text with the
+#    cheapest text extractor handling its MIME type (see TEXT_EXTRACTORS):
+#    native readers first (epubs in reading order, front matter first), then
+#    `pdftotext`, `djvutxt`, `catdoc` and calibre's `ebook-convert`. If
+#    `isbn_stream_extraction` is enabled, the output of the tools is streamed
+#    into the ISBN search, which stops at the first ISBNs. Pdf and djvu
+#    documents are converted by page ranges (first pages, last pages and then
+#    the middle), see `isbn_grep_rf_first_last_pages`.
+# 7. If OCR is enabled and the text extraction fails or its result is empty,
 #    try OCR-ing the file. If the result is non-empty but does not contain
 #    ISBNs and OCR_ENABLED is set to "always", run OCR as well.
+# If the ISBN cache is enabled, the results of steps 2-7 (including the
+# negative ones, unless a limit of the archive budget was hit) are cached by
+# file content and a cache hit skips these steps. Archive members (i.e. when
+# `archive_budget` is given) are not cached: they are temporary copies with a
+# new mtime every time and their ISBNs are cached with the archive's result.
+# `probe` is the FileProbe of the file if the caller already has one
 # ref.: https://bit.ly/2r28US2
-def search_file_for_isbns(file_path):
+def search_file_for_isbns(file_path, archive_budget=None, probe=None):
     logger.info('Searching file {} for ISBN numbers...'.format(file_path))
     # Step 1: check the filename for ISBNs
     basename = os.path.basename(file_path)
@@ -757,56 +2053,202 @@ def search_file_for_isbns(file_path):
         logger.info('Extracted ISBNs {} from the file name!'.format(isbns))
         return isbns
 
+    if probe is None:
+        probe = FileProbe(file_path)
+    # Budget of the file if it is an archive
+    if archive_budget is None:
+        budget = ArchiveScanBudget(file_path)
+    else:
+        budget = archive_budget.nested(file_path)
+    isbn_cache = get_isbn_cache()
+    if isbn_cache is None or archive_budget is not None:
+        return search_file_content_for_isbns(file_path, budget, probe)[0]
+
+    file_info = probe.stat()
+    cache_key = (probe.get_file_hash(), file_info.st_size, file_info.st_mtime)
+    ignore_negative = config.config_dict['general-options']['isbn_cache_ignore_negative']
+    cached = isbn_cache.get(*cache_key, ignore_negative=ignore_negative)
+    if cached is not None:
+        isbns, step = cached
+        if isbns:
+            logger.info('Found cached ISBNs {} (found by step {})!'.format(isbns, step))
+        else:
+            logger.info('Cached result: no ISBNs in {}'.format(file_path))
+        return isbns
+    isbns, step = search_file_content_for_isbns(file_path, budget, probe)
+    if isbns or not budget.truncated:
+        isbn_cache.put(*cache_key, isbns, step)
+    else:
+        logger.info('Not caching the result: the scan of {} was cut short by the archive limits'.format(file_path))
+    return isbns
+
+
+# Magic bytes of the single-file compression formats that are decompressed as
+# streams by search_compressed_file_for_isbns(), with the function opening
+# them (lzma.open() reads both .xz and legacy .lzma files)
+COMPRESSION_MAGIC_BYTES = [(b'\x1f\x8b', gzip.open), (b'BZh', bz2.open),
+                           (b'\xfd7zXZ\x00', lzma.open), (b'\x5d\x00\x00', lzma.open)]
+# Magic bytes of the decompressed contents that need an external tool (and
+# thus a real file), e.g. a pdf or djvu document; contents with NUL bytes are
+# also considered binary
+BINARY_MAGIC_BYTES = (b'%PDF', b'AT&TFORM', b'PK\x03\x04', b'7z\xbc\xaf', b'Rar!')
+
+
+class BudgetedStream(io.RawIOBase):
+    """
+    Binary stream reading the decompressed contents of a file (e.g. from
+    gzip.open()) and accounting for the bytes read in an ArchiveScanBudget,
+    so that a decompression bomb can't fill the temporary directory. The
+    stream ends early, with `truncated` set to True, when the budget has no
+    bytes left.
+    """
+    def __init__(self, f, budget):
+        super().__init__()
+        self.f = f
+        self.budget = budget
+        self.truncated = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.truncated:
+            return 0
+        data = self.f.read(min(len(b), 64*1024))
+        if data and not self.budget.take_bytes(len(data)):
+            self.truncated = True
+            return 0
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+
+# Returns the function opening the file if it is compressed with gzip, bzip2,
+# xz or lzma, None otherwise
+def get_compression_opener(file_path):
+    with open(file_path, 'rb') as f:
+        magic = f.read(6)
+    for magic_bytes, opener in COMPRESSION_MAGIC_BYTES:
+        if magic.startswith(magic_bytes):
+            return opener
+    return None
+
+
+# Searches a single compressed file (e.g. book.txt.gz or book.pdf.xz) for
+# ISBNs without `7z`: text contents are decompressed as a stream straight into
+# the ISBN scanner, other contents are decompressed into a temporary file that
+# goes through the remaining steps of search_file_content_for_isbns(). The
+# decompressed bytes are accounted for in `budget` (the budget of the file):
+# the scan of the text stops and the other contents are skipped when it has
+# no bytes left
+# Returns a tuple `(isbns, step)` or None if the file could not be decompressed
+def search_compressed_file_for_isbns(file_path, opener, budget=None):
+    if budget is None:
+        budget = ArchiveScanBudget(file_path)
+    tmp_file = None
+    try:
+        with opener(file_path, 'rb') as f:
+            head = f.read(64*1024)
+        if head and not head.startswith(BINARY_MAGIC_BYTES) and b'\x00' not in head:
+            logger.info('Compressed file {} contains text, trying to find ISBN directly'.format(file_path))
+
+            def open_text():
+                return io.TextIOWrapper(io.BufferedReader(BudgetedStream(opener(file_path, 'rb'), budget)),
+                                        encoding='utf-8', errors='replace')
+            isbns = scan_text_file_for_isbns(file_path, open_text).get_isbns()
+            if isbns:
+                logger.info('Extracted ISBNs {} from the compressed text file contents!'.format(isbns))
+                return isbns, 'direct_grep'
+            return '', ''
+        # Keep the name without the compression extension, e.g. book.pdf
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        tmp_file = tempfile.mkstemp(suffix='-' + name)[1]
+        with BudgetedStream(opener(file_path, 'rb'), budget) as f:
+            with open(tmp_file, 'wb') as tmp_f:
+                shutil.copyfileobj(f, tmp_f)
+    except (OSError, EOFError, lzma.LZMAError) as e:
+        logger.info('Could not decompress {}: {}'.format(file_path, e))
+        if tmp_file is not None:
+            remove_file(tmp_file)
+        return None
+
+    if f.truncated:
+        logger.info('The contents of {} exceed the limit of extracted bytes, skipping them'.format(file_path))
+        remove_file(tmp_file)
+        return '', ''
+    logger.info('Decompressed {} into {}'.format(file_path, tmp_file))
+    try:
+        return search_file_content_for_isbns(tmp_file, budget)
+    finally:
+        remove_file(tmp_file)
+
+
+# Steps 2-7 of search_file_for_isbns()
+# Returns a tuple `(isbns, step)` where `step` is the name of the step that
+# found the ISBNs (one of ISBN_SEARCH_STEPS) or an empty string if no ISBNs
+# were found. `budget` is the budget of the file if it is an archive
+def search_file_content_for_isbns(file_path, budget=None, probe=None):
+    if probe is None:
+        probe = FileProbe(file_path)
+    isbns = ''
+    # Single compressed files are decompressed as streams
+    opener = get_compression_opener(file_path)
+    if opener is not None:
+        result = search_compressed_file_for_isbns(file_path, opener, budget)
+        if result is not None:
+            return result
     # Steps 2-3: (2) if valid MIME type, search file contents for isbns and
     # (3) if invalid MIME type, exit without results
-    mime_type = get_mime_type(file_path)
+    mime_type = probe.get_mime_type()
     if re.match(config.config_dict['general-options']['isbn_direct_grep_files'], mime_type):
         logger.info('Ebook is in text format, trying to find ISBN directly')
-        data = reorder_file_content(file_path)
-        isbns = find_isbns(data)
+        isbns = scan_text_file_for_isbns(file_path).get_isbns()
         if isbns:
             logger.info('STDERR: Extracted ISBNs {} from the text file contents!'.format(isbns))
+            return isbns, 'direct_grep'
         else:
             logger.info('STDERR: Did not find any ISBNs')
-        return isbns
+        return isbns, ''
     elif re.match(config.config_dict['general-options']['isbn_ignored_files'], mime_type):
         logger.info('The file type in the blacklist, ignoring...')
-        return isbns
+        return isbns, ''
 
     # Step 4: check the file metadata from calibre's `ebook-meta` for ISBNs
     logger.info('Ebook metadata:')
-    ebookmeta = get_ebook_metadata(file_path)
+    ebookmeta = probe.get_ebook_metadata()
     isbns = find_isbns(ebookmeta.stdout)
     if isbns:
         logger.info('Extracted ISBNs {} from calibre ebook metadata!'.format(isbns))
-        return isbns
+        return isbns, 'ebook_meta'
 
     # Step 5: decompress with 7z
-    isbns = get_all_isbns_from_archive(file_path)
-    if isbns:
-        logger.info('Extracted ISBNs {} from the archive file'.format(isbns))
-        return isbns
+    # NOTE: the epub, docx and odt files are zip archives too but their text
+    # is read in reading order by step 6
+    if TEXT_EXTRACTORS.has_container_extractor(mime_type):
+        logger.info('The {} file is read as a document, not as an archive'.format(mime_type))
+    else:
+        isbns = get_all_isbns_from_archive(file_path, budget)
+        if isbns:
+            logger.info('Extracted ISBNs {} from the archive file'.format(isbns))
+            return isbns, 'archive'
 
     # Step 6: convert file to .txt
+    step = 'txt_conversion'
     try_ocr = False
     tmp_file_txt = tempfile.mkstemp(suffix='.txt')[1]
-    logger.info('Converting ebook to text format in file {}...'.format(tmp_file_txt))
 
-    result = convert_to_txt(file_path, tmp_file_txt, mime_type)
-    if result.returncode == 0:
+    scanner = scan_file_text_for_isbns(file_path, mime_type, probe)
+    if scanner is not None:
         logger.info('Conversion to text was successful, checking the result...')
-        with open(tmp_file_txt, 'r') as f:
-            data = f.read()
-        # TODO: debug, to remove
-        # data = '*'
-        if not re.search('[A-Za-z0-9]+', data):
-            logger.info('The converted txt with size {} bytes does not seem to '
-                        'contain text'.format(os.stat(tmp_file_txt).st_size))
-            logger.debug('First 1000 characters:\n{}'.format(data[:1000]))
+        if not scanner.has_text:
+            logger.info('The converted txt with {} characters does not seem to '
+                        'contain text'.format(scanner.chars_scanned))
             try_ocr = True
         else:
-            data = reorder_file_content(tmp_file_txt)
-            isbns = find_isbns(data)
+            isbns = scanner.get_isbns()
             if isbns:
                 logger.info('Text output contains ISBNs {}!'.format(isbns))
             elif config.config_dict['general-options']['ocr_enabled'] == 'always':
@@ -824,10 +2266,10 @@ def search_file_for_isbns(file_path):
     # config.config_dict['general-options']['ocr_enabled'] = True
     if not isbns and config.config_dict['general-options']['ocr_enabled'] and try_ocr:
         logger.info('Trying to run OCR on the file...')
-        if ocr_file(file_path, tmp_file_txt, mime_type) == 0:
+        step = 'ocr'
+        if ocr_file(file_path, tmp_file_txt, mime_type, probe) == 0:
             logger.info('OCR was successful, checking the result...')
-            data = reorder_file_content(tmp_file_txt)
-            isbns = find_isbns(data)
+            isbns = scan_text_file_for_isbns(tmp_file_txt).get_isbns()
             if isbns:
                 logger.info('Text output contains ISBNs {}!'.format(isbns))
             else:
@@ -842,24 +2284,348 @@ def search_file_for_isbns(file_path):
         logger.info('Returning the found ISBNs {}!'.format(isbns))
     else:
         logger.info('Could not find any ISBNs in {} :('.format(file_path))
+        step = ''
 
-    return isbns
+    return isbns, step
+
+
+# Names of the steps of search_file_for_isbns() recorded in the ISBN cache
+# NOTE: results from the filename (step 1) are not cached since it is cheaper
+# to search the filename than to hash the file
+ISBN_SEARCH_STEPS = ['direct_grep', 'ebook_meta', 'archive', 'txt_conversion', 'ocr']
+
+# Caches opened in this run, by name (e.g. 'isbn' for the ISBN cache)
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+# Returns the cache with the given name, opened on first use from the
+# `<name>_cache_path` option, or None if `<name>_cache_enabled` is False
+def _get_cache(name, cache_class, **kwargs):
+    if not config.config_dict['general-options']['{}_cache_enabled'.format(name)]:
+        return None
+    with _caches_lock:
+        if name not in _caches:
+            cache_path = config.config_dict['general-options']['{}_cache_path'.format(name)]
+            logger.info('Opening {} cache {}'.format(name, cache_path))
+            _caches[name] = cache_class(cache_path, **kwargs)
+    return _caches[name]
+
+
+def get_isbn_cache():
+    return _get_cache('isbn', IsbnCache)
+
+
+def get_ocr_cache():
+    max_size = config.config_dict['general-options']['ocr_cache_max_size_mib'] * 1024 * 1024
+    return _get_cache('ocr', OcrCache, max_size=max_size)
+
+
+def get_metadata_cache():
+    ttl = config.config_dict['general-options']['metadata_cache_ttl_days'] * 24 * 3600
+    negative_ttl = config.config_dict['general-options']['metadata_cache_negative_ttl_days'] * 24 * 3600
+    return _get_cache('metadata', MetadataCache, ttl=ttl, negative_ttl=negative_ttl)
+
+
+# Fields added by organize-ebooks after the fetched metadata in the metadata
+# files (see fetch_metadata_by_isbns())
+ADDED_METADATA_FIELDS = ('ISBN', 'All found ISBNs', 'Old file path', 'Metadata source')
+
+
+# Fills the metadata cache with the metadata files (found recursively in
+# `folder`) saved by organize-ebooks next to the books organized by ISBN, e.g.
+# 'Author - Title (2001) [9780306406157].pdf.meta'. Returns the number of
+# cached results
+def warm_metadata_cache(metadata_cache, folder):
+    extension = '.{}'.format(config.config_dict['general-options']['output_metadata_extension'])
+    count = 0
+    for path, dirs, files in os.walk(folder):
+        for name in files:
+            if not name.endswith(extension):
+                continue
+            fields = {}
+            lines = []
+            with open(os.path.join(path, name), 'r', errors='replace') as f:
+                for line in f:
+                    match = re.match(r'^([^:]+?)\s*: ?(.*)$', line.rstrip('\n'))
+                    if match and match.group(1) in ADDED_METADATA_FIELDS:
+                        fields[match.group(1)] = match.group(2).strip()
+                    else:
+                        lines.append(line)
+            if not fields.get('ISBN') or not fields.get('Metadata source') or not lines:
+                logger.debug('{} was not fetched by ISBN, skipping it'.format(name))
+                continue
+            metadata = ''.join(lines)
+            metadata_cache.put(get_metadata_query(isbn=fields['ISBN']), fields['Metadata source'].strip('"'),
+                               metadata if metadata.endswith('\n') else metadata + '\n')
+            count += 1
+    return count
+
+
+# Name of the source of the metadata found in the offline metadata index, as
+# saved in the metadata files
+METADATA_INDEX_SOURCE = 'Metadata index'
+# Number of books of a dump added to the metadata index in one transaction
+METADATA_INDEX_BATCH_SIZE = 10000
+# Formats of the publication dates in the dumps, e.g. 'March 1, 1967'
+PUBLISH_DATE_FORMATS = ['%Y-%m-%d', '%Y-%m', '%B %d, %Y', '%b %d, %Y', '%d %B %Y', '%B %Y', '%b %Y']
+
+
+# Returns the offline metadata index (see `metadata_index_path`), or None if
+# `metadata_index_enabled` is False
+def get_metadata_index():
+    if not config.config_dict['general-options']['metadata_index_enabled']:
+        return None
+    with _caches_lock:
+        if 'metadata_index' not in _caches:
+            index_path = config.config_dict['general-options']['metadata_index_path']
+            logger.info('Opening metadata index {}'.format(index_path))
+            _caches['metadata_index'] = MetadataIndex(index_path)
+    return _caches['metadata_index']
+
+
+# Returns the tuple `(isbn, metadata)` for the first of the comma-separated
+# `isbns` found in the offline metadata index, or `(None, None)`
+def get_indexed_metadata(isbns):
+    metadata_index = get_metadata_index()
+    if metadata_index is not None:
+        for isbn in isbns.split(','):
+            metadata = metadata_index.get(get_canonical_isbn(isbn))
+            if metadata:
+                return isbn, metadata
+    return None, None
+
+
+# Returns the names of a value of a dump that can be a string, a list of
+# strings or a list of objects, e.g. [{'key': '/languages/eng'}] -> ['eng']
+def _get_dump_names(value, name_keys=('name', 'key')):
+    if not value:
+        return []
+    if not isinstance(value, list):
+        value = [value]
+    names = []
+    for item in value:
+        if isinstance(item, dict):
+            item = next((item[k] for k in name_keys if item.get(k)), '')
+        if isinstance(item, str) and item.strip():
+            names.append(item.strip())
+    return names
+
+
+# Returns the publication date of a dump record in the format of calibre, e.g.
+# 'March 1, 1967' -> '1967-03-01T00:00:00+00:00'
+def _get_dump_published(record):
+    date = str(record.get('publish_date') or record.get('date') or record.get('year') or '').strip()
+    for date_format in PUBLISH_DATE_FORMATS:
+        try:
+            return datetime.strptime(date, date_format).strftime('%Y-%m-%dT00:00:00+00:00')
+        except ValueError:
+            pass
+    match = re.search(r'\b(1[4-9]|20)[0-9]{2}\b', date)
+    return '{}-01-01T00:00:00+00:00'.format(match.group()) if match else None
+
+
+# Returns the tuple `(fields, isbns)` of a book record of a dump (see
+# `MetadataIndex.add_books()`), or None if the record has no title or no valid
+# ISBN. The records are OpenLibrary editions, e.g.
+#   {"title": "...", "authors": [{"key": "/authors/OL1A"}], "isbn_10": ["..."],
+#    "publishers": ["..."], "publish_date": "1967", "key": "/books/OL1M", ...}
+# or flat records (e.g. converted from MARC) with the same or similar keys:
+#   {"title": "...", "authors": ["..."], "isbn": "...", "publisher": "...", "year": 1967}
+# `author_names` maps the author keys to names
+def parse_dump_record(record, author_names=None):
+    title = record.get('title')
+    if not isinstance(title, str) or not title.strip():
+        return None
+    if isinstance(record.get('subtitle'), str) and record['subtitle'].strip():
+        title = '{}: {}'.format(title.strip(), record['subtitle'].strip())
+    isbns = []
+    for key in ('isbn_13', 'isbn_10', 'isbns', 'isbn'):
+        for isbn in _get_dump_names(record.get(key)):
+            if is_isbn_valid(isbn):
+                isbn = get_canonical_isbn(isbn)
+                if isbn not in isbns:
+                    isbns.append(isbn)
+    if not isbns:
+        return None
+    authors = []
+    author_values = record.get('authors') or record.get('author') or []
+    for author in author_values if isinstance(author_values, list) else [author_values]:
+        if isinstance(author, dict):
+            # OpenLibrary: {"key": ...} in editions, {"author": {"key": ...}} in works
+            key = author.get('key') or (author.get('author') or {}).get('key')
+            author = author.get('name') or (author_names or {}).get(key)
+        if isinstance(author, str) and author.strip() and author.strip() not in authors:
+            authors.append(author.strip())
+    identifiers = ['isbn:{}'.format(isbns[0])]
+    if isinstance(record.get('key'), str) and record['key'].startswith('/books/'):
+        identifiers.append('openlibrary:{}'.format(record['key'].rsplit('/', 1)[-1]))
+    for scheme, values in (record.get('identifiers') or {}).items():
+        values = _get_dump_names(values)
+        if values:
+            identifiers.append('{}:{}'.format(scheme, values[0]))
+    languages = [language.rsplit('/', 1)[-1] for language in
+                 _get_dump_names(record.get('languages') or record.get('language'), ('key', 'name'))]
+    fields = {
+        'title': ' '.join(title.split()),
+        'authors': ' & '.join(authors),
+        'publisher': next(iter(_get_dump_names(record.get('publishers') or record.get('publisher'))), None),
+        'languages': ', '.join(languages),
+        'published': _get_dump_published(record),
+        'series': next(iter(_get_dump_names(record.get('series'))), None),
+        'identifiers': ', '.join(identifiers),
+    }
+    return fields, isbns
+
+
+# Yields the JSON records of a dump: one JSON object per line, or the lines of
+# the OpenLibrary dumps (type, key, revision, last modified, JSON separated by
+# tabs). The dump can be compressed with gzip
+def iter_dump_records(dump_path):
+    opener = gzip.open if dump_path.endswith('.gz') else open
+    with opener(dump_path, 'rt', encoding='utf-8', errors='replace') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if not line.startswith('{'):
+                line = line.rsplit('\t', 1)[-1]
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.debug('{}:{}: not a JSON record'.format(dump_path, line_number))
+                record = None
+            yield record if isinstance(record, dict) else None
+
+
+# Imports a dump (see iter_dump_records() and parse_dump_record()) into the
+# metadata index, replacing the books of a previous import of the same dump.
+# The author records (OpenLibrary authors dump) are imported too: import the
+# authors before the editions so that the books get their author names.
+# Returns the tuple `(records, books, skipped)`
+def import_metadata_dump(metadata_index, dump_path, dump_name=None):
+    dump_name = dump_name or os.path.basename(dump_path)
+    metadata_index.clear_dump(dump_name)
+    records = books = skipped = 0
+    batch = []
+    authors = []
+
+    def add_batch():
+        keys = set()
+        for record in batch:
+            for author in record.get('authors') or []:
+                if isinstance(author, dict) and not author.get('name'):
+                    keys.add(author.get('key') or (author.get('author') or {}).get('key'))
+        keys.discard(None)
+        author_names = metadata_index.get_author_names(keys) if keys else {}
+        parsed = []
+        for fields, isbns in filter(None, (parse_dump_record(record, author_names) for record in batch)):
+            parsed.append((fields, isbns, get_book_tokens(fields['title'], fields['authors'])))
+        metadata_index.add_books(parsed, dump_name)
+        batch.clear()
+        return len(parsed)
+
+    for record in iter_dump_records(dump_path):
+        records += 1
+        if record is None:
+            skipped += 1
+        elif str(record.get('key', '')).startswith('/authors/'):
+            if record.get('name'):
+                authors.append((record['key'], record['name'].strip()))
+            if len(authors) >= METADATA_INDEX_BATCH_SIZE:
+                metadata_index.add_authors(authors)
+                authors = []
+        else:
+            batch.append(record)
+            if len(batch) >= METADATA_INDEX_BATCH_SIZE:
+                added = add_batch()
+                books += added
+                skipped += METADATA_INDEX_BATCH_SIZE - added
+                logger.info('{}: {} records read, {} books imported'.format(dump_name, records, books))
+    metadata_index.add_authors(authors)
+    batch_size = len(batch)
+    added = add_batch()
+    books += added
+    skipped += batch_size - added
+    metadata_index.add_dump(dump_name, records, books, skipped)
+    metadata_index.update_token_counts()
+    return records, books, skipped
+
+
+# Returns the tokens of the title and authors of a book indexed in the
+# metadata index
+def get_book_tokens(title, authors):
+    return tokenize('{} {}'.format(title or '', (authors or '').replace('&', ' '))).split()
+
+
+# Rebuilds the inverted index of the titles and authors of the metadata index,
+# e.g. after changing `token_min_length` or `tokens_to_ignore`. Returns the
+# number of indexed books
+def reindex_metadata_index(metadata_index):
+    count = 0
+    for books in metadata_index.iter_books(METADATA_INDEX_BATCH_SIZE):
+        metadata_index.set_book_tokens([(book_id, get_book_tokens(title, authors))
+                                        for book_id, title, authors in books])
+        count += len(books)
+    metadata_index.update_token_counts()
+    return count
+
+
+# Returns the metadata of the book of the metadata index best matching `text`
+# (e.g. a filename or a title and author) by the tokens of their title and
+# authors, or None if no book scores at least `metadata_index_min_score`
+def search_indexed_metadata(text):
+    metadata_index = get_metadata_index()
+    if metadata_index is None:
+        return None
+    tokens = tokenize(text).split()
+    if not tokens:
+        return None
+    results = metadata_index.search(tokens)
+    min_score = config.config_dict['general-options']['metadata_index_min_score']
+    if not results or results[0][0] < min_score:
+        metadata_index.misses += 1
+        logger.info('No book of the metadata index matches the tokens {} (best score: {:.2f})'.format(
+            tokens, results[0][0] if results else 0))
+        return None
+    metadata_index.hits += 1
+    score, book_id = results[0]
+    logger.info('Found a book of the metadata index matching the tokens {} (score: {:.2f})'.format(tokens, score))
+    return metadata_index.get_by_id(book_id)
+
+
+def log_cache_stats():
+    for name, cache in _caches.items():
+        logger.info('{} cache: {} hits, {} misses (hit rate: {:.1%})'.format(
+            name, cache.hits, cache.misses, cache.hit_rate()))
+
+
+# Destination paths already handed out by unique_filename() in this run. A
+# reserved path might not exist on disk yet (the move happens later, or never
+# with `dry_run`), so it must also be skipped when several workers organize
+# files concurrently
+_reserved_paths = set()
+_reserved_paths_lock = threading.Lock()
 
 
 # Return "folder_path/basename" if no file exists at this path. Otherwise,
 # sequentially insert " ($n)" before the extension of `basename` and return the
 # first path for which no file is present.
+# NOTE: the returned path is reserved so that concurrent callers never get the
+# same destination path
 # ref.: https://github.com/na--/ebook-tools/blob/0586661ee6f483df2c084d329230c6e75b645c0b/lib.sh#L295
 def unique_filename(folder_path, basename):
     stem = Path(basename).stem
     ext = Path(basename).suffix
     new_path = os.path.join(folder_path, basename)
     counter = 0
-    while os.path.isfile(new_path):
-        counter += 1
-        logger.info('File {} already exists in destination {}, trying with counter {}!'.format(new_path, folder_path, counter))
-        new_stem = '{} {}'.format(stem, counter)
-        new_path = os.path.join(folder_path, new_stem) + ext
+    with _reserved_paths_lock:
+        while os.path.isfile(new_path) or new_path in _reserved_paths:
+            counter += 1
+            logger.info('File {} already exists in destination {}, trying with counter {}!'.format(new_path, folder_path, counter))
+            new_stem = '{} {}'.format(stem, counter)
+            new_path = os.path.join(folder_path, new_stem) + ext
+        _reserved_paths.add(new_path)
     return new_path
 
 
@@ -873,7 +2639,8 @@ def move_or_link_file(current_path, new_path):
     if not os.path.isdir(new_folder):
         logger.info('Creating folder {}'.format(new_folder))
         if not config.config_dict['general-options']['dry_run']:
-            os.makedirs(new_folder)
+            # NOTE: another worker might create the same folder concurrently
+            os.makedirs(new_folder, exist_ok=True)
 
     if config.config_dict['general-options']['symlink_only']:
         logger.info('Symlinking file {} to {}...'.format(current_path, new_path))
@@ -986,8 +2753,14 @@ def move_or_link_ebook_file_and_metadata(new_folder, current_ebook_path, current
 # options='--verbose --opf isbn=1234567890'
 # Returns the ebook metadata as a string; if no metadata found, an empty string
 # is returned
+# The process is killed after `timeout` seconds or when `cancel_event` is set
+# (e.g. another source already returned the metadata), and no metadata is
+# returned in that case
+# The process is only started once there are less than
+# `isbn_metadata_fetch_max_concurrent` of them running (see
+# get_fetch_semaphore()); the timeout starts then
 # ref.: https://bit.ly/2HS0iXQ
-def fetch_metadata(isbn_sources, options=''):
+def fetch_metadata(isbn_sources, options='', timeout=None, cancel_event=None):
     args = '{} {}'.format('fetch-ebook-metadata', options)
     isbn_sources = isbn_sources.split(',')
     for isbn_source in isbn_sources:
@@ -1002,10 +2775,255 @@ def fetch_metadata(isbn_sources, options=''):
     # have the pattern '[a-zA-Z()]+ +: .*'
     # TODO: make sure that you are getting only the fields that match the pattern
     # '[a-zA-Z()]+ +: .*' since you are not using a regex on the result
-    result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    semaphore = get_fetch_semaphore()
+    while not semaphore.acquire(timeout=FETCH_POLL_INTERVAL):
+        if cancel_event is not None and cancel_event.is_set():
+            logger.info('`{}` cancelled before it started'.format(' '.join(args)))
+            result = subprocess.CompletedProcess(args, None, b'', b'fetch-ebook-metadata cancelled')
+            return convert_result_from_shell_cmd(result)
+    try:
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            try:
+                stdout, stderr = proc.communicate(timeout=None if timeout is None and cancel_event is None
+                                                  else FETCH_POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                if cancel_event is not None and cancel_event.is_set():
+                    reason = 'cancelled'
+                elif deadline is not None and time.time() > deadline:
+                    reason = 'timed out after {} s'.format(timeout)
+                else:
+                    continue
+                logger.info('`{}` {}, killing it'.format(' '.join(args), reason))
+                proc.kill()
+                stdout, stderr = proc.communicate()
+                # The metadata might be incomplete
+                stdout = b''
+                stderr += '\nfetch-ebook-metadata {}'.format(reason).encode()
+                break
+    finally:
+        semaphore.release()
+    result = subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
     return convert_result_from_shell_cmd(result)
 
 
+# Interval (in seconds) at which a running `fetch-ebook-metadata` is checked
+# for timeout or cancellation
+FETCH_POLL_INTERVAL = 0.5
+
+# Limits the number of `fetch-ebook-metadata` processes running at the same
+# time (over all the files and whether the sources are queried sequentially or
+# concurrently), see `isbn_metadata_fetch_max_concurrent`
+_fetch_semaphore = None
+_fetch_semaphore_lock = threading.Lock()
+
+
+def get_fetch_semaphore():
+    global _fetch_semaphore
+    with _fetch_semaphore_lock:
+        if _fetch_semaphore is None:
+            max_concurrent = config.config_dict['general-options']['isbn_metadata_fetch_max_concurrent']
+            _fetch_semaphore = threading.BoundedSemaphore(max(1, max_concurrent))
+        return _fetch_semaphore
+
+
+# Returns the timeout (in seconds) of the metadata fetches from `isbn_source`
+# or None if there is no timeout: `isbn_metadata_fetch_source_timeouts` (e.g.
+# 'Amazon.com:60,OZON.ru:15') overrides `isbn_metadata_fetch_timeout` for some
+# sources
+def get_fetch_timeout(isbn_source):
+    timeout = config.config_dict['general-options']['isbn_metadata_fetch_timeout']
+    source_timeouts = config.config_dict['general-options']['isbn_metadata_fetch_source_timeouts']
+    for source_timeout in filter(None, str(source_timeouts).split(',')):
+        source, _, value = source_timeout.rpartition(':')
+        if source.strip() == isbn_source.strip().strip('"'):
+            timeout = int(value)
+    return timeout if timeout else None
+
+
+# Returns the key of the metadata cache for a search by ISBN or by title and
+# author, e.g. 'isbn:9780306406157' or 'title:a book|author:someone'
+def get_metadata_query(isbn=None, title=None, author=None):
+    if isbn is not None:
+        return 'isbn:{}'.format(get_canonical_isbn(isbn))
+    query = 'title:{}'.format(' '.join(title.lower().split()))
+    if author:
+        query += '|author:{}'.format(' '.join(author.lower().split()))
+    return query
+
+
+# Lines of the log of `fetch-ebook-metadata` (stderr) showing that a source
+# failed (e.g. throttling) rather than found nothing
+FETCH_ERROR_REGEX = re.compile(r'Traceback|timed out|HTTP Error|Too Many Requests|\bfailed\b', re.I)
+
+_fetch_scheduler = None
+_fetch_scheduler_lock = threading.Lock()
+
+
+# Returns the scheduler of the metadata fetches (rate limits and circuit
+# breakers of the sources), configured from the `isbn_metadata_fetch_*`
+# options
+def get_fetch_scheduler():
+    global _fetch_scheduler
+    with _fetch_scheduler_lock:
+        if _fetch_scheduler is None:
+            options = config.config_dict['general-options']
+            rate_limits = {}
+            for rate_limit in filter(None, str(options['isbn_metadata_fetch_rate_limits']).split(',')):
+                source, _, value = rate_limit.rpartition(':')
+                rate_limits[source.strip()] = float(value)
+            _fetch_scheduler = FetchScheduler(rate_limits, options['isbn_metadata_fetch_rate_limit'],
+                                              options['isbn_metadata_fetch_circuit_failures'],
+                                              options['isbn_metadata_fetch_circuit_cooldown'])
+        return _fetch_scheduler
+
+
+# Returns the sources of `isbn_metadata_fetch_order` (e.g. 'Amazon.com' or
+# '"WorldCat xISBN"'), sorted by the success rate observed in this run if
+# `isbn_metadata_fetch_reorder` is enabled
+def get_fetch_order(isbn_sources):
+    if not config.config_dict['general-options']['isbn_metadata_fetch_reorder']:
+        return isbn_sources
+    return get_fetch_scheduler().order(isbn_sources, key=lambda source: source.strip().strip('"'))
+
+
+# Same as fetch_metadata() but the call waits for the rate limit of the
+# sources and is skipped (no metadata, `returncode` is None) if their circuit
+# is open, i.e. they failed too many times in a row. The rate limit is waited
+# for before taking one of the `isbn_metadata_fetch_max_concurrent` slots, so
+# that a throttled source doesn't hold a slot while it waits. The outcome
+# (SUCCESS, EMPTY, FAILURE or CANCELLED, None if the call was skipped) and
+# latency of the call are recorded by the scheduler, and the outcome is also
+# returned as `result.outcome`
+def fetch_metadata_scheduled(isbn_sources, options='', timeout=None, cancel_event=None):
+    scheduler = get_fetch_scheduler()
+    source = ','.join(s.strip().strip('"') for s in isbn_sources.split(','))
+    if not scheduler.acquire(source, cancel_event):
+        if cancel_event is None or not cancel_event.is_set():
+            logger.info('Skipping {}: too many failures, it is cooling down'.format(source))
+        result = convert_result_from_shell_cmd(
+            subprocess.CompletedProcess(['fetch-ebook-metadata', source], None, '', 'skipped'))
+        result.outcome = None
+        return result
+    start = time.time()
+    outcome = FAILURE
+    try:
+        result = fetch_metadata(isbn_sources, options, timeout, cancel_event)
+        if result.stdout:
+            outcome = SUCCESS
+        elif cancel_event is not None and cancel_event.is_set():
+            outcome = CANCELLED
+        elif result.returncode is None or result.returncode < 0:
+            # Killed after the timeout
+            outcome = FAILURE
+        elif not FETCH_ERROR_REGEX.search(str(result.stderr)):
+            outcome = EMPTY
+        result.outcome = outcome
+        return result
+    finally:
+        scheduler.record(source, outcome, time.time() - start)
+
+
+def log_fetch_stats():
+    if _fetch_scheduler is None:
+        return
+    for source, stats in sorted(_fetch_scheduler.stats().items()):
+        logger.info('{}: {} calls, {} with metadata, {} failed, {} skipped, success rate: {:.1%}, '
+                    'mean latency: {:.2f} s (max: {:.2f} s){}'.format(
+                        source, stats['calls'], stats['successes'], stats['failures'], stats['skipped'],
+                        stats['success_rate'], stats['mean_latency'], stats['max_latency'],
+                        ', cooling down' if stats['open'] else ''))
+
+
+# Same as fetch_metadata_scheduled() but the results are looked up first in the
+# metadata cache by `query` (see get_metadata_query()) and the sources. Only
+# the metadata found and the answers "no metadata" (EMPTY) are cached: the
+# fetches that failed (errors, throttling, timeouts), were cancelled or were
+# skipped are not since the source might have found metadata.
+def fetch_metadata_cached(isbn_sources, options, query, timeout=None, cancel_event=None):
+    metadata_cache = get_metadata_cache()
+    if metadata_cache is None or query is None:
+        return fetch_metadata_scheduled(isbn_sources, options, timeout, cancel_event)
+    # e.g. '"WorldCat xISBN"' -> 'WorldCat xISBN'
+    source = ','.join(s.strip().strip('"') for s in isbn_sources.split(','))
+    metadata = metadata_cache.get(query, source)
+    if metadata is not None:
+        logger.info('Found cached {}result for {} from {}'.format('' if metadata else 'negative ', query, source))
+        result = convert_result_from_shell_cmd(
+            subprocess.CompletedProcess(['metadata_cache', query, source], 0, metadata, ''))
+        result.outcome = SUCCESS if metadata else EMPTY
+        return result
+    result = fetch_metadata_scheduled(isbn_sources, options, timeout, cancel_event)
+    if result.outcome == SUCCESS:
+        metadata_cache.put(query, source, str(result.stdout))
+    elif result.outcome == EMPTY:
+        metadata_cache.put(query, source, '')
+    return result
+
+
+# Queries all the `isbn_sources` (in order of priority) at the same time with
+# the `fetch-ebook-metadata` options and returns a tuple `(result, source)`
+# with the metadata of the highest-priority source that found some: once a
+# source returns metadata, the fetches of the sources coming after it in
+# `isbn_sources` are cancelled and the ones coming before it are waited for.
+# Returns `(None, None)` if no metadata is found.
+# The metadata cache is used if `query` is given, see fetch_metadata_cached()
+def fetch_metadata_concurrently(isbn_sources, options='', query=None):
+    cancel_events = [threading.Event() for _ in isbn_sources]
+
+    def fetch(i):
+        if cancel_events[i].is_set():
+            return None
+        return fetch_metadata_cached(isbn_sources[i], options, query, get_fetch_timeout(isbn_sources[i]),
+                                     cancel_events[i])
+
+    def get_result(future):
+        try:
+            result = future.result()
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.info('Could not fetch metadata from {}: {}'.format(isbn_sources[futures[future]], e))
+            return None
+        return result if result is not None and result.stdout else None
+
+    logger.info('Fetching metadata from {} concurrently...'.format(', '.join(isbn_sources)))
+    executor = ThreadPoolExecutor(max_workers=len(isbn_sources))
+    best_index, best_result = None, None
+    try:
+        futures = {executor.submit(fetch, i): i for i in range(len(isbn_sources))}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = get_result(future)
+                if result is not None and (best_index is None or futures[future] < best_index):
+                    best_index, best_result = futures[future], result
+            if best_index is None:
+                continue
+            # Only the sources with a higher priority can still give a better
+            # answer
+            for future in pending:
+                if futures[future] > best_index:
+                    cancel_events[futures[future]].set()
+                    future.cancel()
+            pending = set(future for future in pending if futures[future] < best_index)
+            if pending:
+                logger.info('Got metadata from {}, waiting for {}'.format(
+                    isbn_sources[best_index], ', '.join(isbn_sources[futures[f]] for f in sorted(
+                        pending, key=futures.get))))
+        if best_index is None:
+            return None, None
+        logger.info('Using the metadata from {}'.format(isbn_sources[best_index]))
+        return best_result, isbn_sources[best_index]
+    finally:
+        # The running fetches are killed by their thread once they see that
+        # their cancel event is set, there is no need to wait for them
+        for cancel_event in cancel_events:
+            cancel_event.set()
+        executor.shutdown(wait=False)
+
+
 class ReorderFilesAction(argparse.Action):
     def __init__(self, option_strings, dest, nargs=None, **kwargs):
         if nargs is not None:
@@ -1046,14 +3064,44 @@ def handle_script_arg(parser):
     parser.add_argument('--isbn-direct-grep-files', default='^(text/(plain|xml|html)|application/xml)$')
     parser.add_argument('--isbn-ignored-files', default='^(image/(gif|svg.+)|application/(x-shockwave-flash|CDFV2|vnd.ms-opentype|x-font-ttf|x-dosexec|vnd.ms-excel|x-java-applet)|audio/.+|video/.+)$')
     parser.add_argument('--reorder-files-for-grep', default='True, 400, 50', action=ReorderFilesAction)
+    parser.add_argument('-ise', '--isbn-stream-extraction', action='store_true')
+    parser.add_argument('--isbn-grep-rf-first-last-pages', default='10,5')
+    parser.add_argument('--isbn-archive-extract-all', action='store_true')
+    parser.add_argument('--isbn-archive-max-extracted-mib', default=256, type=int)
+    parser.add_argument('--isbn-archive-max-members', default=1000, type=int)
+    parser.add_argument('--isbn-archive-max-depth', default=3, type=int)
+    parser.add_argument('--isbn-archive-jobs', default=4, type=int)
     parser.add_argument('-ocr', '--ocr-enabled', action='store_true')
     parser.add_argument('-ocrop', '--ocr-only-first-last-pages', default='7,3')
     parser.add_argument('-ocrc', '--ocr-command', default='tesseract_wrapper')
+    parser.add_argument('-ocrj', '--ocr-jobs', default=1, type=int)
+    parser.add_argument('--ocr-cache-enabled', action='store_true')
+    parser.add_argument('--ocr-cache-path', default='database/ocr_cache.sqlite')
+    parser.add_argument('--ocr-cache-max-size-mib', default=512, type=int)
+    parser.add_argument('--metadata-cache-enabled', action='store_true')
+    parser.add_argument('--metadata-cache-path', default='database/metadata_cache.sqlite')
+    parser.add_argument('--metadata-cache-ttl-days', default=90, type=int)
+    parser.add_argument('--metadata-cache-negative-ttl-days', default=7, type=int)
+    parser.add_argument('--metadata-index-enabled', action='store_true')
+    parser.add_argument('--metadata-index-path', default='database/metadata_index.sqlite')
+    parser.add_argument('--metadata-index-min-score', default=0.6, type=float)
+    parser.add_argument('-ic', '--isbn-cache-enabled', action='store_true')
+    parser.add_argument('--isbn-cache-path', default='database/isbn_cache.sqlite')
+    parser.add_argument('--isbn-cache-ignore-negative', action='store_true')
 
     parser.add_argument('--token-min-length', default=3, type=int)
     parser.add_argument('--tokens-to-ignore', default='ebook|book|novel|series|ed(ition)?|vol(ume)?|${RE_YEAR}')
 
     parser.add_argument('-imfo', '--isbn-metadata-fetch-order', default='Goodreads,Amazon.com,Google,ISBNDB,WorldCat xISBN,OZON.ru')
+    parser.add_argument('--isbn-metadata-fetch-concurrent', action='store_true')
+    parser.add_argument('--isbn-metadata-fetch-timeout', default=60, type=int)
+    parser.add_argument('--isbn-metadata-fetch-source-timeouts', default='')
+    parser.add_argument('--isbn-metadata-fetch-max-concurrent', default=8, type=int)
+    parser.add_argument('--isbn-metadata-fetch-rate-limit', default=0, type=float)
+    parser.add_argument('--isbn-metadata-fetch-rate-limits', default='')
+    parser.add_argument('--isbn-metadata-fetch-circuit-failures', default=3, type=int)
+    parser.add_argument('--isbn-metadata-fetch-circuit-cooldown', default=300, type=int)
+    parser.add_argument('--isbn-metadata-fetch-reorder', action='store_true')
     parser.add_argument('-owis', '--organize-without-isbn-sources', default='Goodreads,Amazon.com,Google')
     # TODO: add argument FILE_SORT_FLAGS
     # parser.add_argument('-fsf', '--file-sort-flags', default='')
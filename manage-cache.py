@@ -0,0 +1,115 @@
+"""
+Show stats about, invalidate and warm the on-disk caches used by organize-ebooks
+"""
+import argparse
+import os
+import sys
+
+import config
+
+from config import init_config
+from lib import warm_metadata_cache, ISBN_SEARCH_STEPS
+from utils.cache import IsbnCache, MetadataCache, OcrCache
+
+
+def isbn_cache_stats(isbn_cache):
+    stats = isbn_cache.stats()
+    print('Entries\t\t: {}'.format(stats['entries']))
+    print('With ISBNs\t: {}'.format(stats['positive']))
+    print('Without ISBNs\t: {}'.format(stats['negative']))
+    for step, count in sorted(stats['steps'].items()):
+        print('  found by {}\t: {}'.format(step, count))
+
+
+def isbn_cache_invalidate(isbn_cache, negative_only, step):
+    count = isbn_cache.invalidate(negative_only=negative_only, step=step)
+    print('Removed {} entries from the ISBN cache'.format(count))
+
+
+def ocr_cache_stats(ocr_cache):
+    stats = ocr_cache.stats()
+    print('Pages\t\t: {}'.format(stats['entries']))
+    print('Documents\t: {}'.format(stats['documents']))
+    print('Size\t\t: {:.1f} MiB (max: {:.1f} MiB)'.format(stats['size'] / 1024 / 1024,
+                                                      stats['max_size'] / 1024 / 1024))
+
+
+def metadata_cache_stats(metadata_cache):
+    stats = metadata_cache.stats()
+    print('Entries\t\t: {}'.format(stats['entries']))
+    print('With metadata\t: {}'.format(stats['positive']))
+    print('Without metadata: {}'.format(stats['negative']))
+    print('Expired\t\t: {}'.format(stats['expired']))
+    for source, count in sorted(stats['sources'].items()):
+        print('  from {}\t: {}'.format(source, count))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the caches used by organize-ebooks')
+    parser.add_argument('-c', '--config-path', default=os.path.join(os.getcwd(), 'config.yaml'))
+    subparsers = parser.add_subparsers(dest='cache')
+
+    isbn_parser = subparsers.add_parser('isbn', help='Cache of the ISBN search results')
+    isbn_parser.add_argument('--path', help='Path of the cache (default: isbn_cache_path from the config)')
+    isbn_parser.add_argument('action', choices=['stats', 'invalidate'])
+    isbn_parser.add_argument('--negative-only', action='store_true',
+                             help='Only invalidate entries where no ISBNs were found')
+    isbn_parser.add_argument('--step', choices=ISBN_SEARCH_STEPS,
+                             help='Only invalidate entries whose ISBNs were found by this step')
+
+    ocr_parser = subparsers.add_parser('ocr', help='Cache of the OCR-ed pages')
+    ocr_parser.add_argument('--path', help='Path of the cache (default: ocr_cache_path from the config)')
+    ocr_parser.add_argument('action', choices=['stats', 'invalidate'])
+
+    metadata_parser = subparsers.add_parser('metadata', help='Cache of the metadata fetched from online sources')
+    metadata_parser.add_argument('--path', help='Path of the cache (default: metadata_cache_path from the config)')
+    metadata_parser.add_argument('action', choices=['stats', 'invalidate', 'warm'])
+    metadata_parser.add_argument('--negative-only', action='store_true',
+                                 help='Only invalidate entries where no metadata was found')
+    metadata_parser.add_argument('--expired-only', action='store_true', help='Only invalidate expired entries')
+    metadata_parser.add_argument('--source', help='Only invalidate entries from this source')
+    metadata_parser.add_argument('--folder', help='Folder with the metadata files (.meta) of organized books, '
+                                                  'used to warm the cache')
+
+    args = parser.parse_args()
+    if args.cache is None:
+        parser.print_help()
+        sys.exit(1)
+
+    init_config(args.config_path)
+    if config.config_dict is None:
+        sys.exit(1)
+
+    if args.cache == 'isbn':
+        cache = IsbnCache(args.path or config.config_dict['general-options']['isbn_cache_path'])
+        if args.action == 'stats':
+            isbn_cache_stats(cache)
+        else:
+            isbn_cache_invalidate(cache, args.negative_only, args.step)
+        cache.close()
+    elif args.cache == 'ocr':
+        cache = OcrCache(args.path or config.config_dict['general-options']['ocr_cache_path'],
+                         max_size=config.config_dict['general-options']['ocr_cache_max_size_mib'] * 1024 * 1024)
+        if args.action == 'stats':
+            ocr_cache_stats(cache)
+        else:
+            print('Removed {} pages from the OCR cache'.format(cache.invalidate()))
+        cache.close()
+    elif args.cache == 'metadata':
+        cache = MetadataCache(args.path or config.config_dict['general-options']['metadata_cache_path'],
+                              ttl=config.config_dict['general-options']['metadata_cache_ttl_days'] * 24 * 3600,
+                              negative_ttl=config.config_dict['general-options']['metadata_cache_negative_ttl_days']
+                              * 24 * 3600)
+        if args.action == 'stats':
+            metadata_cache_stats(cache)
+        elif args.action == 'invalidate':
+            count = cache.invalidate(args.negative_only, args.expired_only, args.source)
+            print('Removed {} entries from the metadata cache'.format(count))
+        elif args.folder is None:
+            print('--folder is required to warm the cache')
+            cache.close()
+            sys.exit(1)
+        else:
+            print('Added {} entries to the metadata cache'.format(warm_metadata_cache(cache, args.folder)))
+        cache.close()
+    sys.exit(0)
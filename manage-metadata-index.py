@@ -0,0 +1,105 @@
+"""
+Import bulk bibliographic dumps into the offline metadata index used by
+organize-ebooks, show how many books and ISBNs it covers and search it by title
+and author
+"""
+import argparse
+import os
+import sys
+import time
+
+import config
+
+from config import init_config
+from lib import find_isbns, get_canonical_isbn, import_metadata_dump, reindex_metadata_index, tokenize
+from utils.metadata_index import MetadataIndex, BOOK_FIELDS
+
+
+def metadata_index_stats(metadata_index):
+    stats = metadata_index.stats()
+    print('Books\t\t: {}'.format(stats['books']))
+    print('ISBNs\t\t: {}'.format(stats['isbns']))
+    print('Authors\t\t: {}'.format(stats['authors']))
+    print('Tokens\t\t: {} (in the titles and authors of {} books)'.format(stats['tokens'], stats['indexed_books']))
+    for column, field in BOOK_FIELDS:
+        if column != 'title':
+            count = stats['with_{}'.format(column)]
+            print('  with {}\t: {} ({:.1%})'.format(field, count, count / stats['books'] if stats['books'] else 0))
+    for dump in stats['dumps']:
+        print('Dump {}: {} books out of {} records ({} skipped), imported on {}'.format(
+            dump['dump'], dump['books'], dump['records'], dump['skipped'],
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(dump['imported']))))
+
+
+def metadata_index_coverage(metadata_index, file_paths):
+    isbns = set()
+    for file_path in file_paths:
+        with open(file_path, 'r', errors='replace') as f:
+            found = find_isbns(f.read())
+        separator = config.config_dict['find-isbns']['isbn_ret_separator']
+        isbns.update(get_canonical_isbn(isbn) for isbn in found.split(separator) if isbn)
+    found = metadata_index.coverage(isbns)
+    print('{} of the {} ISBNs are indexed ({:.1%})'.format(found, len(isbns), found / len(isbns) if isbns else 0))
+
+
+def metadata_index_search(metadata_index, text):
+    tokens = tokenize(text).split()
+    print('Tokens: {}'.format(' '.join(tokens)))
+    for score, book_id in metadata_index.search(tokens):
+        print('\nScore: {:.2f}'.format(score))
+        print(metadata_index.get_by_id(book_id).rstrip())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the offline metadata index used by organize-ebooks')
+    parser.add_argument('-c', '--config-path', default=os.path.join(os.getcwd(), 'config.yaml'))
+    parser.add_argument('--path', help='Path of the index (default: metadata_index_path from the config)')
+    subparsers = parser.add_subparsers(dest='action')
+
+    import_parser = subparsers.add_parser(
+        'import', help='Import dumps of JSON records (one per line, optionally gzipped), e.g. the OpenLibrary '
+                       'authors and editions dumps. Import the authors first')
+    import_parser.add_argument('dump_paths', nargs='+', metavar='dump')
+    import_parser.add_argument('--name', help='Name of the dump (default: its filename). A dump imported again '
+                                              'under the same name replaces the previous import')
+
+    subparsers.add_parser('stats', help='Number of books, ISBNs and fields in the index')
+
+    coverage_parser = subparsers.add_parser(
+        'coverage', help='Fraction of the ISBNs found in the given files (e.g. lists of ISBNs or metadata files) '
+                         'that are indexed')
+    coverage_parser.add_argument('file_paths', nargs='+', metavar='file')
+
+    subparsers.add_parser('reindex', help='Rebuild the index of the title and author tokens, e.g. after changing '
+                                          'token_min_length or tokens_to_ignore')
+
+    search_parser = subparsers.add_parser('search', help='Show the books best matching a title, author or filename')
+    search_parser.add_argument('text')
+
+    args = parser.parse_args()
+    if args.action is None:
+        parser.print_help()
+        sys.exit(1)
+    if args.action == 'import' and args.name and len(args.dump_paths) > 1:
+        parser.error('--name can only be used when importing one dump')
+
+    init_config(args.config_path)
+    if config.config_dict is None:
+        sys.exit(1)
+
+    index = MetadataIndex(args.path or config.config_dict['general-options']['metadata_index_path'])
+    if args.action == 'import':
+        for dump_path in args.dump_paths:
+            start = time.time()
+            records, books, skipped = import_metadata_dump(index, dump_path, args.name)
+            print('Imported {} books from the {} records of {} ({} skipped) in {:.1f} s'.format(
+                books, records, dump_path, skipped, time.time() - start))
+    elif args.action == 'stats':
+        metadata_index_stats(index)
+    elif args.action == 'reindex':
+        print('Indexed the titles and authors of {} books'.format(reindex_metadata_index(index)))
+    elif args.action == 'search':
+        metadata_index_search(index, args.text)
+    else:
+        metadata_index_coverage(index, args.file_paths)
+    index.close()
@@ -1,20 +1,25 @@
-import ipdb
 import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import logging
 import os
 import re
 import tempfile
 import textwrap
+import threading
 import sys
 
 import config
 
 from config import check_comma_options, expand_folder_paths, init_config, update_config_from_arg_groups
-from lib import check_file_for_corruption, fetch_metadata, find_isbns, get_ebook_metadata, get_file_size, \
-    get_mime_type, get_pages_in_pdf, get_without_isbn_ignore, handle_script_arg, move_or_link_ebook_file_and_metadata, \
-    move_or_link_file, remove_file, search_file_for_isbns, search_meta_val, unique_filename, \
-    GREEN, NC, RED, VERSION
+from lib import check_file_for_corruption, fetch_metadata_cached, fetch_metadata_concurrently, find_isbns, \
+    get_fetch_order, get_fetch_timeout, get_indexed_metadata, get_metadata_query, get_without_isbn_ignore, \
+    handle_script_arg, log_cache_stats, log_extractor_stats, log_fetch_stats, log_probe_stats, \
+    move_or_link_ebook_file_and_metadata, move_or_link_file, remove_file, search_file_for_isbns, \
+    search_indexed_metadata, search_meta_val, tokenize, unique_filename, \
+    FileProbe, GREEN, METADATA_INDEX_SOURCE, NC, RED, VERSION
 from utils.gen import get_full_exception, setup_logging
+from utils.journal import Journal
+from utils.pipeline import Pipeline
 
 
 # Get the logger
@@ -27,29 +32,114 @@ else:
     logger = logging.getLogger('{}.{}'.format(os.path.basename(os.path.dirname(__file__)), __name__))
 
 
+# Serializes the per-file reports from fail_file(), ok_file() and skip_file()
+# so that they don't interleave when files are organized by several workers
+_print_lock = threading.Lock()
+
+# Journal of the state transitions of the organized files (see
+# `journal_path`), None if disabled
+journal = None
+
+
+# Returns the size and modification time of a file (empty if it doesn't exist
+# anymore, e.g. once moved), recorded in the journal to detect the files that
+# were replaced since the run being resumed
+def get_file_signature(file_path):
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return {}
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def journal_record(file_path, stage, **data):
+    if journal is not None:
+        journal.record(file_path, stage, **dict(get_file_signature(file_path), **data))
+
+
+# Returns True if we are resuming a previous run and the file already reached
+# the given stage in that run. A file whose size or modification time changed
+# since then is a new file
+def resumed_stage(file_path, stage):
+    return config.config_dict['organize-ebooks']['resume'] and journal is not None \
+        and journal.reached(file_path, stage, **get_file_signature(file_path))
+
+
+# Returns True if we are resuming a previous run and the file was already
+# organized in that run: moved (or linked) to a path that still exists, or
+# done without a move (e.g. skipped)
+def resumed_organized(file_path):
+    if not resumed_stage(file_path, 'moved'):
+        return False
+    new_path = journal.get_state(file_path).get('new_path')
+    return not new_path or os.path.lexists(new_path)
+
+
+# Returns the path of the temporary metadata file fetched for `file_path` in a
+# previous run, if it can be reused to resume the file at the move stage
+def get_resumable_metadata(file_path):
+    if not resumed_stage(file_path, 'metadata_fetched') or resumed_stage(file_path, 'moved'):
+        return None
+    state = journal.get_state(file_path)
+    tmp_file = state.get('tmp_file')
+    if tmp_file in state['tmp_files'] and os.path.isfile(tmp_file):
+        return tmp_file
+    return None
+
+
+# Removes the temporary metadata files left by an interrupted run, except the
+# ones that can be reused to resume their files
+def cleanup_journal_tmp_files():
+    for file_path, tmp_file in journal.stale_tmp_files():
+        if config.config_dict['organize-ebooks']['resume'] and get_resumable_metadata(file_path) == tmp_file:
+            logger.info('Keeping temp file {} to resume {}'.format(tmp_file, file_path))
+            continue
+        if os.path.isfile(tmp_file):
+            logger.info('Removing stale temp file {}...'.format(tmp_file))
+            remove_file(tmp_file)
+        journal_record(file_path, 'tmp_file_removed', tmp_file=tmp_file)
+
+
+# Reports a file whose organization raised an unexpected error, the other files
+# are still organized.
+# NOTE: get_full_exception() relies on sys.exc_info(), i.e. must be called from
+# the `except` block
+def fail_file_with_exception(file_path, e):
+    err_msg = get_full_exception(error=e, to_print=False)
+    logger.error('Could not organize {}: {}'.format(file_path, err_msg), exc_info=True)
+    journal_record(file_path, 'failed', error=err_msg)
+    fail_file(file_path, 'Unexpected error: {}'.format(err_msg))
+
+
 def fail_file(old_path, reason, new_path=None):
     # More info about printing in terminal with color: https://stackoverflow.com/a/21786287
     first_two_lines = '\n{}ERR{}\t: {}\n' \
                       'REASON\t: {}\n'.format(RED, NC, old_path, reason)
     if new_path is None:
-        print(first_two_lines)
+        msg = first_two_lines
     else:
         third_line = 'TO\t: {}\n'.format( new_path)
-        print(first_two_lines + third_line)
+        msg = first_two_lines + third_line
+    with _print_lock:
+        print(msg)
 
 
 def ok_file(file_path, reason):
-    print('\n{}OK{}\t: {}\n'
-          'TO\t: {}\n'.format(GREEN, NC, file_path, reason))
+    with _print_lock:
+        print('\n{}OK{}\t: {}\n'
+              'TO\t: {}\n'.format(GREEN, NC, file_path, reason))
 
 
 def skip_file(old_path, new_path):
     # TODO: https://bit.ly/2rf38f5
-    print('\nSKIP\t: {}\n'
-          'REASON\t: {}\n'.format(old_path, new_path))
+    with _print_lock:
+        print('\nSKIP\t: {}\n'
+              'REASON\t: {}\n'.format(old_path, new_path))
 
 
-def is_pamphlet(file_path):
+def is_pamphlet(file_path, probe=None):
+    if probe is None:
+        probe = FileProbe(file_path)
     logger.info('Checking whether {} looks like a pamphlet...'.format(file_path))
     # TODO: check that it does the same as to_lower() @ https://bit.ly/2w0O5LN
     lowercase_name = os.path.basename(file_path).lower()
@@ -94,8 +184,8 @@ def is_pamphlet(file_path):
 
     logger.info('The file does not match the pamphlet exclude regex, continuing...')
 
-    mime_type = get_mime_type(file_path)
-    file_size_KiB = get_file_size(file_path, unit='KiB')
+    mime_type = probe.get_mime_type()
+    file_size_KiB = probe.get_file_size(unit='KiB')
     if file_size_KiB is None:
         logger.error('Could not get the file size (KiB) for {}'.format(file_path))
         return None
@@ -104,8 +194,7 @@ def is_pamphlet(file_path):
     if mime_type == 'application/pdf':
         logger.info('The file looks like a pdf, checking if the number of pages '
                     'is larger than {} ...'.format(pamphlet_max_pdf_pages))
-        result = get_pages_in_pdf(file_path)
-        pages = result.stdout
+        pages = probe.get_page_count()
 
         if pages is None:
             logger.error('Could not get the number of pages for {}'.format(file_path))
@@ -127,7 +216,9 @@ def is_pamphlet(file_path):
 
 
 # Arguments: path, reason (optional)
-def organize_by_filename_and_meta(old_path, prev_reason):
+def organize_by_filename_and_meta(old_path, prev_reason, probe=None):
+    if probe is None:
+        probe = FileProbe(old_path)
     prev_reason = '{}; '.format(prev_reason)
     logger.info('Organizing {} by non-ISBN metadata and filename...'.format(old_path))
     # TODO: check that it does the same as to_lower() @ https://bit.ly/2w0O5LN
@@ -152,7 +243,7 @@ def organize_by_filename_and_meta(old_path, prev_reason):
     else:
         logger.info('File does not match the ignore regex, continuing...')
 
-    is_p = is_pamphlet(old_path)
+    is_p = is_pamphlet(old_path, probe)
     if is_p is True:
         logger.info('File {} looks like a pamphlet!'.format(old_path))
         output_folder_pamphlets = config.config_dict['organize-ebooks']['output_folder_pamphlets']
@@ -174,14 +265,13 @@ def organize_by_filename_and_meta(old_path, prev_reason):
     else:
         logger.debug("Couldn't determine if file {} is a pamphlet".format(old_path))
 
-    ipdb.set_trace()
     output_folder_uncertain = config.config_dict['organize-ebooks']['output_folder_uncertain']
     if not output_folder_uncertain:
         logger.info('No uncertain folder specified, skipping...')
         skip_file(old_path, 'No uncertain folder specified')
         return
 
-    result = get_ebook_metadata(old_path)
+    result = probe.get_ebook_metadata()
     if result.stderr:
         logger.error('`ebook-meta` returns an error: '.format(result.error))
     ebookmeta = result.stdout
@@ -196,15 +286,15 @@ def organize_by_filename_and_meta(old_path, prev_reason):
         logger.info('Adding additional metadata to the end of the metadata file...')
         more_metadata = 'Old file path       : {}\n' \
                         'Meta fetch method   : {}\n'.format(old_path, fetch_method)
-        lines = ''
+        # The fields of the original metadata are prefixed with 'OF', e.g.
+        # 'OF Title            : ...'
+        lines = []
         for line in ebookmeta.splitlines():
-            # TODO: remove next line if simpler version does the same thing
-            #lines.append(re.sub('^(.+[^ ]) ([ ]+):', 'OF \1 \2', line))
-            lines.append(re.sub('^(.+)( +):', 'OF \1 \2', line))
-        ebookmeta = '\n'.join(lines)
+            lines.append(re.sub(r'^(.+[^ ]) ([ ]+):', r'OF \1 \2:', line))
+        original_metadata = ''.join('{}\n'.format(line) for line in lines)
         with open(tmpmfile, 'a') as f:
             f.write(more_metadata)
-            f.write(ebookmeta)
+            f.write(original_metadata)
 
         isbn = find_isbns(more_metadata)
         if isbn:
@@ -218,8 +308,23 @@ def organize_by_filename_and_meta(old_path, prev_reason):
         ok_file(old_path, new_path)
 
     # TODO: get title and author from `ebook-meta`
-    title = search_meta_val(ebookmeta, 'Title')
-    author = search_meta_val(ebookmeta, 'Author')
+    title = search_meta_val(ebookmeta, 'Title') or ''
+    author = search_meta_val(ebookmeta, 'Author(s)') or ''
+
+    # The title and author from the ebook metadata, then the filename, are
+    # first searched in the offline metadata index: the online sources are only
+    # queried if no indexed book matches them
+    guesses = []
+    if re.sub(r'[^A-Za-z]', '', title) != '' and title != 'unknown':
+        guesses.append(('index-title&author', '{} {}'.format(title, author if author != 'unknown' else '')))
+    guesses.append(('index-filename', os.path.splitext(os.path.basename(old_path))[0]))
+    for fetch_method, guess in guesses:
+        metadata = search_indexed_metadata(guess)
+        if metadata:
+            with open(tmpmfile, 'a') as f:
+                f.write(metadata)
+            finisher(fetch_method)
+            return
 
     # Equivalent to (in bash):
     # if [[ "${title//[^[:alpha:]]/}" != "" && "$title" != "unknown" ]]
@@ -233,7 +338,8 @@ def organize_by_filename_and_meta(old_path, prev_reason):
             logger.info('Trying to fetch metadata by title {} and author {}...'.format(title, author))
             options = '--verbose --title="{}" --author="{}"'.format(title, author)
             # TODO: check that fetch_metadata() can also return an empty string
-            metadata = fetch_metadata(config.config_dict['general-options']['organize_without_isbn_sources'], options)
+            metadata = fetch_metadata_cached(config.config_dict['general-options']['organize_without_isbn_sources'], options,
+                                             get_metadata_query(title=title, author=author)).stdout
             if metadata:
                 # TODO: they are writing outside the if, https://bit.ly/2FyIiwh
                 with open(tmpmfile, 'a') as f:
@@ -243,7 +349,8 @@ def organize_by_filename_and_meta(old_path, prev_reason):
                 return
             logger.info('Trying to swap places - author {} and title {}...'.format(title, author))
             options = '--verbose --title="{}" --author="{}"'.format(author, title)
-            metadata = fetch_metadata(config.config_dict['general-options']['organize_without_isbn_sources'], options)
+            metadata = fetch_metadata_cached(config.config_dict['general-options']['organize_without_isbn_sources'], options,
+                                             get_metadata_query(title=author, author=title)).stdout
             if metadata:
                 # TODO: they are writing outside the if, https://bit.ly/2Kt78kX
                 with open(tmpmfile, 'a') as f:
@@ -254,7 +361,8 @@ def organize_by_filename_and_meta(old_path, prev_reason):
 
             logger.info('Trying to fetch metadata only by title {}...'.format(title))
             options = '--verbose --title="{}"'.format(title)
-            metadata = fetch_metadata(config.config_dict['general-options']['organize_without_isbn_sources'], options)
+            metadata = fetch_metadata_cached(config.config_dict['general-options']['organize_without_isbn_sources'], options,
+                                             get_metadata_query(title=title)).stdout
             if metadata:
                 # TODO: they are writing outside the if, https://bit.ly/2vZeFES
                 with open(tmpmfile, 'a') as f:
@@ -263,18 +371,19 @@ def organize_by_filename_and_meta(old_path, prev_reason):
                 finisher('title')
                 return
 
-    # TODO: tokenize basename
+    # Equivalent to (in bash):
     # filename="$(basename "${old_path%.*}" | tokenize)"
     # ref.: https://bit.ly/2jlyBIR
-    filename = os.path.splitext(os.path.basename(old_path))[0]
+    filename = tokenize(os.path.splitext(os.path.basename(old_path))[0])
     logger.info('Trying to fetch metadata only the filename {}...'.format(filename))
     options = '--verbose --title="{}"'.format(filename)
-    metadata = fetch_metadata(config.config_dict['general-options']['organize_without_isbn_sources'], options)
+    metadata = fetch_metadata_cached(config.config_dict['general-options']['organize_without_isbn_sources'], options,
+                                     get_metadata_query(title=filename)).stdout
     if metadata:
         # TODO: they are writing outside the if, https://bit.ly/2I3GH6X
         with open(tmpmfile, 'a') as f:
             # TODO: do we write even if metadata can be empty?
-            f.write(filename)
+            f.write(metadata)
         finisher('title')
         return
 
@@ -285,117 +394,397 @@ def organize_by_filename_and_meta(old_path, prev_reason):
 
 
 # Sequentially tries to fetch metadata for each of the supplied ISBNs; if any
-# is found, writes it to a tmp.txt file and calls organize_known_ebook()
+# is found, writes it to a tmp.txt file and returns the path of this file.
+# Otherwise, returns None
+# The offline metadata index is searched first (see `metadata_index_enabled`).
+# Then the sources of `isbn_metadata_fetch_order` are queried one after the other,
+# or all at the same time if `isbn_metadata_fetch_concurrent` is enabled. The
+# sources that failed too many times in a row are skipped for a while (see
+# fetch_metadata_scheduled())
 # Arguments: path, isbns (comma-separated)
-# TODO: in their description, they refer to `organize_known_ebook` but it should
-# be `move_or_link_ebook_file_and_metadata`, ref.: https://bit.ly/2HNv3x0
-def organize_by_isbns(file_path, isbns):
+def fetch_metadata_by_isbns(file_path, isbns):
     isbn_sources = config.config_dict['general-options']['isbn_metadata_fetch_order']
     isbn_sources = isbn_sources.split(',')
-    for isbn in isbns.split(','):
+    # Check if there are spaces in the arguments, and if it is the case
+    # enclose the arguments in quotation marks
+    # Remove whitespaces around the isbn sources
+    isbn_sources = ['"{}"'.format(s.strip()) if ' ' in s.strip() else s.strip() for s in isbn_sources]
+    # The online sources are only queried if none of the ISBNs is in the
+    # offline metadata index
+    indexed_isbn, indexed_metadata = get_indexed_metadata(isbns)
+    for isbn in [indexed_isbn] if indexed_metadata else isbns.split(','):
         tmp_file = tempfile.mkstemp(suffix='.txt')[1]
+        journal_record(file_path, 'tmp_file_created', tmp_file=tmp_file)
         logger.info('Trying to fetch metadata for ISBN {} into temp file {}...'.format(isbn, tmp_file))
 
-        for isbn_source in isbn_sources:
-            # Check if there are spaces in the arguments, and if it is the case
-            # enclose the arguments in quotation marks
-            if ' ' in isbn_source:
-                isbn_source = '"{}"'.format(isbn_source)
-            # Remove whitespaces around the isbn source
-            isbn_source = isbn_source.strip()
-            logger.info('Fetching metadata from {} sources...'.format(isbn_source))
-            options = '--verbose --isbn={}'.format(isbn)
-            result = fetch_metadata(isbn_source, options)
-            metadata = result.stdout
+        options = '--verbose --isbn={}'.format(isbn)
+        query = get_metadata_query(isbn=isbn)
+        isbn_sources = get_fetch_order(isbn_sources)
+        if indexed_metadata:
+            logger.info('Found ISBN {} in the offline metadata index'.format(isbn))
+            fetched = [(METADATA_INDEX_SOURCE, indexed_metadata)]
+        elif config.config_dict['general-options']['isbn_metadata_fetch_concurrent']:
+            result, isbn_source = fetch_metadata_concurrently(isbn_sources, options, query)
+            fetched = [(isbn_source, result.stdout)] if result is not None else []
+        else:
+            fetched = fetch_metadata_sequentially(isbn_sources, options, query)
+        for isbn_source, metadata in fetched:
             # TODO: DEBUGGING to be removed
             # metadata = 'Title               : A Hilbert Space Problem Book\nAuthor(s)           : Paul R. Halmos\nPublisher           : Springer\nLanguages           : eng\nRating              : 2.5\nPublished           : 1967-01-01T00:00:00+00:00\nIdentifiers         : goodreads:851559, isbn:9780387906850\nComments            : <p>From the Preface: "This book was written for the active reader. The first part consists of problems, frequently preceded by definitions and motivation, and sometimes followed by corollaries and historical remarks... The second part, a very short one, consists of hints... The third part, the longest, consists of solutions: proofs, answers, or contructions, depending on the nature of the problem....  </p>\n<p>This is not an introduction to Hilbert space theory. Some knowledge of that subject is a prerequisite: at the very least, a study of the elements of Hilbert space theory should proceed concurrently with the reading of this book."</p>\n'
-            if metadata:
-                with open(tmp_file, 'w') as f:
-                    f.write(metadata)
-                # TODO: is it necessary to sleep after fetching the metadata from
-                # online sources like they do? The code is run sequentially, so
-                # we are executing the rest of the code here once fetch_metadata()
-                # is done, ref.: https://bit.ly/2vV9MfU
-                logger.info('Successfully fetched metadata: ')
-                logger.info(metadata)
-
-                logger.info('Adding additional metadata to the end of the metadata file...')
-                more_metadata = 'ISBN                : {}\n' \
-                                'All found ISBNs     : {}\n' \
-                                'Old file path       : {}\n' \
-                                'Metadata source     : {}'.format(isbn, isbns, file_path, isbn_source)
-                logger.info(more_metadata)
-                with open(tmp_file, 'a') as f:
-                    f.write(more_metadata)
-
-                logger.info('Organizing {} (with {})...'.format(file_path, tmp_file))
-                output_folder = config.config_dict['organize-ebooks']['output_folder']
-                new_path = move_or_link_ebook_file_and_metadata(new_folder=output_folder,
-                                                                current_ebook_path=file_path,
-                                                                current_metadata_path=tmp_file)
-
-                ok_file(file_path, new_path)
-                # NOTE: `tmp_file` was already removed in move_or_link_ebook_file_and_metadata()
-                return
+            with open(tmp_file, 'w') as f:
+                f.write(metadata)
+            # TODO: is it necessary to sleep after fetching the metadata from
+            # online sources like they do? The code is run sequentially, so
+            # we are executing the rest of the code here once fetch_metadata()
+            # is done, ref.: https://bit.ly/2vV9MfU
+            logger.info('Successfully fetched metadata: ')
+            logger.info(metadata)
+
+            logger.info('Adding additional metadata to the end of the metadata file...')
+            more_metadata = 'ISBN                : {}\n' \
+                            'All found ISBNs     : {}\n' \
+                            'Old file path       : {}\n' \
+                            'Metadata source     : {}'.format(isbn, isbns, file_path, isbn_source)
+            logger.info(more_metadata)
+            with open(tmp_file, 'a') as f:
+                f.write(more_metadata)
+            journal_record(file_path, 'metadata_fetched', tmp_file=tmp_file, isbn=isbn, source=isbn_source)
+            return tmp_file
 
         logger.info('Removing temp file {}...'.format(tmp_file))
         remove_file(tmp_file)
-
+        journal_record(file_path, 'tmp_file_removed', tmp_file=tmp_file)
+    return None
+
+
+# Yields the tuples `(source, metadata)` of the sources returning metadata,
+# querying the next source only if the caller asks for it
+def fetch_metadata_sequentially(isbn_sources, options, query=None):
+    for isbn_source in isbn_sources:
+        logger.info('Fetching metadata from {} sources...'.format(isbn_source))
+        result = fetch_metadata_cached(isbn_source, options, query, get_fetch_timeout(isbn_source))
+        if result.stdout:
+            yield isbn_source, result.stdout
+
+
+# Moves (or links) the ebook file to the output folder by using the metadata
+# file returned by fetch_metadata_by_isbns()
+def organize_known_ebook(file_path, metadata_path):
+    logger.info('Organizing {} (with {})...'.format(file_path, metadata_path))
+    output_folder = config.config_dict['organize-ebooks']['output_folder']
+    new_path = move_or_link_ebook_file_and_metadata(new_folder=output_folder,
+                                                    current_ebook_path=file_path,
+                                                    current_metadata_path=metadata_path)
+    ok_file(file_path, new_path)
+    # NOTE: `metadata_path` was already removed in move_or_link_ebook_file_and_metadata()
+    journal_record(file_path, 'tmp_file_removed', tmp_file=metadata_path)
+    journal_record(file_path, 'moved', new_path=new_path)
+
+
+# Called when metadata could not be fetched for any of the found ISBNs
+def organize_without_found_isbns(file_path, isbns, probe=None):
     if config.config_dict['organize-ebooks']['organize_without_isbn']:
         logger.info('Could not organize via the found ISBNs, organizing by filename and metadata instead...')
-        organize_by_filename_and_meta(file_path, 'Could not fetch metadata for ISBNs {}'.format(isbns))
+        organize_by_filename_and_meta(file_path, 'Could not fetch metadata for ISBNs {}'.format(isbns), probe)
     else:
         logger.info('Organization by filename and metadata is not turned on, giving up...')
         skip_file(file_path, 'Could not fetch metadata for ISBNs {}; Non-ISBN organization disabled'.format(isbns))
 
 
+# Sequentially tries to fetch metadata for each of the supplied ISBNs; if any
+# is found, writes it to a tmp.txt file and calls organize_known_ebook()
+# Arguments: path, isbns (comma-separated)
+# TODO: in their description, they refer to `organize_known_ebook` but it should
+# be `move_or_link_ebook_file_and_metadata`, ref.: https://bit.ly/2HNv3x0
+def organize_by_isbns(file_path, isbns, probe=None):
+    tmp_file = fetch_metadata_by_isbns(file_path, isbns)
+    if tmp_file:
+        organize_known_ebook(file_path, tmp_file)
+    else:
+        organize_without_found_isbns(file_path, isbns, probe)
+
+
+def organize_corrupt_file(file_path, file_err):
+    logger.info('File {} is corrupt with error: {}'.format(file_path, file_err))
+    output_folder_corrupt = config.config_dict['organize-ebooks']['output_folder_corrupt']
+    if output_folder_corrupt:
+        new_path = unique_filename(output_folder_corrupt, os.path.basename(file_path))
+
+        fail_file(file_path, 'File is corrupt: {}'.format(file_err), new_path)
+
+        move_or_link_file(file_path, new_path)
+
+        # TODO: do we add the meta extension directly to new_path (which
+        # already has an extension); thus if new_path='/test/path/book.pdf'
+        # then new_metadata_path='/test/path/book.pdf.meta' or should it be
+        # new_metadata_path='/test/path/book.meta' (which is what I'm doing here)
+        # ref.: https://bit.ly/2I6K3pW
+        output_metadata_extension = config.config_dict['general-options']['output_metadata_extension']
+        new_metadata_path = '{}.{}'.format(os.path.splitext(new_path)[0], output_metadata_extension)
+        logger.info('Saving original filename to {}...'.format(new_metadata_path))
+        if not config.config_dict['general-options']['dry_run']:
+            metadata = 'Corruption reason   : {}\nOld file path       : {}\n'.format(file_err, file_path)
+            with open(new_metadata_path, 'w') as f:
+                f.write(metadata)
+    else:
+        logger.info('Output folder for corrupt files is not set, doing nothing')
+        fail_file(file_path, 'File is corrupt: {}'.format(file_err))
+
+
+# Returns the result of check_file_for_corruption(), from the journal if the
+# file was already checked in the run being resumed
+def check_file_for_corruption_journaled(file_path, probe):
+    if resumed_stage(file_path, 'corruption_checked'):
+        logger.info('File {} was already checked for corruption in a previous run'.format(file_path))
+        return journal.get_state(file_path)['file_err']
+    file_err = check_file_for_corruption(file_path, probe)
+    journal_record(file_path, 'corruption_checked', file_err=file_err)
+    return file_err
+
+
+# Returns the result of search_file_for_isbns(), from the journal if the file
+# was already searched in the run being resumed
+def search_file_for_isbns_journaled(file_path, probe):
+    if resumed_stage(file_path, 'isbns_searched'):
+        logger.info('File {} was already searched for ISBNs in a previous run'.format(file_path))
+        return journal.get_state(file_path)['isbns']
+    isbns = search_file_for_isbns(file_path, probe=probe)
+    journal_record(file_path, 'isbns_searched', isbns=isbns)
+    return isbns
+
+
+# Decides how a file is organized once it was searched for ISBNs, the same way
+# for organize_file() and the pipeline (isbn_stage()): returns 'isbns' if it is
+# organized by its ISBNs, 'filename_and_meta' if by its filename and metadata,
+# or None if it is skipped (no ISBNs and `organize_without_isbn` disabled)
+def choose_organization(file_path, isbns):
+    if isbns:
+        logger.info('Organizing {} by ISBNs {}!'.format(file_path, isbns))
+        return 'isbns'
+    elif config.config_dict['organize-ebooks']['organize_without_isbn']:
+        logger.info('No ISBNs found for {}, organizing by filename and metadata...'.format(file_path))
+        return 'filename_and_meta'
+    skip_file(file_path, 'No ISBNs found; Non-ISBN organization disabled')
+    return None
+
+
+# NOTE: the facts about the file (MIME type, `ebook-meta` output, ...) are
+# computed at most once by the FileProbe passed to all the steps
 def organize_file(file_path):
-    file_err = check_file_for_corruption(file_path)
+    if resumed_organized(file_path):
+        logger.info('File {} was already organized in a previous run, skipping...'.format(file_path))
+        return
+    tmp_file = get_resumable_metadata(file_path)
+    if tmp_file:
+        logger.info('Resuming {} with the metadata fetched in a previous run'.format(file_path))
+        organize_known_ebook(file_path, tmp_file)
+        journal_record(file_path, 'done')
+        return
+    probe = FileProbe(file_path)
+    file_err = check_file_for_corruption_journaled(file_path, probe)
     if file_err:
-        logger.info('File {} is corrupt with error: {}'.format(file_path, file_err))
-        output_folder_corrupt = config.config_dict['organize-ebooks']['output_folder_corrupt']
-        if output_folder_corrupt:
-            new_path = unique_filename(output_folder_corrupt, os.path.basename(file_path))
-
-            fail_file(file_path, 'File is corrupt: {}'.format(file_err), new_path)
-
-            move_or_link_file(file_path, new_path)
-
-            # TODO: do we add the meta extension directly to new_path (which
-            # already has an extension); thus if new_path='/test/path/book.pdf'
-            # then new_metadata_path='/test/path/book.pdf.meta' or should it be
-            # new_metadata_path='/test/path/book.meta' (which is what I'm doing here)
-            # ref.: https://bit.ly/2I6K3pW
-            output_metadata_extension = config.config_dict['general-options']['output_metadata_extension']
-            new_metadata_path = '{}.{}'.format(os.path.splitext(new_path)[0], output_metadata_extension)
-            logger.info('Saving original filename to {}...'.format(new_metadata_path))
-            if not config.config_dict['general-options']['dry_run']:
-                metadata = 'Corruption reason   : {}\nOld file path       : {}\n'.format(file_err, file_path)
-                with open(new_metadata_path, 'w') as f:
-                    f.write(metadata)
-        else:
-            logger.info('Output folder for corrupt files is not set, doing nothing')
-            fail_file(file_path, 'File is corrupt: {}'.format(file_err))
+        organize_corrupt_file(file_path, file_err)
     elif config.config_dict['organize-ebooks']['corruption_check_only']:
         logger.info('We are only checking for corruption, do not continue organising...')
         skip_file(file_path, 'File appears OK')
     else:
         logger.info('File passed the corruption test, looking for ISBNs...')
-        isbns = search_file_for_isbns(file_path)
-        ipdb.set_trace()
-        # TODO: debugging, remove False
-        if isbns and False:
-            logger.info('Organizing {} by ISBNs {}!'.format(file_path, isbns))
-            organize_by_isbns(file_path, isbns)
-        # TODO: debugging, remove True
-        elif config.config_dict['organize-ebooks']['organize_without_isbn'] or True:
-            logger.info('No ISBNs found for {}, organizing by filename and metadata...'.format(file_path))
-            organize_by_filename_and_meta(file_path, 'No ISBNs found')
-        else:
-            skip_file(file_path, 'No ISBNs found; Non-ISBN organization disabled')
+        isbns = search_file_for_isbns_journaled(file_path, probe)
+        organization = choose_organization(file_path, isbns)
+        if organization == 'isbns':
+            organize_by_isbns(file_path, isbns, probe)
+        elif organization == 'filename_and_meta':
+            organize_by_filename_and_meta(file_path, 'No ISBNs found', probe)
+    journal_record(file_path, 'done')
     logger.info('=====================================================')
 
 
+# Stages of the pipeline used by organize_files_with_pipeline(). They split
+# organize_file() into its CPU-bound (corruption check, ISBN search with text
+# conversion and OCR), network-bound (metadata fetch) and disk-bound (move)
+# parts. Each stage returns the name of the next stage and the item to pass to
+# it, or None when the file is done. The FileProbe of the file is passed along
+# from stage to stage.
+# When resuming a previous run, the first stage sends the files directly to
+# the stage following the last one they completed
+def corruption_stage(file_path):
+    if resumed_organized(file_path):
+        logger.info('File {} was already organized in a previous run, skipping...'.format(file_path))
+        return None
+    tmp_file = get_resumable_metadata(file_path)
+    if tmp_file:
+        logger.info('Resuming {} with the metadata fetched in a previous run'.format(file_path))
+        return 'move', ('isbn', file_path, tmp_file)
+    probe = FileProbe(file_path)
+    file_err = check_file_for_corruption_journaled(file_path, probe)
+    if file_err:
+        return 'move', ('corrupt', file_path, file_err)
+    elif config.config_dict['organize-ebooks']['corruption_check_only']:
+        logger.info('We are only checking for corruption, do not continue organising...')
+        skip_file(file_path, 'File appears OK')
+        journal_record(file_path, 'done')
+        return None
+    logger.info('File passed the corruption test, looking for ISBNs...')
+    if resumed_stage(file_path, 'isbns_searched'):
+        return isbn_stage(probe)
+    return 'isbn', probe
+
+
+def isbn_stage(probe):
+    file_path = probe.file_path
+    isbns = search_file_for_isbns_journaled(file_path, probe)
+    organization = choose_organization(file_path, isbns)
+    if organization == 'isbns':
+        return 'fetch', (probe, isbns)
+    elif organization == 'filename_and_meta':
+        return 'fetch', (probe, '')
+    journal_record(file_path, 'done')
+    return None
+
+
+def fetch_stage(item):
+    probe, isbns = item
+    file_path = probe.file_path
+    if not isbns:
+        # NOTE: the organization by filename and metadata fetches and moves
+        # in the same step
+        organize_by_filename_and_meta(file_path, 'No ISBNs found', probe)
+        journal_record(file_path, 'done')
+        return None
+    tmp_file = fetch_metadata_by_isbns(file_path, isbns)
+    if tmp_file:
+        return 'move', ('isbn', file_path, tmp_file)
+    organize_without_found_isbns(file_path, isbns, probe)
+    journal_record(file_path, 'done')
+    return None
+
+
+def move_stage(item):
+    kind, file_path, data = item
+    if kind == 'corrupt':
+        organize_corrupt_file(file_path, data)
+    else:
+        organize_known_ebook(file_path, data)
+    journal_record(file_path, 'done')
+    return None
+
+
+# Organizes the supplied files through a pipeline of stages (corruption check
+# -> ISBN search -> metadata fetch -> move) connected by bounded queues, where
+# each stage has its own number of workers, e.g. a few workers for the CPU-bound
+# ISBN search but dozens of workers waiting on the network for metadata.
+# Returns False if the run had to be aborted, True otherwise
+def organize_files_with_pipeline(file_paths, stage_jobs, queue_size=100):
+    stage_names = ['corruption', 'isbn', 'fetch', 'move']
+    stage_funcs = [corruption_stage, isbn_stage, fetch_stage, move_stage]
+    stage_jobs = [int(i) for i in stage_jobs.split(',')]
+    if len(stage_jobs) != len(stage_names):
+        logger.critical('pipeline_stage_jobs should have {} values ({}): {}'.format(
+            len(stage_names), ','.join(stage_names), stage_jobs))
+        return False
+    pipeline = Pipeline(queue_size=queue_size, on_error=fail_pipeline_item)
+    for name, func, jobs in zip(stage_names, stage_funcs, stage_jobs):
+        logger.info('Pipeline stage {} with {} workers'.format(name, jobs))
+        pipeline.add_stage(name, func, jobs)
+    errors = pipeline.run(file_paths, stop_on_error=KeyError)
+    for stage_name, item, e in errors:
+        if isinstance(e, KeyError):
+            logger.critical('Stage {} failed on {}: {}'.format(stage_name, item, e.__repr__()))
+            return False
+    return True
+
+
+# Returns the path of the file of a pipeline item, depending on the stage: a
+# file path (corruption), a FileProbe (isbn), (probe, isbns) (fetch) or
+# (kind, file_path, data) (move)
+def get_pipeline_item_path(item):
+    if isinstance(item, tuple):
+        item = item[0] if isinstance(item[0], FileProbe) else item[1]
+    return item.file_path if isinstance(item, FileProbe) else item
+
+
+# Reports a file whose organization failed in a stage of the pipeline, like
+# organize_files() does. A KeyError (e.g. a missing config option) aborts the
+# run instead, see organize_files_with_pipeline()
+def fail_pipeline_item(stage_name, item, e):
+    if isinstance(e, KeyError):
+        logger.exception('Stage {} failed on {}'.format(stage_name, item))
+        return
+    fail_file_with_exception(get_pipeline_item_path(item), e)
+
+
+# Recursively walks through the supplied ebook folders and yields the path of
+# every file found
+def get_files_to_organize(ebook_folders):
+    for fpath in ebook_folders:
+        # Do some preprocessing on the file path: expand the file path if it
+        # starts with '~' and remove whitespaces around file paths
+        fpath = expand_folder_paths(fpath)
+        fpath = check_comma_options(fpath)
+        logger.info('Recursively scanning {} for files'.format(fpath))
+        # TODO: They make use of sorting flags for walking through the files [FILE_SORT_FLAGS]
+        # ref.: https://bit.ly/2HuI3YS
+        for path, dirs, files in os.walk(fpath):
+            for file in files:
+                yield os.path.join(path, file)
+
+
+# Calls organize_file() on each of the supplied files. If `jobs` is larger than
+# 1, the files are organized concurrently by a pool of `jobs` threads: most of
+# the work per file is done by external tools (`pdftotext`, `7z`,
+# `fetch-ebook-metadata`, ...) which run outside of the GIL.
+# Returns False if the run had to be aborted, True otherwise
+def organize_files(file_paths, jobs=1):
+    if jobs <= 1:
+        for file_path in file_paths:
+            # NOTE: a KeyError is a missing option, which aborts the run. Any
+            # other error only fails the current file
+            try:
+                organize_file(file_path=file_path)
+            except KeyError as e:
+                err_msg = get_full_exception(error=e, to_print=False)
+                logger.critical(err_msg)
+                return False
+            except Exception as e:
+                fail_file_with_exception(file_path, e)
+        return True
+
+    logger.info('Organizing files with {} workers'.format(jobs))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        # Bound the number of submitted files so that huge folders are not
+        # loaded all at once in the executor's queue
+        # future -> path of the file organized by the future
+        pending = {}
+        for file_path in file_paths:
+            pending[executor.submit(organize_file, file_path=file_path)] = file_path
+            if len(pending) < 2 * jobs:
+                continue
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            if not _check_organize_results(done, pending):
+                executor.shutdown(wait=True, cancel_futures=True)
+                return False
+        done, _ = wait(pending)
+        return _check_organize_results(done, pending)
+
+
+# Checks the results of the finished futures (removed from `pending`, a dict of
+# futures to file paths): the files that raised an error are reported as
+# failed, except for a KeyError (missing option) which aborts the run
+def _check_organize_results(futures, pending):
+    for future in futures:
+        file_path = pending.pop(future)
+        try:
+            future.result()
+        except KeyError as e:
+            # NOTE: get_full_exception() relies on sys.exc_info()
+            err_msg = get_full_exception(error=e, to_print=False)
+            logger.critical(err_msg)
+            return False
+        except Exception as e:
+            fail_file_with_exception(file_path, e)
+    return True
+
+
 if __name__ == '__main__':
     # IMPORTANT: command-line parameters have precedence over options in
     # configuration file, i.e. command-line parameters will override
@@ -432,6 +821,12 @@ if __name__ == '__main__':
     group1.add_argument('--pamphlet-excluded-files', default='\.(chm|epub|cbr|cbz|mobi|lit|pdb)$')
     group1.add_argument('--pamphlet-max-pdf-pages', default=50, type=int)
     group1.add_argument('--pamphlet-max-filesize-kib', default=250, type=int)
+    group1.add_argument('-j', '--jobs', default=1, type=int)
+    group1.add_argument('-p', '--pipeline', action='store_true')
+    group1.add_argument('--pipeline-stage-jobs', default='2,4,16,1')
+    group1.add_argument('--pipeline-queue-size', default=100, type=int)
+    group1.add_argument('--journal-path', default='')
+    group1.add_argument('-r', '--resume', action='store_true')
 
     handle_script_arg(group2)
     args = parser.parse_args()
@@ -478,22 +873,26 @@ if __name__ == '__main__':
     # Update options from configuration file with arguments from command-line
     update_config_from_arg_groups(parser)
 
+    journal_path = config.config_dict['organize-ebooks']['journal_path']
+    if journal_path:
+        journal = Journal(journal_path)
+        cleanup_journal_tmp_files()
+    elif config.config_dict['organize-ebooks']['resume']:
+        logger.critical('Can not resume without a journal, journal_path is not set')
+        sys.exit(1)
+
     ebook_folders = config.config_dict['organize-ebooks']['ebook_folders'].split(',')
-    for fpath in ebook_folders:
-        # Do some preprocessing on the file path: expand the file path if it
-        # starts with '~' and remove whitespaces around file paths
-        fpath = expand_folder_paths(fpath)
-        fpath = check_comma_options(fpath)
-        logger.info('Recursively scanning {} for files'.format(fpath))
-        # TODO: They make use of sorting flags for walking through the files [FILE_SORT_FLAGS]
-        # ref.: https://bit.ly/2HuI3YS
-        for path, dirs, files in os.walk(fpath):
-            for file in files:
-                # TODO: catch any error and continue with next filename, see https://stackoverflow.com/a/26199212
-                try:
-                    organize_file(file_path=os.path.join(path, file))
-                except KeyError as e:
-                    err_msg = get_full_exception(error=e, to_print=False)
-                    logger.critical(err_msg)
-                    sys.exit(1)
-    sys.exit(0)
+    file_paths = get_files_to_organize(ebook_folders)
+    if config.config_dict['organize-ebooks']['pipeline']:
+        success = organize_files_with_pipeline(file_paths,
+                                               config.config_dict['organize-ebooks']['pipeline_stage_jobs'],
+                                               config.config_dict['organize-ebooks']['pipeline_queue_size'])
+    else:
+        success = organize_files(file_paths, config.config_dict['organize-ebooks']['jobs'])
+    log_cache_stats()
+    log_fetch_stats()
+    log_extractor_stats()
+    log_probe_stats()
+    if journal is not None:
+        journal.close()
+    sys.exit(0 if success else 1)
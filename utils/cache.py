@@ -0,0 +1,348 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+
+logger = logging.getLogger('{}.{}'.format(os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), __name__))
+
+
+class SqliteCache:
+    """
+    Base class for the on-disk caches. Each cache is a SQLite database that
+    can be shared by several threads (one connection protected by a lock) and
+    by several processes (WAL journal mode and a busy timeout).
+    """
+    # SQL statements creating the tables of the cache (if they don't exist)
+    schema = ''
+
+    def __init__(self, db_path):
+        self.db_path = os.path.expanduser(db_path)
+        dirname = os.path.dirname(self.db_path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(self.schema)
+        # Hits and misses since the cache was opened
+        self.hits = 0
+        self.misses = 0
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def execute_rowcount(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).rowcount
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class IsbnCache(SqliteCache):
+    """
+    Results of the ISBN search on files, keyed by the file content hash, size
+    and mtime.
+
+    Negative results (no ISBNs found) are also stored, with an empty `isbns`.
+    The `step` column records which step of search_file_for_isbns() found the
+    ISBNs, e.g. 'ebook_meta' or 'ocr'.
+    """
+    schema = '''
+        CREATE TABLE IF NOT EXISTS isbn_cache (
+            hash        TEXT NOT NULL,
+            size        INTEGER NOT NULL,
+            mtime       REAL NOT NULL,
+            isbns       TEXT NOT NULL,
+            step        TEXT NOT NULL,
+            created     REAL NOT NULL,
+            PRIMARY KEY (hash, size, mtime)
+        );
+    '''
+
+    def get(self, file_hash, size, mtime, ignore_negative=False):
+        """
+        :return: tuple `(isbns, step)` or None if there is no (usable) entry
+        """
+        rows = self.execute('SELECT isbns, step FROM isbn_cache WHERE hash=? AND size=? AND mtime=?',
+                            (file_hash, size, mtime))
+        if not rows or (ignore_negative and not rows[0][0]):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return rows[0]
+
+    def put(self, file_hash, size, mtime, isbns, step):
+        self.execute('INSERT OR REPLACE INTO isbn_cache VALUES (?, ?, ?, ?, ?, ?)',
+                     (file_hash, size, mtime, isbns, step, time.time()))
+
+    def invalidate(self, negative_only=False, step=None):
+        """
+        Removes entries from the cache, e.g. the negative ones after OCR was
+        enabled.
+
+        :return: number of removed entries
+        """
+        sql = 'DELETE FROM isbn_cache WHERE 1=1'
+        params = []
+        if negative_only:
+            sql += " AND isbns=''"
+        if step is not None:
+            sql += ' AND step=?'
+            params.append(step)
+        return self.execute_rowcount(sql, params)
+
+    def stats(self):
+        stats = {'entries': 0, 'positive': 0, 'negative': 0, 'steps': {},
+                 'hits': self.hits, 'misses': self.misses}
+        for step, isbns_found, count in self.execute(
+                "SELECT step, isbns!='', COUNT(*) FROM isbn_cache GROUP BY step, isbns!=''"):
+            stats['entries'] += count
+            if isbns_found:
+                stats['positive'] += count
+                stats['steps'][step] = stats['steps'].get(step, 0) + count
+            else:
+                stats['negative'] += count
+        return stats
+
+
+class OcrCache(SqliteCache):
+    """
+    OCR-ed text of document pages, keyed by the document content hash, the
+    page number and the OCR settings (e.g. 'tesseract_wrapper:dpi=300:psm=12').
+
+    The texts are compressed with zlib and the total size of the compressed
+    texts is bounded by `max_size` bytes: the least recently used pages are
+    evicted first.
+
+    Since the cache can be shared by several processes, a worker that is about
+    to OCR a page first claims it, so that the other workers wait for its
+    result instead of OCR-ing the same page.
+    """
+    schema = '''
+        CREATE TABLE IF NOT EXISTS ocr_cache (
+            hash        TEXT NOT NULL,
+            page        INTEGER NOT NULL,
+            settings    TEXT NOT NULL,
+            text        BLOB NOT NULL,
+            size        INTEGER NOT NULL,
+            last_access REAL NOT NULL,
+            PRIMARY KEY (hash, page, settings)
+        );
+        CREATE INDEX IF NOT EXISTS ocr_cache_last_access ON ocr_cache (last_access);
+        -- Total size of the cached texts, kept up to date by the triggers so
+        -- that evict() doesn't sum the sizes of every page
+        CREATE TABLE IF NOT EXISTS ocr_cache_size (
+            id          INTEGER PRIMARY KEY CHECK (id = 0),
+            total       INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO ocr_cache_size SELECT 0, COALESCE(SUM(size), 0) FROM ocr_cache
+            WHERE NOT EXISTS (SELECT 1 FROM ocr_cache_size);
+        CREATE TRIGGER IF NOT EXISTS ocr_cache_insert AFTER INSERT ON ocr_cache BEGIN
+            UPDATE ocr_cache_size SET total=total+NEW.size;
+        END;
+        CREATE TRIGGER IF NOT EXISTS ocr_cache_delete AFTER DELETE ON ocr_cache BEGIN
+            UPDATE ocr_cache_size SET total=total-OLD.size;
+        END;
+        CREATE TABLE IF NOT EXISTS ocr_claims (
+            hash        TEXT NOT NULL,
+            page        INTEGER NOT NULL,
+            settings    TEXT NOT NULL,
+            claimed     REAL NOT NULL,
+            PRIMARY KEY (hash, page, settings)
+        );
+    '''
+
+    def __init__(self, db_path, max_size=512*1024*1024, claim_timeout=600):
+        super().__init__(db_path)
+        # The rows replaced by INSERT OR REPLACE fire the delete trigger
+        self.conn.execute('PRAGMA recursive_triggers=ON')
+        self.max_size = max_size
+        # Claims older than this (in seconds) are considered abandoned, e.g.
+        # the worker that claimed the page crashed
+        self.claim_timeout = claim_timeout
+        self.evictions = 0
+
+    def get(self, file_hash, page, settings):
+        """
+        :return: the OCR-ed text of the page or None if it is not cached
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT text FROM ocr_cache WHERE hash=? AND page=? AND settings=?',
+                                    (file_hash, page, settings)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute('UPDATE ocr_cache SET last_access=? WHERE hash=? AND page=? AND settings=?',
+                              (time.time(), file_hash, page, settings))
+        self.hits += 1
+        return zlib.decompress(row[0]).decode('utf-8')
+
+    def put(self, file_hash, page, settings, text):
+        data = zlib.compress(text.encode('utf-8'))
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO ocr_cache VALUES (?, ?, ?, ?, ?, ?)',
+                              (file_hash, page, settings, data, len(data), time.time()))
+            self.conn.execute('DELETE FROM ocr_claims WHERE hash=? AND page=? AND settings=?',
+                              (file_hash, page, settings))
+        self.evict()
+
+    def claim(self, file_hash, page, settings):
+        """
+        :return: True if the page was claimed, False if another worker is
+                 already OCR-ing it
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.execute('DELETE FROM ocr_claims WHERE claimed<?', (now - self.claim_timeout,))
+            return self.conn.execute('INSERT OR IGNORE INTO ocr_claims VALUES (?, ?, ?, ?)',
+                                     (file_hash, page, settings, now)).rowcount == 1
+
+    def release(self, file_hash, page, settings):
+        self.execute('DELETE FROM ocr_claims WHERE hash=? AND page=? AND settings=?',
+                     (file_hash, page, settings))
+
+    def wait(self, file_hash, page, settings, poll_interval=1):
+        """
+        Waits until the page claimed by another worker is cached.
+
+        :return: the OCR-ed text of the page or None if the claim was released
+                 (or abandoned) without a result
+        """
+        while True:
+            rows = self.execute('SELECT claimed FROM ocr_claims WHERE hash=? AND page=? AND settings=?',
+                                (file_hash, page, settings))
+            if not rows or rows[0][0] < time.time() - self.claim_timeout:
+                return self.get(file_hash, page, settings)
+            time.sleep(poll_interval)
+
+    def evict(self, batch_size=100):
+        """
+        Removes the least recently used pages until the cache fits in
+        `max_size` bytes.
+
+        :return: number of evicted pages
+        """
+        with self.lock:
+            excess = self.conn.execute('SELECT total FROM ocr_cache_size').fetchone()[0] - self.max_size
+            evicted = 0
+            while excess > 0:
+                # The oldest pages, by batches read from the last_access index
+                rows = self.conn.execute('SELECT rowid, size FROM ocr_cache ORDER BY last_access LIMIT ?',
+                                         (batch_size,)).fetchall()
+                if not rows:
+                    break
+                rowids = []
+                for rowid, size in rows:
+                    if excess <= 0:
+                        break
+                    rowids.append(rowid)
+                    excess -= size
+                self.conn.execute('DELETE FROM ocr_cache WHERE rowid IN ({})'.format(', '.join('?' * len(rowids))),
+                                  rowids)
+                evicted += len(rowids)
+            if not evicted:
+                return 0
+        self.evictions += evicted
+        logger.debug('Evicted {} pages from the OCR cache'.format(evicted))
+        return evicted
+
+    def invalidate(self):
+        """
+        :return: number of removed pages
+        """
+        self.execute('DELETE FROM ocr_claims')
+        return self.execute_rowcount('DELETE FROM ocr_cache')
+
+    def stats(self):
+        entries = self.execute('SELECT COUNT(*) FROM ocr_cache')[0][0]
+        size = self.execute('SELECT total FROM ocr_cache_size')[0][0]
+        documents = self.execute('SELECT COUNT(DISTINCT hash) FROM ocr_cache')[0][0]
+        return {'entries': entries, 'documents': documents, 'size': size, 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class MetadataCache(SqliteCache):
+    """
+    Metadata fetched from the online sources (the output of calibre's
+    `fetch-ebook-metadata`), keyed by query and source: the query is the
+    canonical ISBN-13 (e.g. 'isbn:9780306406157') or the title/author of a
+    search (e.g. 'title:a book|author:someone') and the source is the allowed
+    plugin(s), e.g. 'Goodreads'.
+
+    Negative results (no metadata found) are stored with an empty `metadata`.
+    The entries expire after `ttl` seconds, `negative_ttl` seconds for the
+    negative ones since the sources might know the book later.
+    """
+    schema = '''
+        CREATE TABLE IF NOT EXISTS metadata_cache (
+            query       TEXT NOT NULL,
+            source      TEXT NOT NULL,
+            metadata    TEXT NOT NULL,
+            created     REAL NOT NULL,
+            PRIMARY KEY (query, source)
+        );
+    '''
+
+    def __init__(self, db_path, ttl=90*24*3600, negative_ttl=7*24*3600):
+        super().__init__(db_path)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+    def get(self, query, source):
+        """
+        :return: the metadata, '' if the source has no metadata for the query,
+                 or None if there is no (fresh) entry
+        """
+        rows = self.execute('SELECT metadata, created FROM metadata_cache WHERE query=? AND source=?',
+                            (query, source))
+        if rows:
+            metadata, created = rows[0]
+            if created >= time.time() - (self.ttl if metadata else self.negative_ttl):
+                self.hits += 1
+                return metadata
+        self.misses += 1
+        return None
+
+    def put(self, query, source, metadata, created=None):
+        self.execute('INSERT OR REPLACE INTO metadata_cache VALUES (?, ?, ?, ?)',
+                     (query, source, metadata, time.time() if created is None else created))
+
+    def invalidate(self, negative_only=False, expired_only=False, source=None):
+        """
+        :return: number of removed entries
+        """
+        now = time.time()
+        sql = 'DELETE FROM metadata_cache WHERE 1=1'
+        params = []
+        if negative_only:
+            sql += " AND metadata=''"
+        if expired_only:
+            sql += " AND created < CASE WHEN metadata='' THEN ? ELSE ? END"
+            params += [now - self.negative_ttl, now - self.ttl]
+        if source is not None:
+            sql += ' AND source=?'
+            params.append(source)
+        return self.execute_rowcount(sql, params)
+
+    def stats(self):
+        now = time.time()
+        stats = {'entries': 0, 'positive': 0, 'negative': 0, 'expired': 0, 'sources': {},
+                 'hits': self.hits, 'misses': self.misses}
+        for source, found, expired, count in self.execute(
+                "SELECT source, metadata!='', created < CASE WHEN metadata='' THEN ? ELSE ? END, COUNT(*) "
+                "FROM metadata_cache GROUP BY 1, 2, 3", (now - self.negative_ttl, now - self.ttl)):
+            stats['entries'] += count
+            stats['positive' if found else 'negative'] += count
+            stats['expired'] += count if expired else 0
+            stats['sources'][source] = stats['sources'].get(source, 0) + count
+        return stats
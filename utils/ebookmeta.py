@@ -0,0 +1,286 @@
+import logging
+import os
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+
+from utils.pdf import get_pdf_metadata
+
+
+logger = logging.getLogger('{}.{}'.format(os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), __name__))
+
+
+# Width of the keys in the calibre `ebook-meta` output, e.g.
+# 'Title               : The Title'
+KEY_WIDTH = 20
+# Maximum number of bytes of a FB2 file parsed to find its <description>
+FB2_MAX_DESCRIPTION_SIZE = 1024 * 1024
+
+NAMESPACES = {
+    'container': 'urn:oasis:names:tc:opendocument:xmlns:container',
+    'opf': 'http://www.idpf.org/2007/opf',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+    'fb2': 'http://www.gribuser.ru/xml/fictionbook/2.0',
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+}
+
+
+class MetadataError(Exception):
+    pass
+
+
+def get_native_ebook_metadata(file_path, mime_type):
+    """
+    Reads the metadata of an epub, fb2 or pdf file without calibre and returns
+    it in the format of calibre's `ebook-meta`, e.g.::
+
+        Title               : The Title
+        Author(s)           : First Author & Second Author
+        Identifiers         : isbn:9780123456786, uuid:...
+
+    :param file_path: path of the ebook
+    :param mime_type: MIME type of the ebook
+    :return str: the metadata or None if the format is not supported or the
+                 file can't be read (calibre should be used instead)
+    """
+    if mime_type == 'application/epub+zip':
+        reader = read_epub_metadata
+    elif mime_type == 'application/pdf':
+        reader = read_pdf_metadata
+    elif mime_type in ('text/xml', 'application/xml', 'application/x-fictionbook+xml') and is_fb2(file_path):
+        reader = read_fb2_metadata
+    else:
+        return None
+    try:
+        metadata = reader(file_path)
+    except (ET.ParseError, LookupError, MetadataError, OSError, UnicodeDecodeError,
+            zipfile.BadZipFile) as e:
+        logger.debug('Could not read the metadata of {} natively: {}'.format(file_path, e))
+        return None
+    if metadata is None:
+        return None
+    return format_metadata(metadata)
+
+
+def format_metadata(metadata):
+    """
+    :param metadata: list of tuples `(key, value)` in calibre's order, the
+                     empty values are skipped
+    :return str: the metadata formatted like calibre's `ebook-meta`
+    """
+    lines = []
+    for key, value in metadata:
+        if value:
+            value = re.sub(r'\s+', ' ', value).strip()
+            lines.append('{}: {}'.format(key.ljust(KEY_WIDTH), value))
+    return '\n'.join(lines)
+
+
+def get_identifiers(identifiers):
+    # e.g. [('isbn', '978...'), ('uuid', '...')] -> 'isbn:978..., uuid:...'
+    seen = []
+    for scheme, value in identifiers:
+        item = '{}:{}'.format(scheme, value) if scheme else value
+        if item not in seen:
+            seen.append(item)
+    return ', '.join(seen)
+
+
+def parse_identifier(value, scheme=''):
+    """
+    :return: tuple `(scheme, value)`, e.g. 'urn:isbn:978...' -> ('isbn', '978...')
+    """
+    value = value.strip()
+    scheme = scheme.strip().lower()
+    match = re.match(r'^(?:urn:)?(isbn|uuid|doi|asin|issn)[:\s]+(.+)$', value, re.I)
+    if match:
+        return match.group(1).lower(), match.group(2).strip()
+    if not scheme and re.match(r'^[0-9][0-9 -]{8,15}[0-9Xx]$', value):
+        scheme = 'isbn'
+    return scheme, value
+
+
+def get_local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def read_epub_metadata(file_path):
+    with zipfile.ZipFile(file_path) as zip_file:
+        container = ET.fromstring(zip_file.read('META-INF/container.xml'))
+        rootfile = container.find('.//container:rootfile', NAMESPACES)
+        if rootfile is None or not rootfile.get('full-path'):
+            raise MetadataError('No OPF file in META-INF/container.xml')
+        opf_path = rootfile.get('full-path')
+        opf = ET.fromstring(zip_file.read(opf_path))
+    return get_opf_metadata(opf)
+
+
+def get_opf_metadata(opf):
+    """
+    :param opf: root element of an OPF (2 or 3) package document
+    :return: list of tuples `(key, value)` as used by format_metadata()
+    """
+    metadata = opf.find('opf:metadata', NAMESPACES)
+    if metadata is None:
+        # OPF 1 and some broken files have no namespace
+        metadata = opf.find('metadata')
+    if metadata is None:
+        raise MetadataError('No <metadata> in the OPF file')
+
+    def texts(name):
+        return [e.text.strip() for e in metadata.iter('{{{}}}{}'.format(NAMESPACES['dc'], name))
+                if e.text and e.text.strip()]
+
+    # <meta name="calibre:series" content="..."/> (OPF 2) or
+    # <meta property="belongs-to-collection">...</meta> (OPF 3)
+    metas = {}
+    for meta in metadata.iter():
+        if get_local_name(meta.tag) != 'meta':
+            continue
+        name = meta.get('name') or meta.get('property')
+        value = meta.get('content') if meta.get('content') is not None else meta.text
+        if name and value and name not in metas:
+            metas[name] = value.strip()
+
+    identifiers = []
+    for e in metadata.iter('{{{}}}identifier'.format(NAMESPACES['dc'])):
+        if e.text and e.text.strip():
+            scheme = e.get('{{{}}}scheme'.format(NAMESPACES['opf'])) or e.get('scheme') or ''
+            identifiers.append(parse_identifier(e.text, scheme))
+
+    series = metas.get('calibre:series') or metas.get('belongs-to-collection')
+    if series and metas.get('calibre:series_index'):
+        series = '{} #{}'.format(series, metas['calibre:series_index'])
+    return [
+        ('Title', ' '.join(texts('title')[:1])),
+        ('Author(s)', ' & '.join(texts('creator'))),
+        ('Publisher', ' '.join(texts('publisher')[:1])),
+        ('Tags', ', '.join(texts('subject'))),
+        ('Series', series),
+        ('Languages', ', '.join(texts('language'))),
+        ('Published', ' '.join(texts('date')[:1])),
+        ('Identifiers', get_identifiers(identifiers)),
+        ('Comments', ' '.join(texts('description')[:1])),
+    ]
+
+
+def is_fb2(file_path):
+    with open(file_path, 'rb') as f:
+        return b'<FictionBook' in f.read(4096)
+
+
+def read_fb2_metadata(file_path):
+    # Only the <description> is parsed: the body and the (big) base64 images
+    # that follow are never read
+    with open(file_path, 'rb') as f:
+        head = f.read(FB2_MAX_DESCRIPTION_SIZE)
+    end = head.find(b'</description>')
+    start = head.find(b'<description')
+    if start < 0 or end < 0:
+        raise MetadataError('No <description> in the first {} bytes'.format(FB2_MAX_DESCRIPTION_SIZE))
+    # Keep the namespace declarations of the root element
+    root_start = head.find(b'<FictionBook')
+    root_end = head.find(b'>', root_start)
+    encoding = re.search(rb'encoding=["\']([\w-]+)["\']', head[:root_start])
+    document = head[root_start:root_end+1] + head[start:end] + b'</description></FictionBook>'
+    if encoding and encoding.group(1).lower() not in (b'utf-8', b'utf8'):
+        document = document.decode(encoding.group(1).decode('ascii')).encode('utf-8')
+    description = ET.fromstring(document).find('fb2:description', NAMESPACES)
+    if description is None:
+        raise MetadataError('No FictionBook 2 <description>')
+
+    def find_text(element, path):
+        e = element.find(path, NAMESPACES) if element is not None else None
+        return e.text.strip() if e is not None and e.text else ''
+
+    title_info = description.find('fb2:title-info', NAMESPACES)
+    publish_info = description.find('fb2:publish-info', NAMESPACES)
+    document_info = description.find('fb2:document-info', NAMESPACES)
+    authors = []
+    for author in title_info.findall('fb2:author', NAMESPACES) if title_info is not None else []:
+        name = ' '.join(filter(None, [find_text(author, 'fb2:first-name'), find_text(author, 'fb2:middle-name'),
+                                      find_text(author, 'fb2:last-name')]))
+        authors.append(name or find_text(author, 'fb2:nickname'))
+    series = None
+    sequence = title_info.find('fb2:sequence', NAMESPACES) if title_info is not None else None
+    if sequence is not None and sequence.get('name'):
+        series = sequence.get('name')
+        if sequence.get('number'):
+            series = '{} #{}'.format(series, sequence.get('number'))
+    identifiers = []
+    if find_text(publish_info, 'fb2:isbn'):
+        identifiers.append(('isbn', find_text(publish_info, 'fb2:isbn')))
+    if find_text(document_info, 'fb2:id'):
+        identifiers.append(('fb2-id', find_text(document_info, 'fb2:id')))
+    tags = [e.text.strip() for e in title_info.findall('fb2:genre', NAMESPACES) if e.text] \
+        if title_info is not None else []
+    annotation = title_info.find('fb2:annotation', NAMESPACES) if title_info is not None else None
+    return [
+        ('Title', find_text(title_info, 'fb2:book-title')),
+        ('Author(s)', ' & '.join(filter(None, authors))),
+        ('Publisher', find_text(publish_info, 'fb2:publisher')),
+        ('Tags', ', '.join(tags)),
+        ('Series', series),
+        ('Languages', find_text(title_info, 'fb2:lang')),
+        ('Published', find_text(publish_info, 'fb2:year') or find_text(title_info, 'fb2:date')),
+        ('Identifiers', get_identifiers(identifiers)),
+        ('Comments', ' '.join(annotation.itertext()) if annotation is not None else ''),
+    ]
+
+
+def read_pdf_metadata(file_path):
+    result = get_pdf_metadata(file_path)
+    if result is None:
+        return None
+    info, xmp = result
+    xmp_values = get_xmp_metadata(xmp) if xmp else {}
+    identifiers = [parse_identifier(value) for value in xmp_values.get('identifier', [])]
+    return [
+        ('Title', info.get('Title') or ' '.join(xmp_values.get('title', [])[:1])),
+        ('Author(s)', info.get('Author') or ' & '.join(xmp_values.get('creator', []))),
+        ('Publisher', ' '.join(xmp_values.get('publisher', [])[:1])),
+        ('Book Producer', info.get('Producer') or info.get('Creator')),
+        ('Tags', info.get('Keywords') or ', '.join(xmp_values.get('subject', []))),
+        ('Published', ' '.join(xmp_values.get('date', [])[:1])),
+        ('Identifiers', get_identifiers(identifiers)),
+        ('Comments', info.get('Subject') or ' '.join(xmp_values.get('description', [])[:1])),
+    ]
+
+
+def get_xmp_metadata(xmp):
+    """
+    :param xmp: XMP packet (bytes)
+    :return: dict of the Dublin Core values (e.g. 'title', 'creator') and of
+             the identifiers (`dc:identifier`, `xmp:Identifier`,
+             `prism:isbn`, ...) under 'identifier'
+    """
+    start = xmp.find(b'<x:xmpmeta')
+    if start < 0:
+        start = xmp.find(b'<rdf:RDF')
+    end = max(xmp.rfind(b'</x:xmpmeta>') + len(b'</x:xmpmeta>'), xmp.rfind(b'</rdf:RDF>') + len(b'</rdf:RDF>'))
+    try:
+        root = ET.fromstring(xmp[start:end] if start >= 0 else xmp)
+    except ET.ParseError as e:
+        logger.debug('Invalid XMP metadata: {}'.format(e))
+        return {}
+    values = {}
+    for element in root.iter():
+        name = get_local_name(element.tag)
+        # Values are in rdf:Alt/rdf:Seq/rdf:Bag lists or directly in the element
+        items = [li.text for li in element.iter('{{{}}}li'.format(NAMESPACES['rdf']))] or [element.text]
+        items = [item.strip() for item in items if item and item.strip()]
+        if element.tag.startswith('{{{}}}'.format(NAMESPACES['dc'])) and name != 'identifier':
+            values.setdefault(name, []).extend(items)
+        elif name.lower() in ('identifier', 'isbn', 'eisbn', 'doi'):
+            scheme = name.lower() if name.lower() != 'identifier' else ''
+            values.setdefault('identifier', []).extend(
+                '{}:{}'.format(scheme, item) if scheme and not item.lower().startswith(scheme) else item
+                for item in items)
+        # Attribute form, e.g. <rdf:Description prism:isbn="978...">
+        for attr, value in element.attrib.items():
+            attr_name = get_local_name(attr)
+            if attr.startswith('{{{}}}'.format(NAMESPACES['dc'])):
+                values.setdefault(attr_name, []).append(value)
+            elif attr_name.lower() in ('isbn', 'eisbn', 'doi'):
+                values.setdefault('identifier', []).append('{}:{}'.format(attr_name.lower(), value))
+    return values
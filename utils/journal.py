@@ -0,0 +1,113 @@
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger('{}.{}'.format(os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), __name__))
+
+
+class Journal:
+    """
+    Append-only JSONL journal of the state transitions of the files being
+    organized, e.g.
+
+        {"file": "/ebooks/book.pdf", "stage": "isbns_searched", "isbns": "9780387906850", "size": 1234,
+         "mtime": 1528800000.0, "time": ...}
+
+    Every record is flushed and synced to disk before record() returns, so that
+    the journal survives crashes. When the journal is opened, the existing
+    records are replayed to rebuild the last known state of every file, which
+    is what a resumed run uses to skip the completed stages.
+    """
+    # Stages of a file in the order they are reached
+    STAGES = ['corruption_checked', 'isbns_searched', 'metadata_fetched', 'moved', 'done']
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.lock = threading.Lock()
+        # file path -> merged data of all the records of the file
+        self.states = {}
+        truncated = False
+        if os.path.isfile(self.path):
+            truncated = self._load()
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.f = open(self.path, 'a')
+        if truncated:
+            # Don't append the next record to the incomplete last line
+            self.f.write('\n')
+
+    # Returns True if the last line of the journal is incomplete
+    def _load(self):
+        line = '\n'
+        with open(self.path, 'r') as f:
+            for i, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line might be incomplete if we crashed while writing it
+                    logger.warning('Ignoring invalid line {} in journal {}'.format(i + 1, self.path))
+                    continue
+                self._update_state(record)
+        logger.info('Loaded the state of {} files from journal {}'.format(len(self.states), self.path))
+        return not line.endswith('\n')
+
+    def _update_state(self, record):
+        state = self.states.setdefault(record['file'], {'tmp_files': []})
+        if record['stage'] == 'tmp_file_created':
+            state['tmp_files'].append(record['tmp_file'])
+            return
+        if record['stage'] == 'tmp_file_removed':
+            if record['tmp_file'] in state['tmp_files']:
+                state['tmp_files'].remove(record['tmp_file'])
+            return
+        state.update(record)
+
+    def record(self, file_path, stage, **data):
+        record = {'file': file_path, 'stage': stage}
+        record.update(data)
+        record['time'] = time.time()
+        with self.lock:
+            self.f.write(json.dumps(record) + '\n')
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self._update_state(record)
+
+    def get_state(self, file_path):
+        """
+        :return: dict with the last stage reached by the file (key 'stage') and
+                 the data recorded along the way, or None for a new file
+        """
+        with self.lock:
+            state = self.states.get(file_path)
+            return dict(state, tmp_files=list(state['tmp_files'])) if state else None
+
+    def reached(self, file_path, stage, size=None, mtime=None):
+        """
+        :param size: current size of the file, with `mtime` its current
+                     modification time: if they differ from the recorded
+                     ones, the file was replaced and its stages are ignored
+        """
+        state = self.get_state(file_path)
+        if state is None or state.get('stage') not in self.STAGES:
+            return False
+        if size is not None and 'size' in state and (state['size'], state['mtime']) != (size, mtime):
+            logger.info('{} changed since it was recorded in the journal, ignoring its stages'.format(file_path))
+            return False
+        return self.STAGES.index(state['stage']) >= self.STAGES.index(stage)
+
+    def stale_tmp_files(self):
+        """
+        :return: list of `(file_path, tmp_file)` for the temporary metadata
+                 files that were created but never moved or removed
+        """
+        with self.lock:
+            return [(file_path, tmp_file) for file_path, state in self.states.items()
+                    for tmp_file in state['tmp_files']]
+
+    def close(self):
+        with self.lock:
+            self.f.close()
@@ -0,0 +1,281 @@
+import logging
+import math
+import os
+import time
+
+from utils.cache import SqliteCache
+from utils.ebookmeta import format_metadata
+
+
+logger = logging.getLogger('{}.{}'.format(os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), __name__))
+
+
+# Columns of the `books` table and the calibre fields they are output as
+BOOK_FIELDS = [
+    ('title', 'Title'),
+    ('authors', 'Author(s)'),
+    ('publisher', 'Publisher'),
+    ('series', 'Series'),
+    ('languages', 'Languages'),
+    ('published', 'Published'),
+    ('identifiers', 'Identifiers'),
+]
+# Number of the least common tokens of a search whose books are scored, and
+# maximum number of books scored per token
+SEARCH_TOKENS = 3
+SEARCH_MAX_CANDIDATES = 1000
+# Maximum number of parameters of a SQL statement
+MAX_PARAMS = 500
+
+
+class MetadataIndex(SqliteCache):
+    """
+    Local store of book metadata imported from bulk bibliographic dumps (e.g.
+    the OpenLibrary editions dump), indexed by ISBN so that books can be
+    identified without querying the online sources.
+
+    The metadata is returned in the format of calibre's
+    `fetch-ebook-metadata`, see `BOOK_FIELDS`. The books of a dump are
+    replaced when the dump is imported again.
+
+    The books can also be searched by the tokens of their title and authors
+    (e.g. the tokens of a filename) through an inverted index, see search().
+    """
+    schema = '''
+        CREATE TABLE IF NOT EXISTS books (
+            id          INTEGER PRIMARY KEY,
+            title       TEXT NOT NULL,
+            authors     TEXT,
+            publisher   TEXT,
+            series      TEXT,
+            languages   TEXT,
+            published   TEXT,
+            identifiers TEXT,
+            dump        TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS books_dump ON books (dump);
+        -- ISBN-13 -> book
+        CREATE TABLE IF NOT EXISTS isbns (
+            isbn        TEXT PRIMARY KEY,
+            book_id     INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS isbns_book_id ON isbns (book_id);
+        -- Author names of the dumps where the books only refer to their
+        -- authors, e.g. '/authors/OL1A' in the OpenLibrary dumps
+        CREATE TABLE IF NOT EXISTS authors (
+            key         TEXT PRIMARY KEY,
+            name        TEXT NOT NULL
+        ) WITHOUT ROWID;
+        -- Inverted index of the tokens of the titles and authors
+        CREATE TABLE IF NOT EXISTS book_tokens (
+            token       TEXT NOT NULL,
+            book_id     INTEGER NOT NULL,
+            PRIMARY KEY (token, book_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS book_tokens_book_id ON book_tokens (book_id);
+        -- Number of books with each token, see update_token_counts()
+        CREATE TABLE IF NOT EXISTS token_counts (
+            token       TEXT PRIMARY KEY,
+            books       INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS dumps (
+            dump        TEXT PRIMARY KEY,
+            imported    REAL NOT NULL,
+            records     INTEGER NOT NULL,
+            books       INTEGER NOT NULL,
+            skipped     INTEGER NOT NULL
+        );
+    '''
+
+    def __init__(self, db_path):
+        super().__init__(db_path)
+        # Number of books, cached since counting them is a full scan
+        self._book_count = None
+
+    def get(self, isbn):
+        """
+        :param isbn: ISBN-13
+        :return: the metadata of the book or None if the ISBN is not indexed
+        """
+        rows = self.execute('SELECT {} FROM isbns JOIN books ON books.id=isbns.book_id WHERE isbn=?'.format(
+            ', '.join(column for column, field in BOOK_FIELDS)), (isbn,))
+        if not rows:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return format_metadata(zip((field for column, field in BOOK_FIELDS), rows[0])) + '\n'
+
+    def get_by_id(self, book_id):
+        rows = self.execute('SELECT {} FROM books WHERE id=?'.format(
+            ', '.join(column for column, field in BOOK_FIELDS)), (book_id,))
+        return format_metadata(zip((field for column, field in BOOK_FIELDS), rows[0])) + '\n' if rows else None
+
+    def _select_in(self, sql, values):
+        # Runs `sql` (with one 'IN ({})') on batches of `values`
+        values = list(values)
+        rows = []
+        for i in range(0, len(values), MAX_PARAMS):
+            batch = values[i:i + MAX_PARAMS]
+            rows.extend(self.execute(sql.format(', '.join('?' * len(batch))), batch))
+        return rows
+
+    def search(self, tokens, limit=5):
+        """
+        Searches the books by the tokens of their title and authors. The
+        tokens are weighted by their rarity (inverse document frequency) and
+        the score of a book is the Dice coefficient of its tokens and the
+        searched tokens: 1 if they are the same, 0 if none is shared. The
+        searched tokens that no book has (e.g. 'retail' in a filename) are
+        ignored.
+
+        :param tokens: tokens of e.g. a filename, see `lib.tokenize()`
+        :param limit: maximum number of returned books
+        :return: list of tuples `(score, book_id)` by decreasing score
+        """
+        if self._book_count is None:
+            self._book_count = self.execute('SELECT COUNT(*) FROM books')[0][0]
+        counts = dict(self._select_in('SELECT token, books FROM token_counts WHERE token IN ({})', set(tokens)))
+        tokens = sorted(set(token for token in tokens if counts.get(token)), key=lambda token: counts[token])
+        if not tokens:
+            return []
+
+        def get_weight(token):
+            return math.log(1 + self._book_count / counts.get(token, 1))
+
+        # Only the books having one of the least common tokens are scored
+        book_ids = set()
+        for token in tokens[:SEARCH_TOKENS]:
+            book_ids.update(book_id for book_id, in self.execute(
+                'SELECT book_id FROM book_tokens WHERE token=? LIMIT ?', (token, SEARCH_MAX_CANDIDATES)))
+        book_tokens = {}
+        for book_id, token in self._select_in('SELECT book_id, token FROM book_tokens WHERE book_id IN ({})',
+                                              book_ids):
+            book_tokens.setdefault(book_id, set()).add(token)
+        counts.update(self._select_in('SELECT token, books FROM token_counts WHERE token IN ({})',
+                                      set().union(*book_tokens.values()) - set(counts)))
+        tokens = set(tokens)
+        searched_weight = sum(map(get_weight, tokens))
+        scores = []
+        for book_id, book_token_set in book_tokens.items():
+            shared_weight = sum(map(get_weight, tokens & book_token_set))
+            score = 2 * shared_weight / (searched_weight + sum(map(get_weight, book_token_set)))
+            scores.append((score, book_id))
+        scores.sort(key=lambda score: (-score[0], score[1]))
+        return scores[:limit]
+
+    def get_author_names(self, keys):
+        rows = self.execute('SELECT key, name FROM authors WHERE key IN ({})'.format(', '.join('?' * len(keys))),
+                            list(keys))
+        return dict(rows)
+
+    def clear_dump(self, dump):
+        with self.lock:
+            self.conn.execute('BEGIN')
+            self.conn.execute('DELETE FROM isbns WHERE book_id IN (SELECT id FROM books WHERE dump=?)', (dump,))
+            self.conn.execute('DELETE FROM book_tokens WHERE book_id IN (SELECT id FROM books WHERE dump=?)', (dump,))
+            self.conn.execute('DELETE FROM books WHERE dump=?', (dump,))
+            self.conn.execute('DELETE FROM dumps WHERE dump=?', (dump,))
+            self.conn.execute('COMMIT')
+        self._book_count = None
+
+    def add_authors(self, authors):
+        """
+        :param authors: list of tuples `(key, name)`
+        """
+        with self.lock:
+            self.conn.execute('BEGIN')
+            self.conn.executemany('INSERT OR REPLACE INTO authors VALUES (?, ?)', authors)
+            self.conn.execute('COMMIT')
+
+    def add_books(self, books, dump):
+        """
+        Adds a batch of books in one transaction.
+
+        :param books: list of tuples `(fields, isbns, tokens)` where `fields`
+                      is a dict of the columns of `BOOK_FIELDS`, `isbns` the
+                      ISBN-13s of the book and `tokens` the tokens of its
+                      title and authors
+        :param dump: name of the dump the books come from
+        """
+        with self.lock:
+            self.conn.execute('BEGIN')
+            book_id = self.conn.execute('SELECT COALESCE(MAX(id), 0) FROM books').fetchone()[0]
+            book_rows = []
+            isbn_rows = []
+            token_rows = []
+            for fields, isbns, tokens in books:
+                book_id += 1
+                book_rows.append([book_id] + [fields.get(column) for column, field in BOOK_FIELDS] + [dump])
+                isbn_rows.extend((isbn, book_id) for isbn in isbns)
+                token_rows.extend((token, book_id) for token in set(tokens))
+            columns = ['id'] + [column for column, field in BOOK_FIELDS] + ['dump']
+            self.conn.executemany('INSERT INTO books ({}) VALUES ({})'.format(
+                ', '.join(columns), ', '.join('?' * len(columns))), book_rows)
+            # The last edition imported with a given ISBN wins
+            self.conn.executemany('INSERT OR REPLACE INTO isbns VALUES (?, ?)', isbn_rows)
+            self.conn.executemany('INSERT INTO book_tokens VALUES (?, ?)', token_rows)
+            self.conn.execute('COMMIT')
+        self._book_count = None
+
+    def iter_books(self, batch_size=10000):
+        """
+        Yields the books by batches of tuples `(book_id, title, authors)`.
+        """
+        book_id = 0
+        while True:
+            rows = self.execute('SELECT id, title, authors FROM books WHERE id>? ORDER BY id LIMIT ?',
+                                (book_id, batch_size))
+            if not rows:
+                return
+            yield rows
+            book_id = rows[-1][0]
+
+    def set_book_tokens(self, book_tokens):
+        """
+        Replaces the tokens of books in one transaction.
+
+        :param book_tokens: list of tuples `(book_id, tokens)`
+        """
+        with self.lock:
+            self.conn.execute('BEGIN')
+            self.conn.executemany('DELETE FROM book_tokens WHERE book_id=?', [(book_id,) for book_id, _ in book_tokens])
+            self.conn.executemany('INSERT INTO book_tokens VALUES (?, ?)',
+                                  [(token, book_id) for book_id, tokens in book_tokens for token in set(tokens)])
+            self.conn.execute('COMMIT')
+
+    def update_token_counts(self):
+        # To be called once the books are added, counting the books of every
+        # token is a full scan of the inverted index
+        with self.lock:
+            self.conn.execute('BEGIN')
+            self.conn.execute('DELETE FROM token_counts')
+            self.conn.execute('INSERT INTO token_counts SELECT token, COUNT(*) FROM book_tokens GROUP BY token')
+            self.conn.execute('COMMIT')
+
+    def add_dump(self, dump, records, books, skipped):
+        self.execute('INSERT OR REPLACE INTO dumps VALUES (?, ?, ?, ?, ?)',
+                     (dump, time.time(), records, books, skipped))
+
+    def coverage(self, isbns):
+        """
+        :param isbns: ISBN-13s, e.g. the ISBNs found in a collection of books
+        :return: number of `isbns` that are indexed
+        """
+        return sum(count for count, in self._select_in('SELECT COUNT(*) FROM isbns WHERE isbn IN ({})', set(isbns)))
+
+    def stats(self):
+        stats = {'books': self.execute('SELECT COUNT(*) FROM books')[0][0],
+                 'isbns': self.execute('SELECT COUNT(*) FROM isbns')[0][0],
+                 'authors': self.execute('SELECT COUNT(*) FROM authors')[0][0],
+                 'tokens': self.execute('SELECT COUNT(*) FROM token_counts')[0][0],
+                 'indexed_books': self.execute('SELECT COUNT(DISTINCT book_id) FROM book_tokens')[0][0],
+                 'dumps': [],
+                 'hits': self.hits, 'misses': self.misses}
+        for column, field in BOOK_FIELDS:
+            if column != 'title':
+                stats['with_{}'.format(column)] = self.execute(
+                    "SELECT COUNT(*) FROM books WHERE COALESCE({}, '')!=''".format(column))[0][0]
+        for dump, imported, records, books, skipped in self.execute('SELECT * FROM dumps ORDER BY imported'):
+            stats['dumps'].append({'dump': dump, 'imported': imported, 'records': records, 'books': books,
+                                   'skipped': skipped})
+        return stats
@@ -0,0 +1,140 @@
+import logging
+import os
+import re
+import zipfile
+
+
+logger = logging.getLogger('{}.{}'.format(os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), __name__))
+
+
+# Number of bytes read at the start of a file to sniff its MIME type
+HEAD_SIZE = 8192
+
+# Signatures at the start of a file: (offset, magic bytes, MIME type). The MIME
+# types are the ones reported by `file --brief --mime-type` since they are
+# matched against the config regexes (e.g. `isbn_ignored_files`)
+SIGNATURES = [
+    (0, b'AT&TFORM', 'image/vnd.djvu'),
+    (60, b'BOOKMOBI', 'application/x-mobipocket-ebook'),
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (0, b'II*\x00', 'image/tiff'),
+    (0, b'MM\x00*', 'image/tiff'),
+    (0, b'ID3', 'audio/mpeg'),
+    (0, b'fLaC', 'audio/flac'),
+    (0, b'OggS', 'audio/ogg'),
+    (0, b'\x1aE\xdf\xa3', 'video/x-matroska'),
+    (0, b'FWS', 'application/x-shockwave-flash'),
+    (0, b'CWS', 'application/x-shockwave-flash'),
+    (0, b'ZWS', 'application/x-shockwave-flash'),
+    (0, b'OTTO', 'application/vnd.ms-opentype'),
+    (0, b'\x00\x01\x00\x00\x00', 'application/x-font-ttf'),
+    (0, b'MZ', 'application/x-dosexec'),
+    (0, b'ITSF', 'application/vnd.ms-htmlhelp'),
+    (0, b'\x1f\x8b', 'application/gzip'),
+    (0, b'BZh', 'application/x-bzip2'),
+    (0, b'\xfd7zXZ\x00', 'application/x-xz'),
+    (0, b'7z\xbc\xaf\x27\x1c', 'application/x-7z-compressed'),
+    (0, b'Rar!\x1a\x07', 'application/x-rar'),
+    (0, b'{\\rtf', 'text/rtf'),
+]
+
+# RIFF containers: format at offset 8 -> MIME type
+RIFF_FORMATS = {b'WAVE': 'audio/x-wav', b'AVI ': 'video/x-msvideo', b'WEBP': 'image/webp'}
+
+# Magic bytes of the Compound File Binary Format (CDFV2) used by the old
+# Microsoft Office documents
+CDFV2_MAGIC = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+# Names (in UTF-16) of the streams of a CDFV2 file identifying its type
+CDFV2_STREAMS = [('WordDocument'.encode('utf-16-le'), 'application/msword'),
+                 ('Workbook'.encode('utf-16-le'), 'application/vnd.ms-excel'),
+                 ('PowerPoint Document'.encode('utf-16-le'), 'application/vnd.ms-powerpoint')]
+
+# Control characters that are not expected in a text file
+BINARY_CHARS = bytes(set(range(32)) - {7, 8, 9, 10, 12, 13, 27})
+# e.g. <!DOCTYPE html> or <html>, possibly after a BOM and whitespaces
+HTML_REGEX = re.compile(rb'^(\xef\xbb\xbf)?\s*(<!--.*?-->\s*)*<(!doctype html|html|head|body)[\s>]', re.I | re.S)
+XML_REGEX = re.compile(rb'^(\xef\xbb\xbf)?\s*<\?xml[\s?]')
+SVG_REGEX = re.compile(rb'<svg[\s>]')
+
+
+def sniff_mime_type(path):
+    """
+    Returns the MIME type of a file by looking at its magic bytes, without
+    spawning a `file` process.
+
+    Only the types that matter to the ISBN search and the corruption checks
+    are recognized: pdf, djvu, mobi, zip-based formats (epub, docx, odt, ...),
+    text/html/xml, images, audio/video, CDFV2 documents, fonts, executables and
+    compressed files.
+
+    :param path: path of the file
+    :return str: the MIME type as reported by `file --brief --mime-type`, or
+                 None if the signature is unknown
+    """
+    with open(path, 'rb') as f:
+        head = f.read(HEAD_SIZE)
+    if not head:
+        return 'inode/x-empty'
+    # Like `file`, the pdf header can be preceded by some garbage
+    if b'%PDF-' in head[:1024]:
+        return 'application/pdf'
+    if head.startswith((b'PK\x03\x04', b'PK\x05\x06')):
+        return _sniff_zip_mime_type(path, head)
+    if head.startswith(CDFV2_MAGIC):
+        for stream_name, mime_type in CDFV2_STREAMS:
+            if stream_name in head:
+                return mime_type
+        # The directory of the streams is not in the head of the file
+        return None
+    if head.startswith(b'RIFF') and head[8:12] in RIFF_FORMATS:
+        return RIFF_FORMATS[head[8:12]]
+    if head[4:8] == b'ftyp':
+        return 'audio/x-m4a' if head[8:11] == b'M4A' else 'video/mp4'
+    for offset, magic, mime_type in SIGNATURES:
+        if head.startswith(magic, offset):
+            return mime_type
+    return _sniff_text_mime_type(head)
+
+
+def _sniff_zip_mime_type(path, head):
+    # OCF (epub) and OpenDocument files start with an uncompressed `mimetype`
+    # member containing the MIME type
+    if head[30:38] == b'mimetype':
+        name_length = int.from_bytes(head[26:28], 'little')
+        extra_length = int.from_bytes(head[28:30], 'little')
+        size = int.from_bytes(head[18:22], 'little')
+        start = 30 + name_length + extra_length
+        mime_type = head[start:start+size].decode('ascii', errors='replace').strip()
+        if re.match(r'^application/[\w.+-]+$', mime_type):
+            return mime_type
+    try:
+        with zipfile.ZipFile(path) as zip_file:
+            names = zip_file.namelist()
+    except (zipfile.BadZipFile, OSError):
+        return 'application/zip'
+    if '[Content_Types].xml' in names:
+        for prefix, mime_type in [
+                ('word/', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'),
+                ('xl/', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+                ('ppt/', 'application/vnd.openxmlformats-officedocument.presentationml.presentation')]:
+            if any(name.startswith(prefix) for name in names):
+                return mime_type
+    return 'application/zip'
+
+
+def _sniff_text_mime_type(head):
+    if b'\x00' in head:
+        # UTF-16 text or an unknown binary format
+        return None
+    if len(head.translate(None, BINARY_CHARS)) < len(head):
+        return None
+    if HTML_REGEX.match(head):
+        return 'text/html'
+    if XML_REGEX.match(head):
+        return 'image/svg+xml' if SVG_REGEX.search(head) else 'text/xml'
+    if head.lstrip().startswith(b'<svg'):
+        return 'image/svg+xml'
+    return 'text/plain'
@@ -1,3 +1,4 @@
+import hashlib
 import os
 
 
@@ -13,3 +14,20 @@ def file_exists(path):
     """
     path = os.path.expanduser(path)
     return os.path.isfile(path)
+
+
+def get_file_hash(path, algorithm='sha1', chunk_size=1024*1024):
+    """
+    Returns the hex digest of the content of a file, computed by reading the
+    file in chunks so that big files are never loaded in memory.
+
+    :param path: path of the file to hash
+    :param algorithm: name of the hashlib algorithm
+    :param chunk_size: number of bytes read at once
+    :return str: hex digest of the file content
+    """
+    h = hashlib.new(algorithm)
+    with open(os.path.expanduser(path), 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
@@ -0,0 +1,546 @@
+import collections
+import logging
+import mmap
+import os
+import re
+import zlib
+
+
+logger = logging.getLogger('{}.{}'.format(os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), __name__))
+
+
+# Maximum number of bytes at the end of the file where `startxref` is searched
+STARTXREF_WINDOW = 4096
+# Maximum number of pages whose boxes are read
+MAX_PAGE_BOXES = 100000
+
+WHITESPACE = b'\x00\t\n\x0c\r '
+DELIMITERS = b'()<>[]{}/%'
+
+WS_RE = re.compile(rb'(?:[\x00\t\n\x0c\r ]|%[^\r\n]*)*')
+NUMBER_RE = re.compile(rb'[+-]?(?:\d+\.?\d*|\.\d+)')
+NAME_RE = re.compile(rb'/([^\x00\t\n\x0c\r ()<>\[\]{}/%]*)')
+KEYWORD_RE = re.compile(rb'[A-Za-z]+')
+REF_RE = re.compile(rb'\s+(\d+)\s+R(?![^\x00\t\n\x0c\r ()<>\[\]{}/%])')
+OBJ_RE = re.compile(rb'\s*(\d+)\s+(\d+)\s+obj(?![^\x00\t\n\x0c\r ()<>\[\]{}/%])')
+ANY_OBJ_RE = re.compile(rb'(?<![0-9])(\d+)\s+(\d+)\s+obj(?![^\x00\t\n\x0c\r ()<>\[\]{}/%])')
+XREF_ENTRY_RE = re.compile(rb'(\d{1,10})\s+(\d{1,5})\s+([nf])')
+STREAM_RE = re.compile(rb'\s*stream(?:\r\n|\n|\r)')
+ESCAPE_RE = re.compile(rb'\\(\r\n|[0-7]{1,3}|.)', re.S)
+ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f',
+           b'\r\n': b'', b'\r': b'', b'\n': b''}
+
+PdfRef = collections.namedtuple('PdfRef', 'num gen')
+
+
+class PdfError(Exception):
+    pass
+
+
+class PdfInfo:
+    """
+    Result of inspect_pdf().
+
+    :ivar page_count: number of pages (`/Count` of the page tree), None if it
+                      could not be found
+    :ivar page_sizes: list of the `(width, height)` in points of the pages, from
+                      their CropBox or MediaBox (what `pdfinfo` reports as
+                      "Page size")
+    :ivar encrypted: True if the document is encrypted
+    :ivar damaged: True if the cross-reference data is missing or wrong, i.e.
+                   the objects had to be found by scanning the whole file
+    :ivar errors: list of the problems found
+    """
+    def __init__(self):
+        self.page_count = None
+        self.page_sizes = []
+        self.encrypted = False
+        self.damaged = False
+        self.errors = []
+
+    def __repr__(self):
+        return 'PdfInfo(page_count={}, encrypted={}, damaged={}, errors={})'.format(
+            self.page_count, self.encrypted, self.damaged, self.errors)
+
+
+class PdfReader:
+    """
+    Minimal PDF object reader: it only parses what is needed to find the page
+    tree (cross-reference tables and streams, object streams, dictionaries,
+    arrays, ...), directly from a memory-mapped file.
+    """
+    def __init__(self, data):
+        self.data = data
+        # object number -> (1, offset) or (2, object stream number, index)
+        self.xref = {}
+        self.trailer = {}
+        self._object_streams = {}
+
+    # ========================================================================
+    # Lexer/parser
+    # ========================================================================
+    def skip_ws(self, data, pos):
+        return WS_RE.match(data, pos).end()
+
+    def parse_object(self, data, pos):
+        pos = self.skip_ws(data, pos)
+        c = data[pos:pos+1]
+        if c == b'<':
+            if data[pos+1:pos+2] == b'<':
+                return self._parse_dict(data, pos + 2)
+            end = data.find(b'>', pos)
+            if end < 0:
+                raise PdfError('Unterminated hex string at {}'.format(pos))
+            hex_digits = re.sub(rb'\s', b'', data[pos+1:end])
+            try:
+                return bytes.fromhex((hex_digits + b'0' * (len(hex_digits) % 2)).decode('ascii')), end + 1
+            except (UnicodeDecodeError, ValueError):
+                raise PdfError('Invalid hex string at {}'.format(pos))
+        if c == b'[':
+            array = []
+            pos += 1
+            while True:
+                pos = self.skip_ws(data, pos)
+                if data[pos:pos+1] == b']':
+                    return array, pos + 1
+                if pos >= len(data):
+                    raise PdfError('Unterminated array')
+                obj, pos = self.parse_object(data, pos)
+                array.append(obj)
+        if c == b'(':
+            return self._parse_literal_string(data, pos)
+        if c == b'/':
+            match = NAME_RE.match(data, pos)
+            name = re.sub(rb'#([0-9A-Fa-f]{2})', lambda m: bytes([int(m.group(1), 16)]), match.group(1))
+            return name.decode('latin-1'), match.end()
+        match = NUMBER_RE.match(data, pos)
+        if match:
+            token = match.group()
+            if b'.' in token:
+                return float(token), match.end()
+            ref = REF_RE.match(data, match.end())
+            if ref:
+                return PdfRef(int(token), int(ref.group(1))), ref.end()
+            return int(token), match.end()
+        match = KEYWORD_RE.match(data, pos)
+        if match:
+            keyword = match.group()
+            if keyword in (b'true', b'false'):
+                return keyword == b'true', match.end()
+            if keyword == b'null':
+                return None, match.end()
+        raise PdfError('Unexpected token at {}: {!r}'.format(pos, bytes(data[pos:pos+10])))
+
+    def _parse_dict(self, data, pos):
+        d = {}
+        while True:
+            pos = self.skip_ws(data, pos)
+            if data[pos:pos+2] == b'>>':
+                return d, pos + 2
+            if data[pos:pos+1] != b'/':
+                raise PdfError('Expected a name in dictionary at {}'.format(pos))
+            key, pos = self.parse_object(data, pos)
+            value, pos = self.parse_object(data, pos)
+            d[key] = value
+
+    def _parse_literal_string(self, data, pos):
+        depth = 0
+        i = pos
+        while i < len(data):
+            c = data[i:i+1]
+            if c == b'\\':
+                i += 2
+                continue
+            if c == b'(':
+                depth += 1
+            elif c == b')':
+                depth -= 1
+                if depth == 0:
+                    return ESCAPE_RE.sub(self._unescape, data[pos+1:i]), i + 1
+            i += 1
+        raise PdfError('Unterminated string at {}'.format(pos))
+
+    @staticmethod
+    def _unescape(match):
+        escape = match.group(1)
+        if escape in ESCAPES:
+            return ESCAPES[escape]
+        if escape[:1].isdigit():
+            return bytes([int(escape, 8) & 0xff])
+        return escape
+
+    # ========================================================================
+    # Indirect objects and streams
+    # ========================================================================
+    def parse_indirect_object(self, pos, num=None):
+        """
+        :return: tuple `(object, stream data or None)`
+        """
+        match = OBJ_RE.match(self.data, pos)
+        if not match or (num is not None and int(match.group(1)) != num):
+            raise PdfError('No object {} at offset {}'.format(num, pos))
+        obj, pos = self.parse_object(self.data, match.end())
+        stream = None
+        if isinstance(obj, dict):
+            match = STREAM_RE.match(self.data, pos)
+            if match:
+                length = self.resolve(obj.get('Length'))
+                start = match.end()
+                if not isinstance(length, int) or self.data[start+length:start+length+30].find(b'endstream') < 0:
+                    # Wrong /Length: look for the end of the stream instead
+                    end = self.data.find(b'endstream', start)
+                    if end < 0:
+                        raise PdfError('Unterminated stream at {}'.format(start))
+                    length = len(self.data[start:end].rstrip(b'\r\n'))
+                stream = self.data[start:start+length]
+        return obj, stream
+
+    def decode_stream(self, obj, stream):
+        filters = obj.get('Filter')
+        if filters is None:
+            filters = []
+        elif not isinstance(filters, list):
+            filters = [filters]
+        params = obj.get('DecodeParms')
+        for f in filters:
+            if f not in ('FlateDecode', 'Fl'):
+                raise PdfError('Unsupported stream filter {}'.format(f))
+            stream = zlib.decompressobj().decompress(stream)
+        if isinstance(params, list):
+            params = params[0] if params else None
+        if isinstance(params, dict) and params.get('Predictor', 1) >= 10:
+            stream = self._unpredict_png(stream, params.get('Columns', 1))
+        return stream
+
+    @staticmethod
+    def _unpredict_png(data, columns):
+        rows = []
+        prev = bytearray(columns)
+        for i in range(0, len(data) - columns, columns + 1):
+            filter_type = data[i]
+            row = bytearray(data[i+1:i+1+columns])
+            for j in range(len(row)):
+                left = row[j-1] if j > 0 else 0
+                up = prev[j]
+                up_left = prev[j-1] if j > 0 else 0
+                if filter_type == 1:
+                    row[j] = (row[j] + left) & 0xff
+                elif filter_type == 2:
+                    row[j] = (row[j] + up) & 0xff
+                elif filter_type == 3:
+                    row[j] = (row[j] + ((left + up) >> 1)) & 0xff
+                elif filter_type == 4:
+                    p = left + up - up_left
+                    pa, pb, pc = abs(p - left), abs(p - up), abs(p - up_left)
+                    predictor = left if pa <= pb and pa <= pc else (up if pb <= pc else up_left)
+                    row[j] = (row[j] + predictor) & 0xff
+            rows.append(bytes(row))
+            prev = row
+        return b''.join(rows)
+
+    def get_object(self, num):
+        entry = self.xref.get(num)
+        if entry is None:
+            return None
+        if entry[0] == 1:
+            return self.parse_indirect_object(entry[1], num)[0]
+        stream_num, index = entry[1], entry[2]
+        if stream_num not in self._object_streams:
+            obj, stream = self.parse_indirect_object(self.xref[stream_num][1], stream_num)
+            data = self.decode_stream(obj, stream)
+            header = data[:obj['First']].split()
+            offsets = {int(header[i]): int(header[i+1]) for i in range(0, len(header) - 1, 2)}
+            self._object_streams[stream_num] = (data, obj['First'], offsets)
+        data, first, offsets = self._object_streams[stream_num]
+        if num not in offsets:
+            raise PdfError('Object {} not in object stream {}'.format(num, stream_num))
+        return self.parse_object(data, first + offsets[num])[0]
+
+    def resolve(self, obj):
+        seen = set()
+        while isinstance(obj, PdfRef):
+            if obj in seen:
+                raise PdfError('Reference loop on {}'.format(obj))
+            seen.add(obj)
+            obj = self.get_object(obj.num)
+        return obj
+
+    # ========================================================================
+    # Cross-reference data
+    # ========================================================================
+    def read_xref(self):
+        tail_start = max(0, len(self.data) - STARTXREF_WINDOW)
+        pos = self.data.rfind(b'startxref', tail_start)
+        if pos < 0:
+            raise PdfError('startxref not found')
+        offset, _ = self.parse_object(self.data, pos + len(b'startxref'))
+        visited = set()
+        while isinstance(offset, int) and offset not in visited:
+            visited.add(offset)
+            trailer = self._read_xref_section(offset)
+            for key, value in trailer.items():
+                self.trailer.setdefault(key, value)
+            if isinstance(trailer.get('XRefStm'), int):
+                self._read_xref_section(trailer['XRefStm'])
+            offset = trailer.get('Prev')
+
+    def _read_xref_section(self, offset):
+        pos = self.skip_ws(self.data, offset)
+        if self.data[pos:pos+4] == b'xref':
+            return self._read_xref_table(pos + 4)
+        obj, stream = self.parse_indirect_object(offset)
+        if not isinstance(obj, dict) or obj.get('Type') != 'XRef' or stream is None:
+            raise PdfError('No cross-reference data at offset {}'.format(offset))
+        self._read_xref_stream(obj, self.decode_stream(obj, stream))
+        return obj
+
+    def _read_xref_table(self, pos):
+        while True:
+            pos = self.skip_ws(self.data, pos)
+            if self.data[pos:pos+7] == b'trailer':
+                return self.parse_object(self.data, pos + 7)[0]
+            start, pos = self.parse_object(self.data, pos)
+            count, pos = self.parse_object(self.data, pos)
+            for num in range(start, start + count):
+                match = XREF_ENTRY_RE.match(self.data, self.skip_ws(self.data, pos))
+                if not match:
+                    raise PdfError('Invalid cross-reference entry at {}'.format(pos))
+                pos = match.end()
+                if match.group(3) == b'n':
+                    self.xref.setdefault(num, (1, int(match.group(1))))
+                else:
+                    self.xref.setdefault(num, (0,))
+
+    def _read_xref_stream(self, obj, data):
+        widths = obj['W']
+        index = obj.get('Index', [0, obj['Size']])
+        entry_size = sum(widths)
+        pos = 0
+        for start, count in zip(index[::2], index[1::2]):
+            for num in range(start, start + count):
+                fields = []
+                for width in widths:
+                    fields.append(int.from_bytes(data[pos:pos+width], 'big'))
+                    pos += width
+                entry_type = fields[0] if widths[0] else 1
+                if entry_type == 1:
+                    self.xref.setdefault(num, (1, fields[1]))
+                elif entry_type == 2:
+                    self.xref.setdefault(num, (2, fields[1], fields[2]))
+                else:
+                    self.xref.setdefault(num, (0,))
+                if pos + entry_size > len(data):
+                    return
+
+    def rebuild_xref(self):
+        """
+        Rebuilds the cross-reference data of a damaged file by scanning it for
+        `N G obj` and recovers the trailer from the last `trailer` dictionary or
+        cross-reference stream.
+        """
+        self.xref = {}
+        self._object_streams = {}
+        for match in ANY_OBJ_RE.finditer(self.data):
+            self.xref[int(match.group(1))] = (1, match.start())
+        pos = self.data.rfind(b'trailer')
+        if pos >= 0:
+            try:
+                self.trailer = self.parse_object(self.data, pos + 7)[0]
+            except (PdfError, IndexError, ValueError):
+                self.trailer = {}
+        if 'Root' not in self.trailer:
+            for num, entry in list(self.xref.items()):
+                try:
+                    obj, stream = self.parse_indirect_object(entry[1], num)
+                except (PdfError, IndexError, ValueError):
+                    continue
+                if isinstance(obj, dict) and obj.get('Type') == 'XRef' and 'Root' in obj:
+                    self.trailer = obj
+                elif isinstance(obj, dict) and obj.get('Type') == 'ObjStm' and stream is not None:
+                    self._index_object_stream(num, obj, stream)
+        if 'Root' not in self.trailer:
+            # No trailer left: look for the document catalog itself
+            for num in list(self.xref):
+                try:
+                    obj = self.get_object(num)
+                except (PdfError, IndexError, KeyError, TypeError, ValueError, zlib.error):
+                    continue
+                if isinstance(obj, dict) and obj.get('Type') == 'Catalog':
+                    self.trailer['Root'] = PdfRef(num, 0)
+                    break
+
+    def _index_object_stream(self, stream_num, obj, stream):
+        try:
+            data = self.decode_stream(obj, stream)
+        except (PdfError, zlib.error):
+            return
+        header = data[:obj.get('First', 0)].split()
+        for i in range(0, len(header) - 1, 2):
+            self.xref.setdefault(int(header[i]), (2, stream_num, i // 2))
+
+    # ========================================================================
+    # Page tree
+    # ========================================================================
+    def get_pages(self):
+        root = self.resolve(self.trailer.get('Root'))
+        if not isinstance(root, dict):
+            raise PdfError('Document catalog not found')
+        pages = self.resolve(root.get('Pages'))
+        if not isinstance(pages, dict):
+            raise PdfError('Page tree not found')
+        return pages
+
+    def iter_page_boxes(self, pages, max_pages=MAX_PAGE_BOXES):
+        """
+        Yields the CropBox (or MediaBox) of the pages, handling the attributes
+        inherited from the parent nodes.
+        """
+        stack = [(pages, {})]
+        visited = set()
+        n_pages = 0
+        while stack and n_pages < max_pages:
+            node, inherited = stack.pop()
+            inherited = dict(inherited, **{k: node[k] for k in ('MediaBox', 'CropBox') if k in node})
+            kids = self.resolve(node.get('Kids'))
+            if node.get('Type') == 'Page' or kids is None:
+                n_pages += 1
+                yield self.resolve(inherited.get('CropBox', inherited.get('MediaBox')))
+                continue
+            for kid in reversed(kids):
+                if isinstance(kid, PdfRef):
+                    if kid in visited:
+                        raise PdfError('Loop in the page tree on {}'.format(kid))
+                    visited.add(kid)
+                kid = self.resolve(kid)
+                if isinstance(kid, dict):
+                    stack.append((kid, inherited))
+
+
+def get_box_size(box):
+    if not isinstance(box, list) or len(box) != 4:
+        return 0, 0
+    try:
+        x0, y0, x1, y1 = [float(v) for v in box]
+    except (TypeError, ValueError):
+        return 0, 0
+    return abs(x1 - x0), abs(y1 - y0)
+
+
+def inspect_pdf(path, max_page_boxes=MAX_PAGE_BOXES):
+    """
+    Inspects the structure of a pdf file without any external tool (e.g.
+    `pdfinfo`): the cross-reference tables/streams and the object streams are
+    read from the memory-mapped file to find the page tree.
+
+    If the cross-reference data is damaged, the objects are found by scanning
+    the whole file (like pdf readers do) and `damaged` is set.
+
+    :param path: path of the pdf file
+    :param max_page_boxes: maximum number of pages whose sizes are read
+    :return PdfInfo: page count, page sizes, encryption and damage flags
+    """
+    info = PdfInfo()
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            info.damaged = True
+            info.errors.append('Empty file')
+            return info
+    with data:
+        if data.find(b'%PDF-', 0, 1024) < 0:
+            info.errors.append('No pdf header')
+            info.damaged = True
+        reader = PdfReader(data)
+        try:
+            reader.read_xref()
+            pages = reader.get_pages()
+        except (PdfError, IndexError, KeyError, TypeError, ValueError, zlib.error) as e:
+            info.damaged = True
+            info.errors.append('Invalid cross-reference data: {}'.format(e))
+            reader.rebuild_xref()
+            try:
+                pages = reader.get_pages()
+            except (PdfError, IndexError, KeyError, TypeError, ValueError, zlib.error) as e:
+                info.errors.append('Could not read the page tree: {}'.format(e))
+                pages = None
+        info.encrypted = 'Encrypt' in reader.trailer
+        if pages is None:
+            return info
+        count = reader.resolve(pages.get('Count'))
+        info.page_count = count if isinstance(count, int) else None
+        try:
+            info.page_sizes = [get_box_size(box) for box in reader.iter_page_boxes(pages, max_page_boxes)]
+        except (PdfError, IndexError, KeyError, TypeError, ValueError, zlib.error) as e:
+            info.errors.append('Could not read the page boxes: {}'.format(e))
+        if info.page_count is not None and info.page_count < max_page_boxes and \
+                len(info.page_sizes) != info.page_count:
+            info.damaged = True
+            info.errors.append('The page tree has {} pages but /Count is {}'.format(
+                len(info.page_sizes), info.page_count))
+    return info
+
+
+def decode_pdf_text(value):
+    """
+    Decodes a pdf text string: UTF-16 if it starts with a BOM, else
+    PDFDocEncoding (approximated with latin-1).
+    """
+    if not isinstance(value, bytes):
+        return str(value)
+    if value.startswith((b'\xfe\xff', b'\xff\xfe')):
+        return value.decode('utf-16', errors='replace')
+    if value.startswith(b'\xef\xbb\xbf'):
+        return value[3:].decode('utf-8', errors='replace')
+    return value.decode('latin-1')
+
+
+def get_pdf_metadata(path):
+    """
+    Reads the document information dictionary and the XMP metadata of a pdf
+    file.
+
+    :param path: path of the pdf file
+    :return: tuple `(info, xmp)` where `info` is a dict of the text entries of
+             the Info dictionary (e.g. 'Title', 'Author') and `xmp` the XMP
+             packet (bytes) or None. Returns None if the file can't be parsed
+             or is encrypted (its strings can't be read without decrypting).
+    """
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return None
+    with data:
+        reader = PdfReader(data)
+        errors = (PdfError, IndexError, KeyError, TypeError, ValueError, zlib.error)
+        try:
+            reader.read_xref()
+        except errors:
+            reader.rebuild_xref()
+        if 'Encrypt' in reader.trailer or 'Root' not in reader.trailer:
+            return None
+        info = {}
+        try:
+            info_dict = reader.resolve(reader.trailer.get('Info'))
+            if isinstance(info_dict, dict):
+                for key, value in info_dict.items():
+                    value = reader.resolve(value)
+                    if isinstance(value, bytes):
+                        info[key] = decode_pdf_text(value).strip('\x00').strip()
+        except errors as e:
+            logger.debug('Could not read the Info dictionary of {}: {}'.format(path, e))
+        xmp = None
+        try:
+            root = reader.resolve(reader.trailer['Root'])
+            metadata = root.get('Metadata') if isinstance(root, dict) else None
+            if isinstance(metadata, PdfRef):
+                entry = reader.xref.get(metadata.num)
+                if entry and entry[0] == 1:
+                    obj, stream = reader.parse_indirect_object(entry[1], metadata.num)
+                    if stream is not None:
+                        xmp = reader.decode_stream(obj, stream)
+        except errors as e:
+            logger.debug('Could not read the XMP metadata of {}: {}'.format(path, e))
+        return info, xmp
@@ -0,0 +1,134 @@
+import logging
+import os
+import queue
+import threading
+
+
+logger = logging.getLogger('{}.{}'.format(os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), __name__))
+
+
+# Sentinel put in a stage's queue to stop one of its workers
+_STOP = object()
+
+
+class Stage:
+    def __init__(self, name, func, jobs, queue_size):
+        self.name = name
+        self.func = func
+        self.jobs = max(1, jobs)
+        # Bounded queue: producers block when it is full (backpressure)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.workers = []
+        self.processed = 0
+
+
+class Pipeline:
+    """
+    Chain of stages connected by bounded queues, each stage being served by
+    its own pool of worker threads.
+
+    A stage function receives an item and returns either None (the item is
+    done) or a tuple `(stage_name, new_item)` to forward `new_item` to another
+    stage. Items can only be forwarded to stages that were added after the
+    current one, e.g. a corrupt file can skip the ISBN stages and go directly
+    to the move stage.
+
+    Since all the queues are bounded, the number of items in flight (and thus
+    the memory used) stays constant no matter how many items are fed.
+
+    :param on_error: function called as `on_error(stage_name, item, exception)`
+                     from the `except` block of the worker when a stage
+                     raises, e.g. to report the failed item (the traceback is
+                     then available through `sys.exc_info()`)
+    """
+    def __init__(self, queue_size=100, on_error=None):
+        self.queue_size = queue_size
+        self.on_error = on_error
+        self.stages = []
+        self.stages_by_name = {}
+        self.errors = []
+        self._in_flight = 0
+        self._cond = threading.Condition()
+
+    def add_stage(self, name, func, jobs=1):
+        stage = Stage(name, func, jobs, self.queue_size)
+        self.stages.append(stage)
+        self.stages_by_name[name] = stage
+        return stage
+
+    def _worker(self, stage):
+        while True:
+            item = stage.queue.get()
+            if item is _STOP:
+                return
+            try:
+                result = stage.func(item)
+                if result is not None:
+                    next_stage_name, next_item = result
+                    self._forward(stage, next_stage_name, next_item)
+            except Exception as e:
+                with self._cond:
+                    self.errors.append((stage.name, item, e))
+                if self.on_error is None:
+                    logger.exception('Stage {} failed on {}'.format(stage.name, item))
+                else:
+                    try:
+                        self.on_error(stage.name, item, e)
+                    except Exception:
+                        logger.exception('Could not handle the failure of stage {} on {}'.format(stage.name, item))
+            finally:
+                stage.processed += 1
+                self._done()
+
+    def _forward(self, stage, next_stage_name, next_item):
+        next_stage = self.stages_by_name[next_stage_name]
+        if self.stages.index(next_stage) <= self.stages.index(stage):
+            raise ValueError('Stage {} can not forward items to stage {}'.format(stage.name, next_stage_name))
+        with self._cond:
+            self._in_flight += 1
+        next_stage.queue.put(next_item)
+
+    def _done(self):
+        with self._cond:
+            self._in_flight -= 1
+            if self._in_flight == 0:
+                self._cond.notify_all()
+
+    def run(self, items, stop_on_error=None):
+        """
+        Feeds `items` to the first stage and blocks until every item went
+        through the pipeline.
+
+        :param items: iterable of items, consumed lazily
+        :param stop_on_error: exception type(s) that stop feeding new items
+        :return: list of `(stage_name, item, exception)` for the failed items
+        """
+        if not self.stages:
+            raise ValueError('The pipeline has no stages')
+        for stage in self.stages:
+            for i in range(stage.jobs):
+                t = threading.Thread(target=self._worker, args=(stage,),
+                                     name='{}-{}'.format(stage.name, i), daemon=True)
+                t.start()
+                stage.workers.append(t)
+        first_stage = self.stages[0]
+        for item in items:
+            if stop_on_error is not None:
+                with self._cond:
+                    if any(isinstance(e, stop_on_error) for _, _, e in self.errors):
+                        logger.info('Error in the pipeline, not feeding any more items')
+                        break
+            with self._cond:
+                self._in_flight += 1
+            first_stage.queue.put(item)
+        # Wait until all the items (including the forwarded ones) are done
+        with self._cond:
+            while self._in_flight > 0:
+                self._cond.wait()
+        for stage in self.stages:
+            for _ in stage.workers:
+                stage.queue.put(_STOP)
+            for t in stage.workers:
+                t.join()
+            logger.info('Stage {} processed {} items'.format(stage.name, stage.processed))
+        return self.errors
@@ -0,0 +1,218 @@
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger('{}.{}'.format(os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), __name__))
+
+
+# Outcomes of a call to a source
+SUCCESS = 'success'
+# The source answered but found nothing
+EMPTY = 'empty'
+# The source failed (error, throttling) or timed out: counts toward opening the
+# circuit
+FAILURE = 'failure'
+# The call was cancelled by the caller, e.g. another source already answered:
+# nothing is learned about the source
+CANCELLED = 'cancelled'
+
+
+class TokenBucket:
+    """
+    Token bucket allowing `rate` calls per second on average, with bursts of
+    up to `capacity` calls.
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, cancel_event=None, poll_interval=0.5):
+        """
+        Waits until a token is available and takes it.
+
+        :return bool: False if `cancel_event` was set while waiting
+        """
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if cancel_event is None:
+                time.sleep(wait)
+            elif cancel_event.wait(min(wait, poll_interval)):
+                return False
+
+
+class SourceStats:
+    """
+    Calls, outcomes and latency of a source, and the state of its circuit.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.successes = 0
+        self.empties = 0
+        self.failures = 0
+        self.cancelled = 0
+        self.skipped = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.consecutive_failures = 0
+        # The circuit is open (calls are skipped) until this time
+        self.open_until = 0.0
+        # A call is being made after the cool-down to test the source
+        self.half_open = False
+
+    def success_rate(self):
+        # Smoothed so that a source never called is neither favored nor
+        # penalized compared to the others
+        return (self.successes + 1) / (self.successes + self.empties + self.failures + 2)
+
+    def mean_latency(self):
+        answered = self.successes + self.empties + self.failures
+        return self.total_latency / answered if answered else 0.0
+
+
+class FetchScheduler:
+    """
+    Decides when (and whether) a source can be called, from the outcomes of
+    the previous calls:
+
+    - rate limit: each source has its own token bucket, e.g. to stay under
+      the throttling threshold of Amazon
+    - circuit breaker: after `failure_threshold` consecutive failures, the
+      source is skipped for `cooldown` seconds. Then a single call is let
+      through: the circuit is closed again if it succeeds, else it is opened
+      for another cool-down
+    - ordering: the sources can be sorted by observed success rate
+
+    :param rate_limits: dict of maximum calls per minute by source
+    :param default_rate_limit: maximum calls per minute of the other sources
+                               (0: no limit)
+    :param failure_threshold: consecutive failures opening the circuit of a
+                              source (0: the circuit is never opened)
+    :param cooldown: seconds during which the calls to a failing source are
+                     skipped
+    """
+    def __init__(self, rate_limits=None, default_rate_limit=0, failure_threshold=3, cooldown=300):
+        self.rate_limits = rate_limits or {}
+        self.default_rate_limit = default_rate_limit
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.sources = {}
+
+    def _get_stats(self, source):
+        if source not in self.sources:
+            self.sources[source] = SourceStats()
+        return self.sources[source]
+
+    def _get_bucket(self, source):
+        with self.lock:
+            if source not in self.buckets:
+                rate_limit = self.rate_limits.get(source, self.default_rate_limit)
+                self.buckets[source] = TokenBucket(rate_limit / 60) if rate_limit else None
+            return self.buckets[source]
+
+    def acquire(self, source, cancel_event=None):
+        """
+        Waits for the rate limit of `source` before a call.
+
+        :return bool: False if the call must be skipped since the circuit of
+                      the source is open (or `cancel_event` was set)
+        """
+        with self.lock:
+            stats = self._get_stats(source)
+            now = time.time()
+            if stats.open_until > now or stats.half_open:
+                stats.skipped += 1
+                return False
+            if stats.open_until:
+                # End of the cool-down: this call tests the source
+                logger.info('Cool-down of {} is over, trying it again'.format(source))
+                stats.half_open = True
+        bucket = self._get_bucket(source)
+        if bucket is not None and not bucket.acquire(cancel_event):
+            self.release(source)
+            return False
+        return True
+
+    def release(self, source):
+        # The call allowed by acquire() was not made
+        with self.lock:
+            self._get_stats(source).half_open = False
+
+    def record(self, source, outcome, latency):
+        with self.lock:
+            stats = self._get_stats(source)
+            stats.half_open = False
+            if outcome == CANCELLED:
+                stats.cancelled += 1
+                return
+            stats.calls += 1
+            stats.total_latency += latency
+            stats.max_latency = max(stats.max_latency, latency)
+            if outcome != FAILURE:
+                if outcome == SUCCESS:
+                    stats.successes += 1
+                else:
+                    stats.empties += 1
+                if stats.open_until:
+                    logger.info('{} is answering again, closing its circuit'.format(source))
+                stats.consecutive_failures = 0
+                stats.open_until = 0.0
+                return
+            stats.failures += 1
+            stats.consecutive_failures += 1
+            if self.failure_threshold and (stats.open_until or
+                                           stats.consecutive_failures >= self.failure_threshold):
+                logger.info('{} failed {} times in a row, skipping it for {} s'.format(
+                    source, stats.consecutive_failures, self.cooldown))
+                stats.open_until = time.time() + self.cooldown
+
+    def is_open(self, source):
+        with self.lock:
+            return self._get_stats(source).open_until > time.time()
+
+    def order(self, sources, key=None):
+        """
+        Returns `sources` sorted by decreasing success rate, the sources with
+        an open circuit coming last. The sort is stable: the initial order
+        breaks the ties.
+
+        :param key: function returning the name of a source in `sources`
+                    (e.g. without quotes)
+        """
+        key = key or (lambda source: source)
+        now = time.time()
+        with self.lock:
+            def get_rank(source):
+                stats = self._get_stats(key(source))
+                return stats.open_until > now, -stats.success_rate()
+            return sorted(sources, key=get_rank)
+
+    def stats(self):
+        with self.lock:
+            return {source: {'calls': stats.calls,
+                             'successes': stats.successes,
+                             'empties': stats.empties,
+                             'failures': stats.failures,
+                             'cancelled': stats.cancelled,
+                             'skipped': stats.skipped,
+                             'success_rate': stats.success_rate(),
+                             'mean_latency': stats.mean_latency(),
+                             'max_latency': stats.max_latency,
+                             'open': stats.open_until > time.time()}
+                    for source, stats in self.sources.items()}
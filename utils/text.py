@@ -0,0 +1,207 @@
+import codecs
+import html.parser
+import logging
+import os
+import posixpath
+import re
+import urllib.parse
+import zipfile
+import xml.etree.ElementTree as ET
+
+
+logger = logging.getLogger('{}.{}'.format(os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), __name__))
+
+
+# Number of bytes read at a time from the markup files
+CHUNK_SIZE = 64 * 1024
+
+# Elements whose content is not text, e.g. the base64 images of a FB2 file
+SKIPPED_ELEMENTS = {'script', 'style', 'binary', 'head'}
+# Elements separating the text in blocks: a newline is added at their limits
+# so that the numbers of two paragraphs (or table cells) are not joined
+BLOCK_ELEMENTS = {
+    'address', 'article', 'aside', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt', 'figcaption', 'figure', 'footer',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li', 'ol', 'p', 'pre', 'section', 'table', 'td', 'th',
+    'title', 'tr', 'ul',
+    # FB2
+    'annotation', 'empty-line', 'epigraph', 'poem', 'stanza', 'subtitle', 'text-author', 'v',
+    # DOCX and ODT
+    'w:p', 'w:br', 'w:tab', 'text:p', 'text:h', 'text:line-break', 'text:tab',
+}
+ENCODING_REGEX = re.compile(rb'''(?:encoding|charset)\s*=\s*["']?([\w.:-]+)''', re.I)
+
+# Documents of the zip-based word processing files holding the text, in order
+OFFICE_DOCUMENTS = {
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': ['word/document.xml'],
+    'application/vnd.oasis.opendocument.text': ['content.xml'],
+}
+# Types (in the OPF <guide>) and names of the front matter documents, where
+# the copyright page usually is
+FRONT_MATTER_TYPES = {'copyright-page', 'title-page', 'titlepage', 'imprint', 'colophon', 'frontmatter'}
+FRONT_MATTER_REGEX = re.compile(r'copyright|imprint|colophon|title|front|legal|rights|isbn', re.I)
+EPUB_NAMESPACES = {
+    'container': 'urn:oasis:names:tc:opendocument:xmlns:container',
+    'opf': 'http://www.idpf.org/2007/opf',
+}
+
+
+class MarkupTextParser(html.parser.HTMLParser):
+    """
+    Incremental tag stripper for HTML, XHTML and XML documents: the markup is
+    fed chunk by chunk and the text found so far is returned by pop_text().
+
+    HTMLParser is used instead of an XML parser since it doesn't fail on the
+    malformed documents that are common in ebooks.
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._parts = []
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_ELEMENTS:
+            self._skip_depth += 1
+        elif tag in BLOCK_ELEMENTS:
+            self._parts.append('\n')
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in BLOCK_ELEMENTS:
+            self._parts.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_ELEMENTS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in BLOCK_ELEMENTS:
+            self._parts.append('\n')
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self._parts.append(data)
+
+    def pop_text(self):
+        text = ''.join(self._parts)
+        self._parts = []
+        return text
+
+
+def guess_markup_encoding(head, default='utf-8'):
+    """
+    :param head: first bytes of an HTML or XML document
+    :return str: the encoding declared in the XML declaration or the
+                 `<meta charset>` of the document, or `default`
+    """
+    if head.startswith(codecs.BOM_UTF8):
+        return 'utf-8'
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    match = ENCODING_REGEX.search(head[:1024])
+    if match:
+        encoding = match.group(1).decode('ascii', errors='replace')
+        try:
+            return codecs.lookup(encoding).name
+        except LookupError:
+            logger.debug('Unknown encoding {}'.format(encoding))
+    return default
+
+
+def iter_markup_text(f, chunk_size=CHUNK_SIZE):
+    """
+    Yields the text of an HTML/XML document by chunks, as the binary file
+    object `f` is read.
+
+    :param f: file object opened in binary mode
+    :param chunk_size: number of bytes read at a time
+    """
+    head = f.read(chunk_size)
+    decoder = codecs.getincrementaldecoder(guess_markup_encoding(head))(errors='replace')
+    parser = MarkupTextParser()
+    data = head
+    while data:
+        parser.feed(decoder.decode(data))
+        text = parser.pop_text()
+        if text:
+            yield text
+        data = f.read(chunk_size)
+    parser.feed(decoder.decode(b'', final=True))
+    parser.close()
+    text = parser.pop_text()
+    if text:
+        yield text
+
+
+def get_epub_documents(zip_file):
+    """
+    Returns the content documents of an epub in reading order, i.e. in the
+    order of the OPF spine.
+
+    :param zip_file: the epub opened as a `zipfile.ZipFile`
+    :return: list of tuples `(path in the archive, is_front_matter)`
+    """
+    container = ET.fromstring(zip_file.read('META-INF/container.xml'))
+    rootfile = container.find('.//container:rootfile', EPUB_NAMESPACES)
+    if rootfile is None or not rootfile.get('full-path'):
+        raise ValueError('No OPF file in META-INF/container.xml')
+    opf_path = rootfile.get('full-path')
+    opf = ET.fromstring(zip_file.read(opf_path))
+
+    def get_path(href):
+        href = urllib.parse.unquote(href.split('#')[0])
+        return posixpath.normpath(posixpath.join(posixpath.dirname(opf_path), href))
+
+    manifest = {}
+    for item in opf.iterfind('opf:manifest/opf:item', EPUB_NAMESPACES):
+        if item.get('id') and item.get('href'):
+            manifest[item.get('id')] = item
+    front_matter_paths = {get_path(reference.get('href', '')) for reference in
+                          opf.iterfind('opf:guide/opf:reference', EPUB_NAMESPACES)
+                          if reference.get('type', '').lower() in FRONT_MATTER_TYPES}
+    documents = []
+    for itemref in opf.iterfind('opf:spine/opf:itemref', EPUB_NAMESPACES):
+        item = manifest.get(itemref.get('idref'))
+        if item is None:
+            continue
+        path = get_path(item.get('href'))
+        is_front_matter = path in front_matter_paths or \
+            FRONT_MATTER_REGEX.search('{} {}'.format(item.get('id'), posixpath.basename(path))) is not None
+        documents.append((path, is_front_matter))
+    if not documents:
+        # No (usable) spine: the documents in the order of the archive
+        documents = [(name, FRONT_MATTER_REGEX.search(posixpath.basename(name)) is not None)
+                     for name in zip_file.namelist() if name.lower().endswith(('.xhtml', '.html', '.htm'))]
+    return documents
+
+
+def iter_epub_text(file_path, front_matter_first=True, separator='\n'):
+    """
+    Yields the text of an epub by chunks, document by document in reading
+    order. The documents are streamed from the archive and never extracted.
+
+    :param file_path: path of the epub
+    :param front_matter_first: if True, the front matter documents (copyright
+                               page, title page, ...) are read first
+    :param separator: yielded after each document so that the text of two
+                      documents is not joined
+    """
+    with zipfile.ZipFile(file_path) as zip_file:
+        documents = get_epub_documents(zip_file)
+        if front_matter_first:
+            documents = [d for d in documents if d[1]] + [d for d in documents if not d[1]]
+        for path, is_front_matter in documents:
+            try:
+                info = zip_file.getinfo(path)
+            except KeyError:
+                logger.debug('Missing document {} in {}'.format(path, file_path))
+                continue
+            with zip_file.open(info) as f:
+                yield from iter_markup_text(f)
+            yield separator
+
+
+def iter_office_text(file_path, mime_type):
+    """
+    Yields the text of a docx or odt file by chunks, see `OFFICE_DOCUMENTS`.
+    """
+    with zipfile.ZipFile(file_path) as zip_file:
+        for name in OFFICE_DOCUMENTS[mime_type]:
+            with zip_file.open(name) as f:
+                yield from iter_markup_text(f)